@@ -151,7 +151,7 @@ class UsersWidget(QtGui.QDialog):
         self.connect(cancelButton, QtCore.SIGNAL("clicked()"), self, QtCore.SLOT("reject()"))
 
     def exec_(self):
-        if not self.parent.userinfo["is_admin"]:
+        if not (self.parent.userinfo or {}).get("is_admin"):
             self.user_add.setDisabled(1)
             self.user_delete.setDisabled(1)
         # Get users list
@@ -191,12 +191,18 @@ class UsersWidget(QtGui.QDialog):
             self.loadUserList()
 
     def updateInfo(self):
+        # Get groups list and users info in one round trip
+        groups, users = vaultMulticall(("group_list", ()),
+                                       ("user_list", (True,)))
+        # Failed calls give False
+        self.groups = (groups or {}).get("list", [])
+        users = (users or {}).get("list", [])
         # Get your informations
-        self.parent.userinfo = getUserInfo(str(self.settings.value("SFLvault/username").toString()))
-        # Get groups list
-        self.groups = listGroup()
-        # Update users info
-        users = listUsers(True)
+        username = str(self.settings.value("SFLvault/username").toString())
+        self.parent.userinfo = False
+        for user in users:
+            if user["username"] == username:
+                self.parent.userinfo = user
         self.model_user = UsersModel(users, parent=self)
 
     def editUser(self):
@@ -231,10 +237,13 @@ class UsersWidget(QtGui.QDialog):
                     datetime = QtCore.QDateTime.fromString(user["created_stamp"].value, "yyyyMMddTHH:mm:ss")
                     self.created_stamp.setDateTime(datetime)
                     self.created_stamp.setDisplayFormat("yyyy-MM-dd HH:mm:ss")
+                    # Your groups, none if you weren't in the users list
+                    yourgroups = [yourgroup["name"] for yourgroup in
+                                  (self.parent.userinfo or {}).get("groups", [])]
                     # Load all groups
-                    for group in self.groups["list"]:
+                    for group in self.groups:
                         # Do not show group which you are not member
-                        if not group["name"] in [yourgroup["name"]  for yourgroup in self.parent.userinfo["groups"] ]:
+                        if not group["name"] in yourgroups:
                             continue
                         group_member = False
                         # browser user groups
@@ -64,6 +64,11 @@ class TreeItem(QtCore.QObject):
         return 0
 
 
+# Number of search results loaded at a time, the next ones are loaded
+# when the tree is scrolled down (see TreeModel.fetchMore)
+SEARCH_PAGE_SIZE = 200
+
+
 class TreeModel(QtCore.QAbstractItemModel):
     def __init__(self, research=None, groups_ids=None, parentView=None):
         QtCore.QAbstractItemModel.__init__(self, parentView)
@@ -76,34 +81,50 @@ class TreeModel(QtCore.QAbstractItemModel):
         self.research = research
         self.groups_ids = groups_ids
 
-        # Init data item tree
-        parents = []
-        parents.append(self.rootItem)
+        # Items already in the tree, as results of a same customer or
+        # machine can come in different pages
+        self.customerItems = {}
+        self.machineItems = {}
+        self.offset = 0
+        self.total = 0
 
         if not self.research:
             self.research = "."
+        self.loadPage()
+
+    def loadPage(self):
+        """Load the next page of search results into the tree"""
         search_result = vaultSearch(self.research, 
                                         {"groups": self.groups_ids,
                                          "machines": [],
                                          "customers": [],
-                                        })
+                                        },
+                                    SEARCH_PAGE_SIZE, self.offset)
+        self.offset += SEARCH_PAGE_SIZE
+        # Older servers return everything at once
+        self.total = search_result.get("total", 0)
+
         for custoid, custo in search_result["results"].items():
-            it = TreeItem([custo["name"],
-                           "c#" + custoid],
-                          Qicons("customer"),
-                          parents[-1])
-            parents[-1].appendChild(it)
-            parents.append(parents[-1].child(parents[-1].childCount() - 1))
+            if custoid not in self.customerItems:
+                it = TreeItem([custo["name"],
+                               "c#" + custoid],
+                              Qicons("customer"),
+                              self.rootItem)
+                self.rootItem.appendChild(it)
+                self.customerItems[custoid] = it
+            custoItem = self.customerItems[custoid]
 
             for machineid, machine in custo["machines"].items():
-                it = TreeItem(["%s (%s - %s)" % (machine["name"],
-                                                 machine["fqdn"],
-                                                 machine["ip"]),
-                               "m#" + machineid],
-                              Qicons("machine"),
-                              parents[-1])
-                parents[-1].appendChild(it)
-                parents.append(parents[-1].child(parents[-1].childCount() - 1))
+                if machineid not in self.machineItems:
+                    it = TreeItem(["%s (%s - %s)" % (machine["name"],
+                                                     machine["fqdn"],
+                                                     machine["ip"]),
+                                   "m#" + machineid],
+                                  Qicons("machine"),
+                                  custoItem)
+                    custoItem.appendChild(it)
+                    self.machineItems[machineid] = it
+                machineItem = self.machineItems[machineid]
 
                 for serviceid, service in machine["services"].items():
                     if not service["url"]:
@@ -113,12 +134,20 @@ class TreeModel(QtCore.QAbstractItemModel):
                         it = TreeItem([service["url"],
                                        "s#" + serviceid],
                                       Qicons(protocol, "service"),
-                                      parents[-1])
-                        parents[-1].appendChild(it)
-
-                parents.pop()
+                                      machineItem)
+                        machineItem.appendChild(it)
 
-            parents.pop()
+    def canFetchMore(self, parent):
+        if parent.isValid():
+            return False
+        return self.offset < self.total
+
+    def fetchMore(self, parent):
+        if not self.canFetchMore(parent):
+            return
+        self.layoutAboutToBeChanged.emit()
+        self.loadPage()
+        self.layoutChanged.emit()
 
     def columnCount(self, parent):
         if parent.isValid():
@@ -32,6 +32,7 @@ from PyQt4 import QtCore, QtGui
 from Crypto.PublicKey import ElGamal
 
 from sflvault.client import SFLvaultClient
+from sflvault.client.utils import SessionError
 from sflvault.clientqt.gui.config.config import Config
 from error import *
 
@@ -154,13 +155,13 @@ def reauth(func):
     """ Decorator to reactivate the client if is expired
     """
     def reauth_func(*k, **a):
-        status = func(*k, **a)
+        try:
+            status = func(*k, **a)
+        except SessionError, e:
+            getAuth()
+            status = func(*k, **a)
         if 'error' in status and status["error"]:
-            if status['message'] == 'Permission denied':
-                getAuth()
-                status = func(*k, **a)
-            else:
-                ErrorMessage(status['message'])
+            ErrorMessage(status['message'])
         return status
     return reauth_func
 
@@ -195,6 +196,31 @@ def return_user(func):
         return False
     return ret_user
 
+def vaultMulticall(*calls):
+    """ Make independent (method, args) calls to the vault in one round
+        trip, see SFLvaultClient.multicall().  The authtok is added to the
+        args.  Returns the results, False for those that failed
+    """
+    global client
+    batch = client.multicall()
+    for method, args in calls:
+        getattr(batch, method)(*args)
+    try:
+        results = batch()
+    except socket.error, e:
+        ErrorMessage(e)
+        return [False] * len(calls)
+    if not results:
+        # The authentication was aborted
+        return [False] * len(calls)
+    for i, status in enumerate(results):
+        if isinstance(status, xmlrpclib.Fault):
+            ErrorMessage(status)
+            results[i] = False
+        elif isinstance(status, dict) and status.get("error"):
+            ErrorMessage(status['message'])
+    return results
+
 @return_user
 @try_connect
 @reauth
@@ -234,10 +260,12 @@ def getCustomer(id):
 
 @try_connect
 @reauth
-def vaultSearch(pattern, filters={}):
+def vaultSearch(pattern, filters={}, limit=None, offset=0):
     global client
-    result = client.vault.search(client.authtok, pattern,
-                                filters.get('groups'), False, filters)
+    args = [client.authtok, pattern, filters.get('groups'), False, filters]
+    if limit is not None or offset:
+        args += [limit, offset]
+    result = client.vault.search(*args)
     return result
 
 @return_element("plaintext")
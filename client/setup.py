@@ -56,6 +56,7 @@ setup(
     entry_points="""
     [console_scripts]
     sflvault = sflvault.client.commands:main
+    sflvault-agent = sflvault.client.agent:main
 
     [sflvault.services]
     ssh = sflvault.client.services:ssh
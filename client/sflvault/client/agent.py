@@ -0,0 +1,357 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""sflvault-agent: keeps the private key unlocked for the CLI.
+
+Outside shell mode, each `sflvault` command asks for the passphrase,
+decrypts the private key, answers the login challenge and decrypts the
+group keys again.  Like ssh-agent, `sflvault-agent` asks for the
+passphrase once, and keeps for the next commands, on a Unix socket:
+
+  * the unlocked private key, used to answer the login challenges,
+  * the last authtok,
+  * the decrypted group keys, for `groupkey_cache_ttl` seconds,
+
+and decrypts the services' symkeys on the client's behalf, so that the
+client is left with the RPC and the AES decryption of the secrets.  It
+also wraps symkeys for a group, and encrypts a group's key for a new
+member.
+
+Neither the user's private key nor the decrypted group keys leave the
+agent.  The commands that need a group's private key itself (migrating a
+group's ciphers) ask for the passphrase instead.
+
+Start it with:
+
+  eval `sflvault-agent`
+
+which sets SFLVAULT_AGENT_SOCK for the commands run afterwards.  The
+client also finds it with the `agent_socket` option of its config.
+
+The protocol is one JSON object per line each way: {"op": ..., args} and
+{"error": message} or the results.
+"""
+
+import json
+import optparse
+import os
+import socket
+import SocketServer
+import struct
+import sys
+import threading
+import time
+from base64 import b64encode
+
+from sflvault.common.crypto import *
+from sflvault.client.utils import GroupKeyCache
+
+# Environment variable telling the clients where the agent listens.
+AGENT_SOCK_ENV = 'SFLVAULT_AGENT_SOCK'
+
+# From <sys/socket.h>, Python 2 doesn't have it.
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+
+
+class AgentError(Exception):
+    """Raised on the client side when the agent can't be used"""
+    pass
+
+
+class Agent(object):
+    """What the agent keeps, and the operations it does.
+
+    privkey - the unlocked private key object.
+    username, url - whose key it is, and for which vault.
+    lifetime - forget everything after that many seconds, 0 never to.
+    """
+    def __init__(self, privkey, username, url, lifetime=0,
+                 groupkey_size=32, groupkey_ttl=600):
+        self.privkey = privkey
+        self.username = username
+        self.url = url
+        self.expires = time.time() + int(lifetime) if int(lifetime) else None
+        self.authtok = ''
+        self.groupkeys = GroupKeyCache(groupkey_size, groupkey_ttl)
+        self._lock = threading.Lock()
+
+    def locked(self):
+        if self.expires is not None and self.expires < time.time():
+            self.lock()
+        return self.privkey is None
+
+    def lock(self):
+        """Forget the private key and everything decrypted with it"""
+        self.privkey = None
+        self.authtok = ''
+        self.groupkeys.clear()
+
+    def handle(self, request):
+        """Run one request, and return the response"""
+        op = request.pop('op', None)
+        func = getattr(self, 'op_%s' % op, None)
+        if func is None:
+            return {'error': "Unknown operation: %s" % op}
+        self._lock.acquire()
+        try:
+            if op not in ('status', 'lock') and self.locked():
+                return {'error': "The agent is locked"}
+            return func(**request)
+        except (DecryptError, TypeError, ValueError), e:
+            return {'error': "%s failed: %s" % (op, e)}
+        finally:
+            self._lock.release()
+
+    def op_status(self):
+        return {'locked': self.locked(), 'username': self.username,
+                'url': self.url, 'groupkeys': len(self.groupkeys)}
+
+    def op_lock(self):
+        self.lock()
+        return {}
+
+    def op_challenge(self, cryptok):
+        """Decrypt the login challenge, as the client's authenticate()"""
+        if isinstance(self.privkey, X25519Key):
+            token = decrypt_longmsg(self.privkey, cryptok)
+        else:
+            token = elgamal_decrypt(self.privkey,
+                                    unserial_elgamal_msg(cryptok))
+        return {'token': b64encode(token)}
+
+    def op_authtok_get(self):
+        return {'authtok': self.authtok}
+
+    def op_authtok_set(self, authtok):
+        self.authtok = authtok
+        return {}
+
+    def _groupkey(self, group_id, cryptgroupkey):
+        grouppacked = self.groupkeys.get(group_id, cryptgroupkey)
+        if grouppacked is None:
+            grouppacked = decrypt_longmsg(self.privkey, cryptgroupkey)
+            self.groupkeys.set(group_id, cryptgroupkey, grouppacked)
+        return grouppacked
+
+    def op_groupkey_for(self, group_id, cryptgroupkey, pubkey):
+        """Encrypt the group key for a new member's serialized pubkey"""
+        grouppacked = self._groupkey(group_id, cryptgroupkey)
+        return {'cryptgroupkey': encrypt_longmsg(unserial_pubkey(pubkey),
+                                                 grouppacked)}
+
+    def op_wrap_symkey(self, group_id, cryptgroupkey, symkey):
+        """Wrap a service's symkey with the group's wrapping key"""
+        grouppacked = self._groupkey(group_id, cryptgroupkey)
+        return {'cryptsymkey': wrap_symkey(group_wrapkey(grouppacked),
+                                           symkey)}
+
+    def op_symkeys(self, group_id, cryptgroupkey, cryptsymkeys):
+        """Decrypt the symkeys of services of the same group"""
+        grouppacked = self._groupkey(group_id, cryptgroupkey)
+        groupkey = unserial_privkey(grouppacked)
+        wrapkey = None
+        symkeys = []
+        for cryptsymkey in cryptsymkeys:
+            if cryptsymkey.startswith(GROUP_WRAP_PREFIX):
+                if wrapkey is None:
+                    wrapkey = group_wrapkey(grouppacked)
+                symkeys.append(unwrap_symkey(wrapkey, cryptsymkey))
+            else:
+                symkeys.append(decrypt_longmsg(groupkey, cryptsymkey))
+        return {'symkeys': symkeys}
+
+
+def _str(value):
+    """The strings we exchange are ASCII, but come out of JSON as unicode"""
+    if isinstance(value, unicode):
+        return str(value)
+    if isinstance(value, list):
+        return [_str(x) for x in value]
+    return value
+
+
+class AgentRequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        if sys.platform.startswith('linux'):
+            # Only serve our own user, whatever the socket's mode.
+            creds = self.request.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                                            struct.calcsize('3i'))
+            if struct.unpack('3i', creds)[1] != os.getuid():
+                return
+
+        for line in iter(self.rfile.readline, ''):
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("not an object")
+                request = dict([(str(k), _str(v))
+                                for k, v in request.items()])
+            except ValueError, e:
+                response = {'error': "Invalid request: %s" % e}
+            else:
+                if request.get('op') == 'stop':
+                    self.wfile.write(json.dumps({}) + '\n')
+                    self.server.agent.lock()
+                    threading.Thread(target=self.server.shutdown).start()
+                    return
+                response = self.server.agent.handle(request)
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+
+class AgentServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Serve an Agent on a Unix socket, only accessible by its owner"""
+    daemon_threads = True
+
+    def __init__(self, path, agent):
+        self.agent = agent
+        if os.path.exists(path):
+            os.unlink(path)
+        umask = os.umask(0177)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, path,
+                                                   AgentRequestHandler)
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+class AgentClient(object):
+    """Talk to an agent listening on `path`"""
+    def __init__(self, path, timeout=10):
+        self.path = path
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        self._sock = sock
+        self._file = sock.makefile('rb')
+
+    def close(self):
+        if self._sock is not None:
+            self._file.close()
+            self._sock.close()
+            self._sock = self._file = None
+
+    def call(self, op, **kwargs):
+        """Run an operation on the agent, and return its results.
+
+        Raises AgentError when the agent can't be reached or fails."""
+        kwargs['op'] = op
+        try:
+            if self._sock is None:
+                self._connect()
+            self._sock.sendall(json.dumps(kwargs) + '\n')
+            line = self._file.readline()
+            if not line:
+                raise socket.error("connection closed")
+        except (socket.error, IOError), e:
+            self.close()
+            raise AgentError("Can't talk to the agent on %s: %s" %
+                             (self.path, e))
+        response = json.loads(line)
+        if 'error' in response:
+            raise AgentError(response['error'])
+        return response
+
+
+def main():
+    from sflvault.client.client import SFLvaultClient
+    from sflvault.client.commands import CONFIG_FILE, CONFIG_FILE_ENV
+
+    parser = optparse.OptionParser(usage="eval `sflvault-agent [options]`")
+    parser.add_option('-c', '--config', dest="config",
+                      default=os.environ.get(CONFIG_FILE_ENV, CONFIG_FILE),
+                      help="Client configuration file")
+    parser.add_option('-s', '--socket', dest="socket", default=None,
+                      help="Unix socket to listen on (default: agent.sock "
+                           "next to the configuration file)")
+    parser.add_option('-t', '--lifetime', dest="lifetime", type="int",
+                      default=0,
+                      help="Forget the key after that many seconds")
+    parser.add_option('-f', '--foreground', dest="foreground",
+                      action="store_true", default=False,
+                      help="Don't detach from the terminal")
+    parser.add_option('-k', '--kill', dest="kill", action="store_true",
+                      default=False,
+                      help="Stop the agent of SFLVAULT_AGENT_SOCK")
+    opts, args = parser.parse_args()
+
+    if opts.kill:
+        if AGENT_SOCK_ENV not in os.environ:
+            print >>sys.stderr, "%s is not set" % AGENT_SOCK_ENV
+            return 1
+        AgentClient(os.environ[AGENT_SOCK_ENV]).call('stop')
+        print "unset %s;" % AGENT_SOCK_ENV
+        return 0
+
+    client = SFLvaultClient(opts.config)
+    cfg = client.cfg
+    if not cfg.has_option('SFLvault', 'key'):
+        print >>sys.stderr, "No private key in %s, run user-setup first" % \
+              cfg.config_file
+        return 1
+    try:
+        privkey = unserial_privkey(decrypt_privkey(cfg.get('SFLvault', 'key'),
+                                                   client.getpassfunc()))
+    except DecryptError, e:
+        print >>sys.stderr, "Invalid passphrase"
+        return 1
+
+    path = opts.socket or os.path.join(os.path.dirname(cfg.config_file),
+                                       'agent.sock')
+    path = os.path.abspath(os.path.expanduser(path))
+    agent = Agent(privkey, cfg.get('SFLvault', 'username'),
+                  cfg.get('SFLvault', 'url'), opts.lifetime,
+                  client.groupkeys.size, client.groupkeys.ttl)
+    del(privkey)
+    server = AgentServer(path, agent)
+
+    print "%s=%s; export %s;" % (AGENT_SOCK_ENV, path, AGENT_SOCK_ENV)
+    sys.stdout.flush()
+    if not opts.foreground:
+        # Detach, as a daemon
+        if os.fork():
+            os._exit(0)
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in range(3):
+            os.dup2(devnull, fd)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
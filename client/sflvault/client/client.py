@@ -22,6 +22,8 @@
 import pkg_resources as pkgres
 from ConfigParser import ConfigParser, NoSectionError
 import xmlrpclib
+import urllib
+import zlib
 import getpass
 import sys
 import re
@@ -34,9 +36,13 @@ from decorator import decorator
 from pprint import pprint
 
 from sflvault.common import VaultError
+from sflvault.common import jsonrpc
+import sflvault.common.crypto
 from sflvault.common.crypto import *
 from sflvault.client.utils import *
 from sflvault.client import remoting
+from sflvault.client.migrate import CipherMigration, Checkpoint
+from sflvault.client.agent import AgentClient, AgentError, AGENT_SOCK_ENV
 
 
 
@@ -63,81 +69,258 @@ def authenticate(keep_privkey=False):
         """Login decorator
         
         self is there because it's called on class elements.
+
+        The last authtok is used right away, and we only go through the
+        login/authenticate roundtrip when the vault says its session is
+        gone (see VaultProxy).
         """
 
         username = self.cfg.get('SFLvault', 'username')
-        privkey = None
+        agent = not hasattr(self, 'privkey') and self._agent_ready(username)
 
         # Check if we've cached the decrypted private key
-        if hasattr(self, 'privkey'):
-            # Use cached private key.
-            privkey = self.privkey
-
-        else:
+        privkey = getattr(self, 'privkey', None)
+        if privkey is None and not agent and keep_privkey:
+            privkey = self._load_privkey(keep_privkey)
+            if privkey is None:
+                return False
 
+        if self.authtok:
             try:
-                privkey_enc = self.cfg.get('SFLvault', 'key')
-            except:
-                raise VaultConfigurationError("No private key in local config, init with: user-setup username vault-url")
-        
-            try:
-                privpass = self.getpassfunc()
-                privkey_packed = decrypt_privkey(privkey_enc, privpass)
-                del(privpass)
-                eg = ElGamal.ElGamalobj()
-                (eg.p, eg.x, eg.g, eg.y) = unserial_elgamal_privkey(privkey_packed)
-                privkey = eg
-
-            except DecryptError, e:
-                print "[SFLvault] Invalid passphrase"
-                return False
-            except TypeError, e:
-                print "[SFLvault] Could not retrieve passphrase, please resync your Keyring using the 'wallet' command."
-                return False
-            except KeyboardInterrupt, e:
-                print "[aborted]"
+                return func(self, *args, **kwargs)
+            except SessionError, e:
+                print "[SFLvault] %s, authenticating again" % e
+                self.authtok = ''
+
+        if privkey is None and not agent:
+            privkey = self._load_privkey(keep_privkey)
+            if privkey is None:
                 return False
 
-            # When we ask to keep the privkey, keep the ElGamal obj.
-            if keep_privkey or self.shell_mode:
-                self.privkey = privkey
-
-       # Go for the login/authenticate roundtrip
-
-        # TODO: check also is the privkey (ElGamal obj) has been cached
-        #       in self.privkey (when invoked with keep_privkey)
+        # Go for the login/authenticate roundtrip
         retval = self.vault.login(username, pkgres.get_distribution('SFLvault_client').version)
         self.authret = retval
-        if not retval['error']:
-            # try the last token
-            retval2 = self.vault.authenticate(username, self.authtok)
-            if retval2['error']:
-                print retval2['message']
-                # decrypt token.
-                cryptok = privkey.decrypt(unserial_elgamal_msg(retval['cryptok']))
-                retval3 = self.vault.authenticate(username, b64encode(cryptok))
-                self.authret = retval3
-
-                if retval3['error']:
-                    #print retval
-                    print retval3
-                    raise AuthenticationError("Authentication failed: %s" % \
-                                              retval3['message'])
-                else:
-                    self.authtok = retval3['authtok']
-                    print retval3['message']
+        if retval['error']:
+            raise AuthenticationError("Authentication failed: %s" % \
+                                      retval['message'])
 
-            else:
-                self.authtok = retval2['authtok']
-                print retval2['message']
-        else:
+        # decrypt token.
+        cryptok = self._decrypt_challenge(privkey, retval['cryptok'])
+        retval = self.vault.authenticate(username, b64encode(cryptok))
+        self.authret = retval
+        if retval['error']:
+            print retval
             raise AuthenticationError("Authentication failed: %s" % \
                                       retval['message'])
+        self.authtok = retval['authtok']
+        print retval['message']
+
+        if privkey is None:
+            # Keep the authtok in the agent for the next commands
+            try:
+                self.agent.call('authtok_set', authtok=self.authtok)
+            except AgentError, e:
+                print "[SFLvault] %s" % e
 
         return func(self, *args, **kwargs)
 
     return decorator(do_authenticate)
 
+
+class VaultProxy(object):
+    """The vault's XML-RPC methods, raising SessionError when the vault
+    refuses our authtok, so that authenticate() can log in again."""
+    def __init__(self, proxy):
+        self._proxy = proxy
+
+    def __getattr__(self, name):
+        # For the dotted names too, as vault.machine.get()
+        return VaultProxy(getattr(self._proxy, name))
+
+    def __call__(self, *args):
+        retval = self._proxy(*args)
+        if is_session_error(retval):
+            raise SessionError(retval['message'])
+        return retval
+
+
+def is_session_error(retval):
+    """Whether the vault refused the call's authtok"""
+    # Older vaults only tell it in the message
+    return isinstance(retval, dict) and bool(retval.get('error')) and \
+           (bool(retval.get('session_error')) or
+            retval.get('message', '').startswith('Permission denied (session'))
+
+
+class VaultMultiCall(object):
+    """Calls to the vault, collected to be made in one system.multicall.
+
+    Call the vault's methods on it as on SFLvaultClient.vault, but without
+    the authtok, then call it to get the list of their results:
+
+      batch = client.multicall()
+      batch.user_list(True)
+      batch.group_list()
+      users, groups = batch()
+
+    A call that failed gives its xmlrpclib.Fault instead of a result.  The
+    calls must not depend on each other, the vault makes them in order.
+    """
+    def __init__(self, client, calls=None, name=None):
+        self._client = client
+        self._calls = [] if calls is None else calls
+        self._name = name
+
+    def __getattr__(self, name):
+        if self._name:
+            name = '%s.%s' % (self._name, name)
+        return VaultMultiCall(self._client, self._calls, name)
+
+    def __call__(self, *args):
+        if self._name:
+            self._calls.append((self._name, args))
+            return None
+        return self._client.multicall_run(self._calls)
+
+
+class KeepAliveMixIn:
+    """Keep the connection to the vault open between calls when the vault
+    allows it (sflvault.server.keepalive), to save a TCP setup and, over
+    HTTPS, a TLS handshake per RPC.
+
+    With keepalive=False, the connection is closed after each call, as
+    older vaults do anyway.
+
+    Before Python 2.7, xmlrpclib opens a connection per call whatever
+    keepalive says."""
+    keepalive = True
+
+    def send_request(self, connection, handler, request_body):
+        xmlrpclib.Transport.send_request(self, connection, handler,
+                                         request_body)
+        if not self.keepalive:
+            connection.putheader("Connection", "close")
+
+    def single_request(self, host, handler, request_body, verbose=0):
+        try:
+            return xmlrpclib.Transport.single_request(self, host, handler,
+                                                      request_body, verbose)
+        finally:
+            if not self.keepalive:
+                self.close()
+
+    def close(self):
+        if sys.version_info < (2, 7):
+            # No connection is kept before Python 2.7
+            return
+        xmlrpclib.Transport.close(self)
+
+
+class NegotiateMixIn:
+    """Learn from the vault's responses whether it serves JSON-RPC, see
+    sflvault.common.jsonrpc, and takes gzipped requests.
+
+    VaultServer then sends its calls to `jsonrpc_path`, unless jsonrpc is
+    False, and the requests larger than `gzip_threshold` bytes are
+    gzipped.  With gzip_threshold = 0, nothing is gzipped either way.
+
+    Before Python 2.7, xmlrpclib doesn't hand the responses to
+    parse_response(), so nothing is learned: the calls stay in XML-RPC and
+    the requests aren't gzipped."""
+    jsonrpc = True
+    jsonrpc_path = None
+    gzip_threshold = 1400
+    encode_threshold = None
+
+    def send_content(self, connection, request_body):
+        if request_body.startswith('{'):
+            connection.putheader("Content-Type", "application/json")
+        else:
+            connection.putheader("Content-Type", "text/xml")
+        if self.encode_threshold and \
+           len(request_body) > self.encode_threshold:
+            connection.putheader("Content-Encoding", "gzip")
+            request_body = xmlrpclib.gzip_encode(request_body)
+        connection.putheader("Content-Length", str(len(request_body)))
+        if sys.version_info < (2, 7):
+            # endheaders() doesn't take the body before Python 2.7
+            connection.endheaders()
+            connection.send(request_body)
+        else:
+            connection.endheaders(request_body)
+
+    def parse_response(self, response):
+        path = response.getheader(jsonrpc.JSONRPC_HEADER)
+        if path and self.jsonrpc:
+            self.jsonrpc_path = path
+        if 'gzip' in response.getheader('accept-encoding', '') and \
+           self.gzip_threshold:
+            self.encode_threshold = self.gzip_threshold
+        if response.getheader('content-type', '') == 'application/json':
+            data = response.read()
+            if response.getheader('content-encoding', '') == 'gzip':
+                data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+            return (jsonrpc.loads_response(data),)
+        return xmlrpclib.Transport.parse_response(self, response)
+
+
+class VaultTransport(NegotiateMixIn, KeepAliveMixIn, xmlrpclib.Transport):
+    def __init__(self, keepalive=True, jsonrpc=True, gzip_threshold=1400,
+                 **kwargs):
+        xmlrpclib.Transport.__init__(self, **kwargs)
+        self.keepalive = keepalive
+        self.jsonrpc = jsonrpc
+        self.gzip_threshold = int(gzip_threshold)
+        self.accept_gzip_encoding = bool(self.gzip_threshold)
+
+
+class SafeVaultTransport(NegotiateMixIn, KeepAliveMixIn,
+                         xmlrpclib.SafeTransport):
+    def __init__(self, keepalive=True, jsonrpc=True, gzip_threshold=1400,
+                 **kwargs):
+        xmlrpclib.SafeTransport.__init__(self, **kwargs)
+        self.keepalive = keepalive
+        self.jsonrpc = jsonrpc
+        self.gzip_threshold = int(gzip_threshold)
+        self.accept_gzip_encoding = bool(self.gzip_threshold)
+
+
+class VaultServer:
+    """Like xmlrpclib.ServerProxy, but making the calls over JSON-RPC once
+    the transport knows the vault serves it."""
+    def __init__(self, url, transport):
+        host_path = urllib.splittype(url)[1]
+        self._host, self._handler = urllib.splithost(host_path)
+        self._handler = self._handler or '/RPC2'
+        self._transport = transport
+
+    def _request(self, methodname, params):
+        if self._transport.jsonrpc_path:
+            handler = self._transport.jsonrpc_path
+            body = jsonrpc.dumps_request(methodname, params)
+        else:
+            handler = self._handler
+            body = xmlrpclib.dumps(params, methodname, allow_none=True)
+        response = self._transport.request(self._host, handler, body)
+        if len(response) == 1:
+            response = response[0]
+        return response
+
+    def __getattr__(self, name):
+        return xmlrpclib._Method(self._request, name)
+
+
+def vault_server(url, keepalive=True, jsonrpc=True, gzip_threshold=1400,
+                 **kwargs):
+    """Return the proxy to the vault at `url`, and its transport"""
+    if url.lower().startswith('https:'):
+        transport = SafeVaultTransport(keepalive, jsonrpc, gzip_threshold,
+                                       **kwargs)
+    else:
+        transport = VaultTransport(keepalive, jsonrpc, gzip_threshold,
+                                   **kwargs)
+    return VaultServer(url, transport), transport
+
 ###
 ### Différentes façons d'obtenir la passphrase
 ###
@@ -421,10 +604,65 @@ class SFLvaultClient(object):
         self.shell_mode = shell
         self.authtok = ''
         self.authret = None
+
+        # The sflvault-agent holding our unlocked private key, if any
+        self.agent = None
+        path = os.environ.get(AGENT_SOCK_ENV)
+        if not path and self.cfg.has_option('SFLvault', 'agent_socket'):
+            path = os.path.expanduser(self.cfg.get('SFLvault',
+                                                   'agent_socket'))
+        if path and os.path.exists(path):
+            self.agent = AgentClient(path)
+
+        # Decrypted group keys, see _decrypt_groupkey()
+        size = 32
+        ttl = 600
+        if self.cfg.has_option('SFLvault', 'groupkey_cache_size'):
+            size = self.cfg.get('SFLvault', 'groupkey_cache_size')
+        if self.cfg.has_option('SFLvault', 'groupkey_cache_ttl'):
+            ttl = self.cfg.get('SFLvault', 'groupkey_cache_ttl')
+        self.groupkeys = GroupKeyCache(size, ttl)
+
+        # Format of the group keys we encrypt for other users, see
+        # encrypt_longmsg()
+        if self.cfg.has_option('SFLvault', 'longmsg_version'):
+            sflvault.common.crypto.LONGMSG_VERSION = int(
+                self.cfg.get('SFLvault', 'longmsg_version'))
+        # Wrap the symkeys of the services we add or change with the
+        # groups' wrapping keys, see GROUP_WRAP_PREFIX.  Only turn it on
+        # once all the members' clients can read these.
+        self.wrap_symkeys = False
+        if self.cfg.has_option('SFLvault', 'wrap_symkeys'):
+            self.wrap_symkeys = self.cfg.get('SFLvault', 'wrap_symkeys') \
+                                .lower() in ['1', 'true', 'yes', 'on']
+        # 'auto', 'gmpy2' or 'python', see BIGINT_BACKEND
+        if self.cfg.has_option('SFLvault', 'bigint_backend'):
+            sflvault.common.crypto.BIGINT_BACKEND = \
+                self.cfg.get('SFLvault', 'bigint_backend')
+
+        # Keep the connection to the vault open between calls
+        self.keepalive = True
+        if self.cfg.has_option('SFLvault', 'keepalive'):
+            self.keepalive = self.cfg.get('SFLvault', 'keepalive') \
+                             .lower() in ['1', 'true', 'yes', 'on']
+        # Switch to JSON-RPC when the vault serves it
+        self.jsonrpc = True
+        if self.cfg.has_option('SFLvault', 'jsonrpc'):
+            self.jsonrpc = self.cfg.get('SFLvault', 'jsonrpc') \
+                           .lower() in ['1', 'true', 'yes', 'on']
+        # Gzip the requests larger than that, once the vault says it takes
+        # them, 0 not to use gzip at all.
+        self.gzip_threshold = 1400
+        if self.cfg.has_option('SFLvault', 'gzip_threshold'):
+            self.gzip_threshold = int(self.cfg.get('SFLvault',
+                                                   'gzip_threshold'))
+
         # Set the default route to the Vault
+        self.server = None
+        self.transport = None
         url = self.cfg.get('SFLvault', 'url')
         if url:
-            self.vault = xmlrpclib.Server(url, allow_none=True).sflvault
+            self._set_vault(url)
 
     def set_getpassfunc(self, func=None):
         """Set the function to ask for passphrase.
@@ -438,9 +676,134 @@ class SFLvaultClient(object):
         else:
             self.getpassfunc = func
         
+    def _load_privkey(self, keep_privkey=False):
+        """Decrypt our private key from the config, asking for the
+        passphrase.  Return it, or None when it couldn't be decrypted."""
+        try:
+            privkey_enc = self.cfg.get('SFLvault', 'key')
+        except:
+            raise VaultConfigurationError("No private key in local config, init with: user-setup username vault-url")
+
+        try:
+            privpass = self.getpassfunc()
+            privkey_packed = decrypt_privkey(privkey_enc, privpass)
+            del(privpass)
+            privkey = unserial_privkey(privkey_packed)
+
+        except DecryptError, e:
+            print "[SFLvault] Invalid passphrase"
+            return None
+        except TypeError, e:
+            print "[SFLvault] Could not retrieve passphrase, please resync your Keyring using the 'wallet' command."
+            return None
+        except KeyboardInterrupt, e:
+            print "[aborted]"
+            return None
+
+        # Group keys decrypted with another private key are now stale.
+        self.groupkeys.clear()
+
+        # When we ask to keep the privkey, keep the key obj.
+        if keep_privkey or self.shell_mode:
+            self.privkey = privkey
+        return privkey
+
+    def _agent_ready(self, username):
+        """Tell whether the agent has our private key unlocked, and take
+        the last authtok from it"""
+        if self.agent is None:
+            return False
+        try:
+            status = self.agent.call('status')
+            if status['locked'] or status['username'] != username or \
+               status['url'] != self.cfg.get('SFLvault', 'url'):
+                return False
+            if not self.authtok:
+                self.authtok = self.agent.call('authtok_get')['authtok']
+        except AgentError, e:
+            print "[SFLvault] %s" % e
+            return False
+        return True
+
+    def _use_agent(self):
+        """Whether the agent decrypts for us, see authenticate()"""
+        return not hasattr(self, 'privkey') and self.agent is not None
+
+    def _decrypt_challenge(self, privkey, cryptok):
+        """Decrypt the login challenge with privkey, or with the agent when
+        it is None"""
+        if privkey is None:
+            try:
+                return b64decode(self.agent.call('challenge',
+                                                 cryptok=cryptok)['token'])
+            except AgentError, e:
+                raise AuthenticationError("Authentication failed: %s" % e)
+        if isinstance(privkey, X25519Key):
+            return decrypt_longmsg(privkey, cryptok)
+        return elgamal_decrypt(privkey, unserial_elgamal_msg(cryptok))
+
+    def multicall(self):
+        """Return a VaultMultiCall, to make independent calls to the vault
+        in one round trip"""
+        return VaultMultiCall(self)
+
+    @authenticate()
+    def multicall_run(self, calls):
+        """Make the (method, args) calls with one system.multicall, see
+        VaultMultiCall"""
+        return self._multicall(calls)
+
+    def _multicall(self, calls):
+        """multicall_run(), for the methods already authenticated"""
+        if not calls:
+            return []
+        results = self.server.system.multicall(
+            [{'methodName': 'sflvault.%s' % method,
+              'params': [self.authtok] + list(args)}
+             for method, args in calls])
+        if results is None:
+            # Older vaults don't do system.multicall, one call at a time
+            results = []
+            for method, args in calls:
+                try:
+                    results.append([getattr(self.vault, method)(self.authtok,
+                                                                *args)])
+                except xmlrpclib.Fault, fault:
+                    results.append({'faultCode': fault.faultCode,
+                                    'faultString': fault.faultString})
+
+        out = []
+        for result in results:
+            if isinstance(result, dict):
+                out.append(xmlrpclib.Fault(result['faultCode'],
+                                           result['faultString']))
+            elif is_session_error(result[0]):
+                # They all have the same authtok, authenticate() will
+                # get another one and make them again.
+                raise SessionError(result[0]['message'])
+            else:
+                out.append(result[0])
+        return out
+
+    def close(self):
+        """Close the connection to the vault, if one is kept open"""
+        if self.transport is not None:
+            self.transport.close()
+
+    def forget_privkey(self):
+        """Wipe the cached private key and all the group keys decrypted
+        with it.  The passphrase will be asked again on next call."""
+        if hasattr(self, 'privkey'):
+            del(self.privkey)
+        self.groupkeys.clear()
+
     def _set_vault(self, url, save=False):
         """Set the vault's URL and optionally save it"""
-        self.vault = xmlrpclib.Server(url, allow_none=True).sflvault
+        self.close()
+        self.server, self.transport = vault_server(url, self.keepalive,
+                                                     self.jsonrpc,
+                                                     self.gzip_threshold)
+        self.vault = VaultProxy(self.server.sflvault)
         if save:
             self.cfg.set('SFLvault', 'url', url)
 
@@ -607,7 +970,7 @@ class SFLvaultClient(object):
 
         return retval
 
-    @authenticate()
+    @authenticate(True)
     def service_add(self, machine_id, parent_service_id, url, group_ids, secret,
                     notes='', metadata=None):
         """Add a service to the Vault's database.
@@ -632,12 +995,13 @@ class SFLvaultClient(object):
 
         # TODO: accept group_id as group_ids, accept list and send list.
         psi = int(parent_service_id) if parent_service_id else None
-        retval = vaultReply(self.vault.service_add(self.authtok,
-                                                  int(machine_id),
-                                                  psi, url,
-                                                  group_ids, secret,
-                                                  notes,
-                                                  metadata),
+        args = [self.authtok, int(machine_id), psi, url, group_ids, secret,
+                notes, metadata]
+        ciphertext, cryptsymkeys = self._encrypt_secret(group_ids, secret)
+        if cryptsymkeys:
+            args[5] = ciphertext
+            args.append(cryptsymkeys)
+        retval = vaultReply(self.vault.service_add(*args),
                             "Error adding service")
 
         print "Success: %s" % retval['message']
@@ -645,12 +1009,21 @@ class SFLvaultClient(object):
 
         return retval
 
-    @authenticate()
+    @authenticate(True)
     def service_passwd(self, service_id, newsecret):
         """Updates the password on the Vault for a certain service"""
-        retval = vaultReply(self.vault.service_passwd(self.authtok,
-                                                        service_id,
-                                                        newsecret),
+        args = [self.authtok, service_id, newsecret]
+        if self.wrap_symkeys:
+            tree = vaultReply(self.vault.service_get_tree(self.authtok,
+                                                          service_id, True),
+                              "Error loading service infos")
+            ciphertext, cryptsymkeys = self._encrypt_secret(
+                [gid for gid, name in tree['services'][-1]['groups_list']],
+                newsecret)
+            if cryptsymkeys:
+                args[2] = ciphertext
+                args.append(cryptsymkeys)
+        retval = vaultReply(self.vault.service_passwd(*args),
                             "Error changing password for "\
                             "service %s" % service_id)
 
@@ -696,7 +1069,8 @@ class SFLvaultClient(object):
 
         print "user-passwd successful"
         
-    def user_setup(self, username, vault_url, passphrase=None):
+    def user_setup(self, username, vault_url, passphrase=None,
+                   algorithm=None):
         """Sets up the local configuration to communicate with the Vault.
 
         username  - the name with which an admin prepared (with add-user)
@@ -705,6 +1079,8 @@ class SFLvaultClient(object):
                     (typically host://domain.example.org:5000/vault/rpc
         passphrase - use the given passphrase instead of asking it on the
                      command line.
+        algorithm - the type of key to generate, one of KEY_ALGORITHMS.
+                    Defaults to the 'key_algorithm' option, or 'elgamal'.
         """
         # possible-TODO: implement --force if user wants to override.
         if self.cfg.has_option('SFLvault', 'key'):
@@ -712,12 +1088,14 @@ class SFLvaultClient(object):
             
         self._set_vault(vault_url, False)
         
-        # Generate a new key:
-        print "Generating new ElGamal key-pair..."
-        eg = generate_elgamal_keypair()
+        if algorithm is None:
+            algorithm = 'elgamal'
+            if self.cfg.has_option('SFLvault', 'key_algorithm'):
+                algorithm = self.cfg.get('SFLvault', 'key_algorithm')
 
-        # Marshal the ElGamal key
-        pubkey = elgamal_pubkey(eg)
+        # Generate a new key:
+        print "Generating new %s key-pair..." % algorithm
+        eg = generate_keypair(algorithm)
 
         print "You will need a passphrase to secure your private key. The"
         print "encrypted key will be stored on this machine in %s" % self.cfg.config_file
@@ -729,7 +1107,7 @@ class SFLvaultClient(object):
         print "Sending request to vault..."
         # Send it to the vault, with username
         retval = vaultReply(self.vault.user_setup(username,
-                                                serial_elgamal_pubkey(pubkey)),
+                                                  serial_pubkey(eg)),
                             "Setup failed")
 
         # If Vault sends a SUCCESS, save all the stuff (username, vault_url)
@@ -743,8 +1121,7 @@ class SFLvaultClient(object):
         # p and x form the private key, add the public key, add g and y.
         # if encryption is required at some point.
         self.cfg.set('SFLvault', 'key',
-                   encrypt_privkey(serial_elgamal_privkey(elgamal_bothkeys(eg)),
-                                   passphrase))
+                     encrypt_privkey(serial_privkey(eg), passphrase))
         del(passphrase)
         del(eg)
 
@@ -754,7 +1131,7 @@ class SFLvaultClient(object):
 
 
     @authenticate()
-    def search(self, query, filters=None, verbose=True):
+    def search(self, query, filters=None, verbose=True, limit=None, offset=0):
         """Search the database for query terms.
 
         Arguments:
@@ -766,6 +1143,9 @@ class SFLvaultClient(object):
             
             verbose (bool): shows the notes and location attributes for services and machines.
 
+            limit, offset (int): return only one page of the results, `total`
+            tells how many results there are in all.
+
         Returns:
             Hierarchical view of the results.
         """
@@ -774,15 +1154,30 @@ class SFLvaultClient(object):
         if filters:
             filters = dict([(x, filters[x]) for x in filters if filters[x]])
 
-        retval = vaultReply(self.vault.search(self.authtok, query,
-                 filters.get('groups') if filters else None, verbose, filters),
+        args = [self.authtok, query,
+                filters.get('groups') if filters else None, verbose, filters]
+        if limit is not None or offset:
+            # Only sent when asked for, older servers don't know about it.
+            args += [limit, offset]
+        retval = vaultReply(self.vault.search(*args),
                             "Error searching database")
         print "Results:"
+        self._print_search_results(retval['results'], verbose)
+
+        if limit is not None and 'total' in retval:
+            print "Results %d to %d of %d" % (
+                min(offset + 1, retval['total']),
+                min(offset + limit, retval['total']), retval['total'])
+
+        return retval
+
+    def _print_search_results(self, results, verbose):
+        """Print the hierarchical results of search()"""
         encode = lambda x: x.encode('utf-8') if isinstance(x, str) else x
 
         # TODO: call the pager `less` when too long.
         level = 0
-        for c_id, c in retval['results'].items():
+        for c_id, c in results.items():
             level = 0
             # Display customer info
             print "c#%s  %s" % (c_id, encode(c['name']))
@@ -824,25 +1219,157 @@ class SFLvaultClient(object):
                 
             if level in [0,1]:
                 print "%s" % (spc1) + '-' * (80 - len(spc1))
-
-        return retval
             
-    def _decrypt_service(self, serv, onlysymkey=False, onlygroupkey=False):
+    def _decrypt_groupkey(self, group_id, cryptgroupkey):
+        """Decrypt a group's cryptgroupkey with our private key, and return
+        the serialized group privkey.
+
+        This is the longest thing to decrypt (over a second on a 3GHz
+        machine), so results are kept in self.groupkeys.
+
+        The agent doesn't give out group keys: when it's used, the
+        passphrase is asked for to decrypt our private key here.
+        """
+        grouppacked = self.groupkeys.get(group_id, cryptgroupkey)
+        if grouppacked is None:
+            privkey = getattr(self, 'privkey', None)
+            if privkey is None:
+                privkey = self._load_privkey(True)
+                if privkey is None:
+                    raise DecryptError("Unable to decrypt our private key")
+            grouppacked = decrypt_longmsg(privkey, cryptgroupkey)
+            self.groupkeys.set(group_id, cryptgroupkey, grouppacked)
+        return grouppacked
+
+    def _agent_call(self, op, **kwargs):
+        """Have the agent decrypt or encrypt with a group key, raise
+        DecryptError if it can't"""
+        try:
+            return self.agent.call(op, **kwargs)
+        except AgentError, e:
+            raise DecryptError("Unable to use the group key (%s)" % e)
+
+    def _encrypt_symkey(self, group_ids, symkey, group_list=None):
+        """Return symkey wrapped with the wrapping key of the groups in
+        group_ids we're a member of (see GROUP_WRAP_PREFIX), and encrypted
+        for the pubkey of the others, as a {group_id: cryptsymkey} dict.
+        The wrapping keys never leave the client.
+
+        This is None unless the 'wrap_symkeys' option is on, or if a group's
+        pubkey can't be loaded: the vault then encrypts the symkey itself.
+        group_list is the vault's group_list reply, if we already have it.
+        """
+        if not self.wrap_symkeys:
+            return None
+        group_ids = [int(x) for x in group_ids]
+        if group_list is None:
+            group_list = self.vault.group_list(self.authtok)
+        retval = vaultReply(group_list, "Error listing groups")
+        mine = dict((grp['id'], grp['cryptgroupkey'])
+                    for grp in retval['list'] if grp.get('cryptgroupkey'))
+
+        others = [gid for gid in group_ids if gid not in mine]
+        pubkeys = {}
+        results = self._multicall([('group_get', (gid,)) for gid in others])
+        for gid, retval in zip(others, results):
+            if isinstance(retval, xmlrpclib.Fault) or retval['error'] or \
+               not retval['group'].get('pubkey'):
+                return None
+            pubkeys[gid] = retval['group']['pubkey']
+
+        cryptsymkeys = {}
+        for gid in group_ids:
+            if gid in mine and self._use_agent():
+                cryptsymkeys[str(gid)] = str(self._agent_call('wrap_symkey',
+                    group_id=gid, cryptgroupkey=mine[gid],
+                    symkey=symkey)['cryptsymkey'])
+            elif gid in mine:
+                grouppacked = self._decrypt_groupkey(gid, mine[gid])
+                cryptsymkeys[str(gid)] = wrap_symkey(
+                    group_wrapkey(grouppacked), symkey)
+            else:
+                cryptsymkeys[str(gid)] = encrypt_longmsg(
+                    unserial_pubkey(pubkeys[gid]), symkey)
+        return cryptsymkeys
+
+    def _encrypt_secret(self, group_ids, secret):
+        """Encrypt secret with a new symkey, and the symkey for the groups,
+        see _encrypt_symkey().  Return the ciphertext and the cryptsymkeys,
+        or (None, None) to let the vault do it."""
+        seckey, ciphertext = encrypt_secret(secret)
+        cryptsymkeys = self._encrypt_symkey(group_ids, seckey)
+        del(seckey)
+        if not cryptsymkeys:
+            return None, None
+        return ciphertext, cryptsymkeys
+
+    def _decrypt_services(self, servs):
+        """Decrypt many service objects returned from the vault, with one
+        decrypt_longmsg_many(), or one call to the agent, per group."""
+        agent = self._use_agent()
+        bygroup = {}
+        for serv in servs:
+            if agent or \
+               not serv['cryptsymkey'].startswith(GROUP_WRAP_PREFIX):
+                bygroup.setdefault(serv['group_id'], []).append(serv)
+
+        symkeys = {}
+        for group_id, group_servs in bygroup.items():
+            if agent:
+                try:
+                    aeskeys = self.agent.call('symkeys', group_id=group_id,
+                        cryptgroupkey=group_servs[0]['cryptgroupkey'],
+                        cryptsymkeys=[x['cryptsymkey'] for x in group_servs])
+                except AgentError, e:
+                    raise DecryptError("Unable to decrypt symkey (%s)" % e)
+                for serv, aeskey in zip(group_servs, aeskeys['symkeys']):
+                    symkeys[id(serv)] = str(aeskey)
+                continue
+            try:
+                grouppacked = self._decrypt_groupkey(
+                    group_id, group_servs[0]['cryptgroupkey'])
+                groupkey = unserial_privkey(grouppacked)
+            except Exception, e:
+                raise DecryptError("Unable to decrypt groupkey (%s)" % e)
+            try:
+                for serv, aeskey in zip(group_servs, decrypt_longmsg_many(
+                        groupkey, [x['cryptsymkey'] for x in group_servs])):
+                    symkeys[id(serv)] = aeskey
+            except Exception, e:
+                raise DecryptError("Unable to decrypt symkey (%s)" % e)
+
+        for serv in servs:
+            self._decrypt_service(serv, aeskey=symkeys.get(id(serv)))
+
+    def _decrypt_service(self, serv, onlysymkey=False, onlygroupkey=False,
+                         aeskey=None):
         """Decrypt the service object returned from the vault.
 
         onlysymkey - return the plain symkey in the result
         onlygroupkey - return the plain groupkey ElGamal obj in result
+        aeskey - the symkey, when already decrypted
         """
+        if aeskey is None and not onlygroupkey and self._use_agent():
+            aeskey = str(self._agent_call('symkeys',
+                group_id=serv['group_id'],
+                cryptgroupkey=serv['cryptgroupkey'],
+                cryptsymkeys=[serv['cryptsymkey']])['symkeys'][0])
+
+        if aeskey is not None and not onlygroupkey:
+            if onlysymkey:
+                serv['symkey'] = aeskey
+            else:
+                serv['plaintext'] = decrypt_secret(aeskey, serv['secret'])
+            return
+
         # First decrypt groupkey
         try:
-            # TODO: implement a groupkey cache system, since it's the longest
-            #       thing to decrypt (over a second on a 3GHz machine)
-            grouppacked = decrypt_longmsg(self.privkey, serv['cryptgroupkey'])
+            grouppacked = self._decrypt_groupkey(serv['group_id'],
+                                                 serv['cryptgroupkey'])
         except Exception, e:
             raise DecryptError("Unable to decrypt groupkey (%s)" % e)
 
-        eg = ElGamal.ElGamalobj()
-        (eg.p, eg.x, eg.g, eg.y) = unserial_elgamal_privkey(grouppacked)
+        eg = unserial_privkey(grouppacked)
         groupkey = eg
         
         if onlygroupkey:
@@ -850,7 +1377,11 @@ class SFLvaultClient(object):
             
         # Then decrypt symkey
         try:
-            aeskey = decrypt_longmsg(groupkey, serv['cryptsymkey'])
+            if serv['cryptsymkey'].startswith(GROUP_WRAP_PREFIX):
+                aeskey = unwrap_symkey(group_wrapkey(grouppacked),
+                                       serv['cryptsymkey'])
+            else:
+                aeskey = decrypt_longmsg(groupkey, serv['cryptsymkey'])
         except Exception, e:
             raise DecryptError("Unable to decrypt symkey (%s)" % e)
 
@@ -881,7 +1412,7 @@ class SFLvaultClient(object):
         if decrypt:
             # Add it only if we can! (or if we want to)
             if serv.get('cryptgroupkey'):
-                self._decrypt_service(serv)
+                self._decrypt_services([serv])
 
         return serv
 
@@ -900,16 +1431,9 @@ class SFLvaultClient(object):
                                                         with_groups),
                 "Error fetching data-tree for service %s" % service_id)
 
-        for x in retval['services']:
-            # Decrypt secret
-            aeskey = ''
-            secret = ''
-
-            if not x['cryptsymkey']:
-                # Don't add a plaintext if we can't.
-                continue
-
-            self._decrypt_service(x)
+        # Don't add a plaintext if we can't.
+        self._decrypt_services([x for x in retval['services']
+                                if x['cryptsymkey']])
 
         return retval['services']
 
@@ -1074,8 +1598,18 @@ class SFLvaultClient(object):
     @authenticate(True)
     def group_add_service(self, group_id, service_id):
         print "Fetching service info..."
-        retval = vaultReply(self.vault.service_get(self.authtok, service_id),
-                            "Error loading service infos")
+        group_list = None
+        if self.wrap_symkeys:
+            # We'll need the group's wrapping key too
+            retval, group_list = self._multicall([('service_get',
+                                                   (service_id,)),
+                                                  ('group_list', ())])
+            for fault in [retval, group_list]:
+                if isinstance(fault, xmlrpclib.Fault):
+                    raise fault
+        else:
+            retval = self.vault.service_get(self.authtok, service_id)
+        retval = vaultReply(retval, "Error loading service infos")
 
         # TODO: decrypt the symkey with the group's decrypted privkey.
         serv = retval['service']
@@ -1085,10 +1619,14 @@ class SFLvaultClient(object):
 
 
         print "Sending data back to vault"
-        retval = vaultReply(self.vault.group_add_service(self.authtok,
-                                                         group_id,
-                                                         service_id,
-                                                         serv['symkey']),
+        args = [self.authtok, group_id, service_id, serv['symkey']]
+        cryptsymkeys = self._encrypt_symkey([group_id], serv['symkey'],
+                                            group_list)
+        if cryptsymkeys:
+            # The symkey itself isn't sent
+            args[3] = None
+            args.append(cryptsymkeys.values()[0])
+        retval = vaultReply(self.vault.group_add_service(*args),
                             "Error adding service to group")
 
         print "Success: %s" % retval['message']
@@ -1111,16 +1649,22 @@ class SFLvaultClient(object):
                                                       user),
                             "Error adding user to group")
 
-        # Decrypt cryptgroupkey
-        # TODO: make use of a cache
-        grouppacked = decrypt_longmsg(self.privkey, retval['cryptgroupkey'])
-        
-        # Get userpubkey and unpack
-        eg = ElGamal.ElGamalobj()
-        (eg.p, eg.g, eg.y) = unserial_elgamal_pubkey(retval['userpubkey'])
-        
-        # Re-encrypt for user
-        newcryptgroupkey = encrypt_longmsg(eg, grouppacked)
+        if self._use_agent():
+            # Re-encrypted for user without the group key leaving the agent
+            newcryptgroupkey = str(self._agent_call('groupkey_for',
+                group_id=retval['group_id'],
+                cryptgroupkey=retval['cryptgroupkey'],
+                pubkey=retval['userpubkey'])['cryptgroupkey'])
+        else:
+            # Decrypt cryptgroupkey
+            grouppacked = self._decrypt_groupkey(retval['group_id'],
+                                                 retval['cryptgroupkey'])
+
+            # Get userpubkey and unpack
+            eg = unserial_pubkey(retval['userpubkey'])
+
+            # Re-encrypt for user
+            newcryptgroupkey = encrypt_longmsg(eg, grouppacked)
         
         # Return a well-formed database-ready cryptgroupkey for user,
         # also, give the param is_admin.. as desired.
@@ -1167,6 +1711,60 @@ class SFLvaultClient(object):
         print "Success: %s" % retval['message']
         return retval
 
+    @authenticate()
+    def group_ciphers_get(self, group_id, kind, after_id=0, limit=100,
+                          version=None):
+        """Fetch a batch of a group's ciphers, see sflvault.client.migrate"""
+        return vaultReply(self.vault.group_ciphers_get(self.authtok, group_id,
+                                                       kind, after_id, limit,
+                                                       version),
+                          "Error loading the group's ciphers")
+
+    @authenticate()
+    def group_ciphers_put(self, group_id, kind, ciphers):
+        """Save a batch of re-encrypted ciphers"""
+        return vaultReply(self.vault.group_ciphers_put(self.authtok, group_id,
+                                                       kind, ciphers),
+                          "Error saving the group's ciphers")
+
+    @authenticate(True)
+    def migrate_ciphers(self, group_ids=None, version=2, batch_size=100,
+                        workers=None, checkpoint_file=None):
+        """Re-encrypt the service keys and group keys of the groups we're
+        admin of (or only those in group_ids) in the `version` format of
+        encrypt_longmsg().
+
+        With checkpoint_file, the progress is kept there and an interrupted
+        migration resumes where it stopped."""
+        retval = vaultReply(self.vault.group_list(self.authtok),
+                            "Error listing groups")
+        if group_ids is None:
+            groups = [grp for grp in retval['list'] if grp.get('admin')]
+        else:
+            group_ids = [int(x) for x in group_ids]
+            groups = [grp for grp in retval['list'] if grp['id'] in group_ids]
+            missing = set(group_ids) - set(grp['id'] for grp in groups)
+            if missing:
+                raise VaultError("No such groups: %s" % ', '.join(
+                    'g#%d' % x for x in sorted(missing)))
+
+        migration = CipherMigration(self, version, batch_size, workers,
+                                    Checkpoint(checkpoint_file))
+        try:
+            for grp in groups:
+                if not grp.get('cryptgroupkey'):
+                    raise VaultError("Not a member of group g#%d" % grp['id'])
+                grouppacked = self._decrypt_groupkey(grp['id'],
+                                                     grp['cryptgroupkey'])
+                migration.migrate_group(grp['id'], grouppacked)
+        finally:
+            migration.close()
+
+        print "Re-encrypted %d ciphers in %d groups (%.1f/s)" % \
+              (migration.count, len(groups), migration.rate())
+        return migration
+
+
     @authenticate()
     def group_list(self, quiet=False):
         """Simply list the available groups"""
@@ -1221,6 +1819,17 @@ class SFLvaultClient(object):
         return retval
 
 
+    @authenticate()
+    def metrics(self):
+        """Show the server's internal counters and timings (admin only)"""
+        retval = vaultReply(self.vault.metrics(self.authtok),
+                            "Error getting server metrics")
+        print "Server metrics:"
+        for name, value in sorted(retval['metrics'].items()):
+            print "%s\t%s" % (name, value)
+        return retval
+
+
     @authenticate()
     def customer_list(self, customer_id=None):
         """List customers in the vault and possibly corresponding to the needed id
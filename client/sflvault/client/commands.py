@@ -82,7 +82,15 @@ class SFLvaultShell(object):
         
         print "Welcome to SFLvault. Type 'help' for help."
         prompt = "SFLvault> "
-        
+
+        try:
+            self._loop(prompt)
+        finally:
+            # Don't leave the decrypted keys behind us.
+            self.vault.forget_privkey()
+
+    def _loop(self, prompt):
+        """Read and execute commands until the user quits"""
         while True:
             cmd = raw_input(prompt)
             if not cmd:
@@ -788,6 +796,45 @@ class SFLvaultCommand(object):
         self.vault.group_list(self.opts.quiet)
 
 
+    def migrate_crypto(self):
+        """Re-encrypt the keys of your groups in another format.
+
+        Go through the groups you're admin of, and re-encrypt the services'
+        keys and the group's key of each member in the format set by
+        --version.  Use --checkpoint to be able to resume an interrupted
+        migration."""
+        self.parser.set_usage("migrate-crypto [options]")
+        self.parser.add_option('-g', '--group', dest="groups",
+                               action="append", type="string",
+                               help="Migrate only these groups")
+        self.parser.add_option('--version', dest="version", type="int",
+                               default=2,
+                               help="Format to migrate to (1 or 2, default: 2)")
+        self.parser.add_option('-b', '--batch', dest="batch", type="int",
+                               default=100,
+                               help="Rows re-encrypted and saved at once")
+        self.parser.add_option('-w', '--workers', dest="workers", type="int",
+                               help="Processes re-encrypting (default: one "
+                                    "per CPU, 0 for none)")
+        self.parser.add_option('-c', '--checkpoint', dest="checkpoint",
+                               help="File keeping the progress, to resume "
+                                    "an interrupted migration")
+        self._parse()
+
+        if len(self.args):
+            raise SFLvaultParserError("Invalid number of arguments")
+        if self.opts.version not in (1, 2):
+            raise SFLvaultParserError("Invalid version: %s" % self.opts.version)
+
+        group_ids = None
+        if self.opts.groups:
+            group_ids = [self.vault.vaultId(x, 'g') for x in self.opts.groups]
+
+        self.vault.migrate_ciphers(group_ids, self.opts.version,
+                                   self.opts.batch, self.opts.workers,
+                                   self.opts.checkpoint)
+
+
     def machine_list(self):
         """List existing machines.
 
@@ -833,7 +880,12 @@ class SFLvaultCommand(object):
             vault_url: the URL (http://example.org:port/vault/rpc) to the vault.
         """
         
-        self.parser.set_usage("user-setup <username> <vault_url>")
+        self.parser.set_usage("user-setup [options] <username> <vault_url>")
+        self.parser.add_option('-k', '--key-type', dest="algorithm",
+                               default=None,
+                               help="Type of key to generate: 'elgamal' "
+                                    "(the default) or 'x25519', much faster "
+                                    "but only usable by recent clients")
         self._parse()
         
         if len(self.args) != 2:
@@ -842,7 +894,12 @@ class SFLvaultCommand(object):
         username = self.args[0]
         url      = self.args[1]
 
-        self.vault.user_setup(username, url)
+        if self.opts.algorithm and \
+           self.opts.algorithm not in KEY_ALGORITHMS:
+            raise SFLvaultParserError("Invalid key type: %s" %
+                                      self.opts.algorithm)
+
+        self.vault.user_setup(username, url, algorithm=self.opts.algorithm)
 
     def show(self):
         """Show informations to connect to a particular service.
@@ -930,6 +987,14 @@ class SFLvaultCommand(object):
                                action="append", type="string",
                                help="Filter results on these customers only")
 
+        self.parser.add_option('-l', '--limit', dest="limit", type="int",
+                               help="Show that many results at a time, "
+                                    "asking before loading the next ones")
+
+        self.parser.add_option('-o', '--offset', dest="offset", type="int",
+                               default=0,
+                               help="Skip that many results first")
+
         self._parse()
 
         if not len(self.args):
@@ -947,7 +1012,27 @@ class SFLvaultCommand(object):
                             for x in getattr(self.opts, f)]
             filters[f] = criteria
 
-        self.vault.search(self.args, filters or None, self.opts.verbose)
+        limit, offset = self.opts.limit, self.opts.offset
+        if not limit and not offset:
+            self.vault.search(self.args, filters or None, self.opts.verbose)
+            return
+
+        # Load the results one page at a time
+        while True:
+            retval = self.vault.search(self.args, filters or None,
+                                       self.opts.verbose, limit, offset)
+            if limit is None:
+                break
+            offset += limit
+            if offset >= retval.get('total', 0) or not sys.stdin.isatty():
+                break
+            try:
+                ans = raw_input("-- Press Enter for the next results, "
+                                "'q' to stop --")
+            except EOFError:
+                break
+            if ans.strip().lower() == 'q':
+                break
 
     def wallet(self):
         """Put your SFLvault password in a wallet"""
@@ -0,0 +1,196 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Re-encrypt a group's ciphers in another encrypt_longmsg() format.
+
+The vault never sees the group keys, so this runs on the client of a
+group admin.  For each group, it streams batches of:
+
+  * the services' symkeys encrypted for the group, decrypted with the
+    group's private key and encrypted again for the group,
+  * the group's key encrypted for each member, encrypted again for the
+    member's public key.
+
+The batches are re-encrypted on a pool of worker processes (the services'
+with decrypt_longmsg_many() and encrypt_longmsg_many()), and saved on
+the vault one by one.  The vault only saves the rows that didn't change
+since they were fetched, the others are fetched again with the next
+batch.  After each batch, the last row done is written to a
+checkpoint file, so an interrupted migration resumes where it stopped.
+"""
+
+import json
+import multiprocessing
+import os
+import time
+
+from Crypto import Random
+
+from sflvault.common.crypto import *
+
+# In the order they're migrated.  The group key is still needed to migrate
+# the services, so the members' copies come last.
+KINDS = ['services', 'users']
+
+
+def _reencrypt_user_job(job):
+    """Encrypt the group's key for a member in the `version` format.
+
+    job - a (member's serialized pubkey, serialized group privkey, version)
+          tuple.
+    """
+    pubkey, grouppacked, version = job
+    eg = unserial_pubkey(pubkey)
+    return encrypt_longmsg(eg, grouppacked, version)
+
+
+class Checkpoint(object):
+    """Last row migrated for each group and kind of ciphers, kept in a
+    JSON file.
+
+    filename - where to keep it, or None not to keep it at all.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.done = {}
+        if filename and os.path.exists(filename):
+            f = open(filename)
+            try:
+                self.done = json.load(f)
+            finally:
+                f.close()
+
+    def get(self, group_id, kind):
+        """Return the ID of the last row migrated, or 0"""
+        return self.done.get(str(group_id), {}).get(kind, 0)
+
+    def set(self, group_id, kind, last_id):
+        self.done.setdefault(str(group_id), {})[kind] = last_id
+        self.save()
+
+    def save(self):
+        if not self.filename:
+            return
+        # Never leave a half written checkpoint behind.
+        tmp = self.filename + '.tmp'
+        f = open(tmp, 'w')
+        try:
+            json.dump(self.done, f)
+        finally:
+            f.close()
+        os.rename(tmp, self.filename)
+
+
+class CipherMigration(object):
+    """Migrate the ciphers of groups we're admin of.
+
+    client - an SFLvaultClient, with its private key kept.
+    version - the encrypt_longmsg() format to migrate to.
+    batch_size - how many rows are fetched, re-encrypted and saved at once.
+    workers - number of processes re-encrypting, 0 to do it in this
+              process, None for one per CPU.
+    checkpoint - a Checkpoint
+    """
+    def __init__(self, client, version=2, batch_size=100, workers=None,
+                 checkpoint=None):
+        self.client = client
+        self.version = int(version)
+        self.batch_size = int(batch_size)
+        self.workers = workers
+        self.checkpoint = checkpoint or Checkpoint()
+        self.pool = None
+        self.count = 0
+        self.elapsed = 0.0
+
+    def _get_pool(self):
+        if self.workers == 0:
+            return None
+        if self.pool is None:
+            # The random pool must be reseeded in each worker.
+            self.pool = multiprocessing.Pool(self.workers,
+                                             initializer=Random.atfork)
+        return self.pool
+
+    def _map(self, func, jobs):
+        if self.workers == 0 or len(jobs) < 2:
+            return [func(job) for job in jobs]
+        return self._get_pool().map(func, jobs)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def migrate_group(self, group_id, grouppacked):
+        """Migrate the ciphers of one group, with its serialized privkey"""
+        groupkey = unserial_privkey(grouppacked)
+        for kind in KINDS:
+            after_id = self.checkpoint.get(group_id, kind)
+            while True:
+                start = time.time()
+                batch = self.client.group_ciphers_get(group_id, kind,
+                                                      after_id,
+                                                      self.batch_size,
+                                                      self.version)
+                rows = batch['ciphers']
+                if not rows:
+                    break
+
+                if kind == 'services':
+                    pool = self._get_pool()
+                    symkeys = list(decrypt_longmsg_many(groupkey,
+                        [row['cipher'] for row in rows], pool=pool))
+                    ciphers = list(encrypt_longmsg_many(groupkey, symkeys,
+                                                        self.version,
+                                                        pool=pool))
+                    del(symkeys)
+                else:
+                    # Members without a pubkey yet get the group key when
+                    # they complete their setup.
+                    rows = [row for row in rows if row['pubkey']]
+                    jobs = [(row['pubkey'], grouppacked, self.version)
+                            for row in rows]
+                    ciphers = self._map(_reencrypt_user_job, jobs)
+
+                saved = self.client.group_ciphers_put(group_id, kind,
+                    [{'id': row['id'], 'cipher': cipher,
+                      'old_cipher': row['cipher']}
+                     for row, cipher in zip(rows, ciphers)])
+
+                if saved['skipped']:
+                    # Changed since fetched: start the next batch with them
+                    # (the rows already migrated aren't fetched again).
+                    after_id = min(saved['skipped']) - 1
+                else:
+                    after_id = batch['ciphers'][-1]['id']
+                self.checkpoint.set(group_id, kind, after_id)
+
+                elapsed = time.time() - start
+                self.count += saved['count']
+                self.elapsed += elapsed
+                print "g#%s %s: %d re-encrypted (%.1f/s), %d left" % \
+                      (group_id, kind, saved['count'],
+                       saved['count'] / elapsed if elapsed else 0.0,
+                       batch['remaining'] + len(saved['skipped']))
+
+    def rate(self):
+        """Rows re-encrypted per second so far"""
+        return self.count / self.elapsed if self.elapsed else 0.0
@@ -23,6 +23,8 @@
 
 import urlparse
 import re
+import time
+import hashlib
 from pkg_resources import iter_entry_points, DistributionNotFound
 import platform
 if platform.system() != 'Windows':
@@ -33,7 +35,8 @@ __all__ = ['urlparse', 'AuthenticationError', 'PermissionError',
            'VaultIDSpecError', 'VaultConfigurationError', 'RemotingError',
            'ServiceRequireError', 'ServiceExpectError', 'sflvault_escape_chr',
            'ask_for_service_password', 'services_entry_points',
-           "ServiceSwitchException", "KeyringError"]
+           "ServiceSwitchException", "KeyringError", "GroupKeyCache",
+           "SessionError"]
 
 
 def services_entry_points():
@@ -77,6 +80,61 @@ def ask_for_service_password(edit=False, url=None):
     return sec
 
 
+### Decrypted group keys cache
+
+class GroupKeyCache(object):
+    """Keeps decrypted group keys in memory, for a limited time.
+
+    Decrypting a `cryptgroupkey` is the slowest thing the client does, so
+    we remember the result for each (group_id, cryptgroupkey) pair.  The
+    cryptgroupkey is only kept as a hash, so that a group being re-keyed
+    never hits a stale entry.
+
+    When more than `size` entries are cached, the least recently used
+    one is dropped.  Entries older than `ttl` seconds are never returned.
+    """
+    def __init__(self, size=32, ttl=600):
+        self.size = int(size)
+        self.ttl = int(ttl)
+        self._keys = {}
+
+    def _key(self, group_id, cryptgroupkey):
+        return (str(group_id), hashlib.sha1(cryptgroupkey).hexdigest())
+
+    def get(self, group_id, cryptgroupkey):
+        """Return the cached plain groupkey, or None"""
+        key = self._key(group_id, cryptgroupkey)
+        if key not in self._keys:
+            return None
+
+        value, created, used = self._keys[key]
+        now = time.time()
+        if created + self.ttl < now:
+            del(self._keys[key])
+            return None
+
+        self._keys[key] = (value, created, now)
+        return value
+
+    def set(self, group_id, cryptgroupkey, value):
+        """Remember the plain groupkey for that cryptgroupkey"""
+        if self.size <= 0:
+            return
+        now = time.time()
+        self._keys[self._key(group_id, cryptgroupkey)] = (value, now, now)
+
+        while len(self._keys) > self.size:
+            oldest = min(self._keys.items(), key=lambda x: x[1][2])[0]
+            del(self._keys[oldest])
+
+    def clear(self):
+        """Wipe every decrypted key from memory"""
+        self._keys.clear()
+
+    def __len__(self):
+        return len(self._keys)
+
+
 ### Passwords management exceptions
 
 class KeyringError(Exception):
@@ -89,6 +147,11 @@ class KeyringError(Exception):
 class AuthenticationError(Exception):
     pass
 
+class SessionError(AuthenticationError):
+    """Raised when the vault doesn't know, or doesn't accept anymore, the
+    session of our authtok"""
+    pass
+
 
 ### Server restrictions errors
 
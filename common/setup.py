@@ -39,6 +39,10 @@ setup(
     url='http://www.sflvault.org',
     license='GPLv3',
     install_requires=requires,
+    # Much faster ElGamal operations, and X25519 keys, see
+    # sflvault.common.crypto
+    extras_require={'gmpy2': ['gmpy2'],
+                    'x25519': ['cryptography']},
     packages=find_packages(),
     namespace_packages=['sflvault'],
     test_suite='nose.collector',
@@ -23,13 +23,30 @@
 
 from Crypto.PublicKey import ElGamal
 from Crypto.Cipher import AES, Blowfish
-from Crypto.Util.number import long_to_bytes, bytes_to_long
+from Crypto.Util.number import long_to_bytes, bytes_to_long, getRandomRange
 from Crypto import Random
 from base64 import b64decode, b64encode
+from binascii import hexlify, unhexlify
+import collections
+import hashlib
+import hmac
+import multiprocessing
 import random
 import os
+import threading
 from zlib import crc32 # Also available in binascii
 
+try:
+    import gmpy2
+except ImportError:
+    gmpy2 = None
+
+try:
+    from cryptography.hazmat.primitives.asymmetric import x25519
+    from cryptography.hazmat.primitives import serialization
+except ImportError:
+    x25519 = None
+
 #
 # Random number generators setup
 #
@@ -94,6 +111,8 @@ def generate_elgamal_keypair():
         eg.g, eg.p, eg.x, eg.y = keys[random.randint(0, 1)]
         return eg
     # Otherwise, generate, really :)
+    if bigint_backend() == 'gmpy2':
+        return _gmpy2_generate(1536, randfunc)
     return ElGamal.generate(1536, randfunc)
 
 def elgamal_pubkey(eg):
@@ -112,44 +131,53 @@ def elgamal_bothkeys(eg):
 #
 # Deal with ElGamal pubkey and messages serialization.
 #
+# Each number is in base64, joined with ':'.  This is what the pubkey,
+# cryptgroupkey and cryptsymkey Text columns hold, and what goes over
+# XML-RPC: a smaller binary format would need binary columns, a migration
+# of the stored values, and base64 only at the RPC boundary.  Only the
+# parsing is made faster here, the format is unchanged.
+
+def _long_to_bytes(n):
+    """Same as long_to_bytes(), without its Python loop"""
+    h = '%x' % n
+    return unhexlify('0' * (len(h) % 2) + h)
+
+def _bytes_to_long(s):
+    """Same as bytes_to_long(), without its Python loop"""
+    return long(hexlify(s) or '0', 16)
+
+def _serial_elgamal(parts):
+    return ':'.join([b64encode(part) for part in parts])
+
+def _unserial_elgamal(serial, count):
+    x = serial.split(':')
+    return tuple([b64decode(x[i]) for i in range(count)])
 
 
 # _msg are used to store Userciphers in the database (symkey
 # encrypted for each user)
 def serial_elgamal_msg(cryptsymkey):
     """Get a 2-elements tuple of str(), return a string."""
-    try:
-        ns = b64encode(cryptsymkey[0]) + ':' + \
-             b64encode(cryptsymkey[1])
-    except IndexError, e:
+    if len(cryptsymkey) < 2:
         raise DecryptError("Error decrypting: inconsistent message")
-    
-    return ns
+    return _serial_elgamal(cryptsymkey[:2])
 
 def unserial_elgamal_msg(cryptsymkey):
     """Get a string, return a 2-elements tuple of str()"""
-    x = cryptsymkey.split(':')
     try:
-        return (b64decode(x[0]),
-                b64decode(x[1]))
-    except IndexError, e:
+        return _unserial_elgamal(cryptsymkey, 2)
+    except (IndexError, TypeError), e:
         raise DecryptError("Error decrypting: inconsistent message")
 
 # _pubkey are used to encode the public key stored in the database
 # (El Gamal pub key, packed together)
 def serial_elgamal_pubkey(pubkey):
     """Get a 3-elements tuple of long(), return a string."""
-    ns = b64encode(long_to_bytes(pubkey[0])) + ':' + \
-         b64encode(long_to_bytes(pubkey[1])) + ':' + \
-         b64encode(long_to_bytes(pubkey[2]))         
-    return ns
+    return _serial_elgamal([_long_to_bytes(x) for x in pubkey[:3]])
 
 def unserial_elgamal_pubkey(pubkey):
     """Get a string, return a 3-elements tuple of long()"""
-    x = pubkey.split(':')
-    return (bytes_to_long(b64decode(x[0])),
-            bytes_to_long(b64decode(x[1])),
-            bytes_to_long(b64decode(x[2])))
+    return tuple([_bytes_to_long(x) for x in _unserial_elgamal(pubkey, 3)])
 
 
 # _privkey are used to encode the key in a storable manner
@@ -159,21 +187,13 @@ def serial_elgamal_privkey(privkey):
     """Get a 4-elements tuple of long(), return a string.
 
     This contains the private (two first elements) *and* the public key."""
-    ns = b64encode(long_to_bytes(privkey[0])) + ':' + \
-         b64encode(long_to_bytes(privkey[1])) + ':' + \
-         b64encode(long_to_bytes(privkey[2])) + ':' + \
-         b64encode(long_to_bytes(privkey[3]))
-    return ns
+    return _serial_elgamal([_long_to_bytes(x) for x in privkey[:4]])
 
 def unserial_elgamal_privkey(privkey):
     """Get a string, return a 4-elements tuple of long()
 
     This contains the private (two first elements) and the public key."""
-    x = privkey.split(':')
-    return (bytes_to_long(b64decode(x[0])),
-            bytes_to_long(b64decode(x[1])),
-            bytes_to_long(b64decode(x[2])),
-            bytes_to_long(b64decode(x[3])))
+    return tuple([_bytes_to_long(x) for x in _unserial_elgamal(privkey, 4)])
 
 
 #
@@ -240,16 +260,207 @@ def decrypt_secret(seckey, ciphertext):
     return chksum(secret)
 
 
+#
+# Big-integer arithmetic of the ElGamal operations
+#
+# BIGINT_BACKEND is one of:
+#
+#  'python': PyCrypto, with Python longs
+#  'gmpy2': gmpy2's GMP functions, much faster
+#  'auto': gmpy2 when it is installed (the default)
+#
+# Without gmpy2, 'gmpy2' also falls back to 'python'.  Both give the same
+# results, in the same formats.
+BIGINT_BACKEND = 'auto'
+
+def bigint_backend():
+    """Return the backend in use, 'gmpy2' or 'python'"""
+    if gmpy2 is not None and BIGINT_BACKEND in ('auto', 'gmpy2'):
+        return 'gmpy2'
+    return 'python'
+
+def _gmpy2_generate(bits, randfunc):
+    """Same as ElGamal.generate(bits, randfunc), with gmpy2"""
+    # Safe prime p = 2q + 1, as PyCrypto does
+    while True:
+        q = bytes_to_long(randfunc((bits - 1 + 7) / 8))
+        q = (q & ((1 << (bits - 1)) - 1)) | (1 << (bits - 2))
+        q = gmpy2.next_prime(q)
+        if gmpy2.bit_length(q) != bits - 1:
+            continue
+        p = 2 * q + 1
+        if gmpy2.is_prime(p, 50):
+            break
+
+    # Generator g, with the same checks as PyCrypto
+    while True:
+        g = gmpy2.mpz(getRandomRange(3, long(p), randfunc))
+        if gmpy2.powmod(g, 2, p) == 1 or gmpy2.powmod(g, q, p) == 1:
+            continue
+        if (p - 1) % g == 0 or (p - 1) % gmpy2.invert(g, p) == 0:
+            continue
+        break
+
+    eg = ElGamal.ElGamalobj()
+    eg.p = long(p)
+    eg.g = long(g)
+    eg.x = getRandomRange(2, eg.p - 1, randfunc)
+    eg.y = long(gmpy2.powmod(g, eg.x, p))
+    return eg
+
+
+#
+# ElGamal encryption to the keys we encrypt to often
+#
+# Encrypting computes g^K and y^K mod p, with the same g, y and p each time
+# for a given key.  Once a key has been encrypted to FIXEDBASE_MIN_USES
+# times, tables of the powers of g and y are kept, and these
+# exponentiations only multiply a few entries of them together.  The
+# ciphertexts are the same as with eg.encrypt().
+#
+# The tables take about 1.3MB for a 1536-bit key.  FIXEDBASE_CACHE_SIZE
+# keys are remembered, 0 disables it.
+FIXEDBASE_CACHE_SIZE = 0
+FIXEDBASE_MIN_USES = 8
+
+# Bits of the exponents read at once, and the largest exponent covered by
+# the tables: we use randfunc(32) for K.
+_FIXEDBASE_WINDOW = 6
+_FIXEDBASE_BITS = 256
+
+_fixedbase_keys = collections.OrderedDict()
+_fixedbase_lock = threading.Lock()
+
+
+class _FixedBase(object):
+    """Powers of `base` modulo p, to compute base^e mod p quickly"""
+    def __init__(self, base, p):
+        self.base = base
+        self.p = p
+        size = 1 << _FIXEDBASE_WINDOW
+        self.table = []
+        # Row i holds base^(j * 2^(i * window)) for each j
+        for i in range((_FIXEDBASE_BITS + _FIXEDBASE_WINDOW - 1) /
+                       _FIXEDBASE_WINDOW):
+            row = [1]
+            for j in range(1, size):
+                row.append(row[-1] * base % p)
+            self.table.append(row)
+            base = row[-1] * base % p
+
+    def pow(self, e):
+        if e >> _FIXEDBASE_BITS:
+            return pow(self.base, e, self.p)
+        mask = (1 << _FIXEDBASE_WINDOW) - 1
+        result = 1
+        for row in self.table:
+            if not e:
+                break
+            if e & mask:
+                result = result * row[e & mask] % self.p
+            e >>= _FIXEDBASE_WINDOW
+        return result
+
+
+def _fixedbase_tables(eg):
+    """Return the (g, y) _FixedBase tables of eg, or None while it isn't
+    used often enough"""
+    if FIXEDBASE_CACHE_SIZE <= 0:
+        return None
+    key = (eg.p, eg.g, eg.y)
+    _fixedbase_lock.acquire()
+    try:
+        entry = _fixedbase_keys.pop(key, [0, None])
+        entry[0] += 1
+        _fixedbase_keys[key] = entry
+        while len(_fixedbase_keys) > FIXEDBASE_CACHE_SIZE:
+            _fixedbase_keys.popitem(last=False)
+        if entry[1] is not None or entry[0] < FIXEDBASE_MIN_USES:
+            return entry[1]
+    finally:
+        _fixedbase_lock.release()
+
+    # Built once, by the call that makes the key hot
+    entry[1] = (_FixedBase(eg.g, eg.p), _FixedBase(eg.y, eg.p))
+    return entry[1]
+
+def elgamal_encrypt(eg, plaintext, K):
+    """Same as eg.encrypt(plaintext, K), faster with gmpy2 or for the keys
+    we encrypt to often, see BIGINT_BACKEND and FIXEDBASE_CACHE_SIZE."""
+    gmpy = bigint_backend() == 'gmpy2'
+    tables = None
+    if not gmpy:
+        tables = _fixedbase_tables(eg)
+        if tables is None:
+            return eg.encrypt(plaintext, K)
+
+    was_string = isinstance(plaintext, str)
+    if was_string:
+        plaintext = _bytes_to_long(plaintext)
+    if isinstance(K, str):
+        K = _bytes_to_long(K)
+    if gmpy:
+        a = long(gmpy2.powmod(eg.g, K, eg.p))
+        b = long(plaintext * gmpy2.powmod(eg.y, K, eg.p) % eg.p)
+    else:
+        a = tables[0].pow(K)
+        b = plaintext * tables[1].pow(K) % eg.p
+    if was_string:
+        return (_long_to_bytes(a), _long_to_bytes(b))
+    return (a, b)
+
+def elgamal_decrypt(eg, ciphertext):
+    """Same as eg.decrypt(ciphertext), faster with gmpy2"""
+    if bigint_backend() != 'gmpy2':
+        return eg.decrypt(ciphertext)
+
+    if not hasattr(eg, 'x'):
+        raise TypeError('Private key not available in this object')
+    if not isinstance(ciphertext, tuple):
+        ciphertext = (ciphertext,)
+    was_string = isinstance(ciphertext[0], str)
+    if was_string:
+        ciphertext = tuple([_bytes_to_long(x) for x in ciphertext])
+    ax = gmpy2.powmod(ciphertext[0], eg.x, eg.p)
+    plaintext = long(ciphertext[1] * gmpy2.invert(ax, eg.p) % eg.p)
+    if was_string:
+        return _long_to_bytes(plaintext)
+    return plaintext
+
+
 #
 # Encrypt / decrypt group's privkeys
 #
-def encrypt_longmsg(eg, message):
-    """This takes a long message, and encrypts it as multiple ElGamal-encrypted
-    chunks.
+
+# Format written by encrypt_longmsg(), decrypt_longmsg() reads both:
+#
+#  1: the message is split in chunks, each one ElGamal-encrypted:
+#     b64(a):b64(b)&b64(a):b64(b)&...
+#  2: one ElGamal-encrypted random key, the message AES-encrypted with it:
+#     v2$b64(a):b64(b)$b64(iv + AES-256-CBC ciphertext + HMAC-SHA256)
+#
+# Clients older than version 2 can only read version 1.
+LONGMSG_VERSION = 1
+LONGMSG_V2_PREFIX = 'v2$'
+
+def encrypt_longmsg(eg, message, version=None):
+    """This takes a long message, and encrypts it for the ElGamal key.
 
     You probably will want to have a serialized message as `message`.
 
-    This will return a b64 version of the encrypted message."""
+    version - format to use, LONGMSG_VERSION by default.
+
+    This will return a b64 version of the encrypted message.
+
+    For an X25519Key, the message is always encrypted with ECIES, whatever
+    the version."""
+    if isinstance(eg, X25519Key):
+        return _encrypt_ecies(eg, message)
+    if version is None:
+        version = LONGMSG_VERSION
+    if version == 2:
+        return _encrypt_longmsg_v2(eg, message)
+
     # Tested and works to up to 192, but we'll use 96 for safety.
     CHUNK_MAX_SIZE = 96
 
@@ -268,7 +479,8 @@ def encrypt_longmsg(eg, message):
 
     out = []
     for chunk in chunks:
-        b64chunk = serial_elgamal_msg(eg.encrypt(chunk, randfunc(32)))
+        b64chunk = serial_elgamal_msg(elgamal_encrypt(eg, chunk,
+                                                      randfunc(32)))
         out.append(b64chunk)
 
     return '&'.join(out)
@@ -279,17 +491,396 @@ def decrypt_longmsg(eg, ciphermessage):
     the provided ElGamal key (private key must be in).
 
     This returns the original str()."""
+    if ciphermessage.startswith(ECIES_PREFIX):
+        return _decrypt_ecies(eg, ciphermessage)
+    if isinstance(eg, X25519Key):
+        raise DecryptError("Error decrypting: not encrypted for an X25519 key")
+    if ciphermessage.startswith(LONGMSG_V2_PREFIX):
+        return _decrypt_longmsg_v2(eg, ciphermessage)
 
     chunks = ciphermessage.split('&')
     out = []
     for chunk in chunks:
-        snip = eg.decrypt(unserial_elgamal_msg(chunk))
+        snip = elgamal_decrypt(eg, unserial_elgamal_msg(chunk))
         out.append(snip)
 
     message = chksum(''.join(out))
 
     return message
-        
+
+
+def _aes_seal(keys, message, authdata):
+    """Encrypt message with AES-256-CBC with keys[:32], and authenticate it
+    along with authdata with HMAC-SHA256 with keys[32:].
+
+    Return the IV, ciphertext and MAC, in that order."""
+    iv = randfunc(16)
+    padlen = 16 - (len(message) % 16)
+    a = AES.new(keys[:32], AES.MODE_CBC, iv)
+    ciphertext = iv + a.encrypt(message + chr(padlen) * padlen)
+    del(a)
+    mac = hmac.new(keys[32:], authdata + ciphertext, hashlib.sha256).digest()
+    return ciphertext + mac
+
+def _constant_time_compare(a, b):
+    """hmac.compare_digest(), which Python has since 2.7.7"""
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+_compare_digest = getattr(hmac, 'compare_digest', _constant_time_compare)
+
+def _aes_open(keys, payload, authdata):
+    """Check and decrypt the output of _aes_seal()"""
+    ciphertext, mac = payload[:-32], payload[-32:]
+    if len(ciphertext) < 32 or len(ciphertext) % 16 or \
+       not _compare_digest(hmac.new(keys[32:], authdata + ciphertext,
+                                    hashlib.sha256).digest(), mac):
+        raise DecryptError("Error decrypting: inconsistent cipher")
+
+    a = AES.new(keys[:32], AES.MODE_CBC, ciphertext[:16])
+    message = a.decrypt(ciphertext[16:])
+    del(a)
+    return message[:-ord(message[-1])]
+
+def _encrypt_longmsg_v2(eg, message):
+    """Encrypt message with AES, and the AES key with ElGamal"""
+    keys = randfunc(64)
+    # The leading byte keeps leading zeros of the keys through ElGamal
+    wrapped = serial_elgamal_msg(elgamal_encrypt(eg, '\x02' + keys,
+                                                randfunc(32)))
+    payload = _aes_seal(keys, message, wrapped)
+    del(keys)
+
+    return LONGMSG_V2_PREFIX + wrapped + '$' + b64encode(payload)
+
+def _decrypt_longmsg_v2(eg, ciphermessage):
+    """Decrypt a message from _encrypt_longmsg_v2()"""
+    try:
+        wrapped, payload = str(ciphermessage[len(LONGMSG_V2_PREFIX):]) \
+                               .split('$')
+        payload = b64decode(payload)
+    except (ValueError, TypeError, UnicodeError), e:
+        raise DecryptError("Error decrypting: inconsistent message")
+
+    keys = elgamal_decrypt(eg, unserial_elgamal_msg(wrapped))
+    if len(keys) != 65 or keys[0] != '\x02':
+        raise DecryptError("Error decrypting: wrong key")
+    message = _aes_open(keys[1:], payload, wrapped)
+    del(keys)
+    return message
+
+
+#
+# Many messages for the same key
+#
+# encrypt_longmsg_many() and decrypt_longmsg_many() take the key object
+# once for all the messages.  Given worker processes, the messages are
+# sent to them in chunks, with the key once per chunk, and the results
+# are all collected before the workers are stopped: an iterator over them
+# is returned.  Otherwise the messages are handled as they are iterated.
+LONGMSG_MANY_CHUNK = 16
+
+def _longmsg_many_job(job):
+    """Encrypt or decrypt a chunk of messages in a worker process.
+
+    job - an (encrypt, key, version, messages) tuple.
+    """
+    encrypt, eg, version, messages = job
+    if encrypt:
+        return [encrypt_longmsg(eg, message, version) for message in messages]
+    return [decrypt_longmsg(eg, message) for message in messages]
+
+def _longmsg_many_serial(encrypt, eg, messages, version):
+    for message in messages:
+        if encrypt:
+            yield encrypt_longmsg(eg, message, version)
+        else:
+            yield decrypt_longmsg(eg, message)
+
+def _longmsg_many_failed(results, error):
+    """Yield the results of the chunks before the one that failed, then
+    raise its error"""
+    for result in results:
+        yield result
+    raise error
+
+def _longmsg_many(encrypt, eg, messages, version, workers, pool, chunk_size):
+    messages = list(messages)
+    chunk_size = max(1, int(chunk_size))
+    if (not workers and pool is None) or len(messages) <= chunk_size:
+        return _longmsg_many_serial(encrypt, eg, messages, version)
+
+    jobs = [(encrypt, eg, version, messages[i:i + chunk_size])
+            for i in range(0, len(messages), chunk_size)]
+    own_pool = pool is None
+    if own_pool:
+        # The random pool must be reseeded in each worker.
+        pool = multiprocessing.Pool(min(int(workers), len(jobs)),
+                                    initializer=Random.atfork)
+    results = []
+    try:
+        try:
+            for chunk in pool.imap(_longmsg_many_job, jobs):
+                results.extend(chunk)
+        except DecryptError, e:
+            return _longmsg_many_failed(results, e)
+    finally:
+        if own_pool:
+            pool.terminate()
+    return iter(results)
+
+def encrypt_longmsg_many(eg, messages, version=None, workers=0, pool=None,
+                         chunk_size=LONGMSG_MANY_CHUNK):
+    """Encrypt each of the messages for the same key, like
+    encrypt_longmsg(), and return an iterator over the ciphertexts, in the
+    same order.
+
+    workers - number of processes to spread the chunks of chunk_size
+              messages on, 0 to encrypt them all in this process.
+    pool - a multiprocessing.Pool to use instead of starting one.
+    """
+    if version is None:
+        version = LONGMSG_VERSION
+    return _longmsg_many(True, eg, messages, version, workers, pool,
+                         chunk_size)
+
+def decrypt_longmsg_many(eg, ciphermessages, workers=0, pool=None,
+                         chunk_size=LONGMSG_MANY_CHUNK):
+    """Decrypt each of the ciphermessages with the same key, like
+    decrypt_longmsg(), and return an iterator over the messages, in the
+    same order.
+
+    A DecryptError is raised when reaching a message that can't be
+    decrypted.  See encrypt_longmsg_many() for the other arguments.
+    """
+    return _longmsg_many(False, eg, ciphermessages, None, workers, pool,
+                         chunk_size)
+
+
+#
+# Service symkeys wrapped with a group's symmetric key
+#
+# Instead of being encrypted with encrypt_longmsg() for the group's pubkey,
+# a service's symkey can be wrapped with the group's wrapping key, derived
+# from the group's private key: every member already gets it in its
+# cryptgroupkey.  Once the group key is decrypted, unwrapping the symkeys
+# of its services takes no ElGamal operation.  Format:
+#
+#     w1$b64(iv + AES-256-CBC ciphertext + HMAC-SHA256)
+#
+# Clients that don't know the format can't read these symkeys.
+GROUP_WRAP_PREFIX = 'w1$'
+
+def group_wrapkey(grouppacked):
+    """Return the wrapping key of a group, from its serialized privkey"""
+    key = unserial_privkey(grouppacked)
+    if isinstance(key, X25519Key):
+        secret = key.private
+    else:
+        secret = _long_to_bytes(key.x)
+    return hmac.new(secret, 'SFLvault group wrapping key',
+                    hashlib.sha512).digest()
+
+def wrap_symkey(wrapkey, symkey):
+    """Wrap a service's symkey with a group's wrapping key"""
+    if len(wrapkey) != 64:
+        raise ValueError("Invalid wrapping key")
+    return GROUP_WRAP_PREFIX + b64encode(_aes_seal(wrapkey, symkey,
+                                                   GROUP_WRAP_PREFIX))
+
+def unwrap_symkey(wrapkey, cryptsymkey):
+    """Return the symkey wrapped by wrap_symkey()"""
+    if not cryptsymkey.startswith(GROUP_WRAP_PREFIX):
+        raise DecryptError("Error decrypting: not a wrapped symkey")
+    try:
+        payload = b64decode(cryptsymkey[len(GROUP_WRAP_PREFIX):])
+    except (TypeError, UnicodeError), e:
+        raise DecryptError("Error decrypting: inconsistent message")
+    return _aes_open(wrapkey, payload, GROUP_WRAP_PREFIX)
+
+def check_cryptsymkey(cryptsymkey, algorithm='elgamal'):
+    """Raise ValueError unless cryptsymkey looks like a symkey wrapped with
+    wrap_symkey(), or encrypted with encrypt_longmsg() for a key of that
+    algorithm.
+
+    Nothing is decrypted: this only checks the format, so that the vault
+    doesn't store junk sent by a client."""
+    sizes = []
+    try:
+        cryptsymkey = str(cryptsymkey)
+        if cryptsymkey.startswith(GROUP_WRAP_PREFIX):
+            payload = b64decode(cryptsymkey[len(GROUP_WRAP_PREFIX):])
+            sizes.append(len(payload) - 32)
+        elif algorithm == 'x25519':
+            if not cryptsymkey.startswith(ECIES_PREFIX):
+                raise ValueError()
+            raw = b64decode(cryptsymkey[len(ECIES_PREFIX):])
+            # The ephemeral key and the MAC around the ciphertext
+            sizes.append(len(raw) - 64)
+        elif cryptsymkey.startswith(LONGMSG_V2_PREFIX):
+            wrapped, payload = cryptsymkey[len(LONGMSG_V2_PREFIX):] \
+                                   .split('$')
+            unserial_elgamal_msg(wrapped)
+            sizes.append(len(b64decode(payload)) - 32)
+        else:
+            for chunk in cryptsymkey.split('&'):
+                unserial_elgamal_msg(chunk)
+    except (ValueError, TypeError, UnicodeError, DecryptError), e:
+        raise ValueError("Invalid cryptsymkey")
+    # An IV and at least one block
+    for size in sizes:
+        if size < 32 or size % 16:
+            raise ValueError("Invalid cryptsymkey")
+
+
+#
+# Key types
+#
+# Users and groups have ElGamal keys, serialized with serial_elgamal_*(),
+# or X25519 keys, serialized as X25519_PREFIX + b64(public key) for the
+# pubkey, and X25519_PREFIX + b64(private key + public key) for the
+# privkey.  The serial_*() and unserial_*() functions below handle both,
+# and encrypt_longmsg() and decrypt_longmsg() take either kind of key.
+#
+# Messages for an X25519 key are encrypted with ECIES: an ephemeral
+# X25519 key agreement, HMAC-SHA512 of the shared secret for the AES and
+# HMAC keys, then _aes_seal():
+#
+#     e1$b64(ephemeral pubkey + iv + AES-256-CBC ciphertext + HMAC-SHA256)
+#
+# X25519 needs the 'cryptography' package.  Clients without it, or older
+# than this format, can't use X25519 keys.
+KEY_ALGORITHMS = ['elgamal', 'x25519']
+X25519_PREFIX = 'x25519$'
+ECIES_PREFIX = 'e1$'
+
+class X25519Key(object):
+    """An X25519 keypair, or only its public half, used where ElGamal
+    objects are.
+
+    public, private - the raw 32 bytes keys.
+    """
+    def __init__(self, public, private=None):
+        if len(public) != 32 or (private is not None and len(private) != 32):
+            raise ValueError("Invalid X25519 key")
+        self.public = public
+        self.private = private
+
+    def has_private(self):
+        return self.private is not None
+
+def _x25519_required():
+    if x25519 is None:
+        raise ValueError("X25519 keys need the 'cryptography' package")
+
+def _x25519_raw(key):
+    """Return the raw bytes of a `cryptography` X25519 key"""
+    if hasattr(key, 'private_bytes'):
+        return key.private_bytes(serialization.Encoding.Raw,
+                                 serialization.PrivateFormat.Raw,
+                                 serialization.NoEncryption())
+    return key.public_bytes(serialization.Encoding.Raw,
+                            serialization.PublicFormat.Raw)
+
+def _generate_x25519():
+    _x25519_required()
+    priv = x25519.X25519PrivateKey.generate()
+    return X25519Key(_x25519_raw(priv.public_key()), _x25519_raw(priv))
+
+def generate_keypair(algorithm='elgamal'):
+    """Return a newly generated keypair of that algorithm, an ElGamal
+    object or an X25519Key"""
+    if algorithm == 'x25519':
+        return _generate_x25519()
+    if algorithm != 'elgamal':
+        raise ValueError("Unknown key algorithm: %s" % algorithm)
+    return generate_elgamal_keypair()
+
+def key_algorithm(serialized):
+    """Return the algorithm of a serialized pubkey or privkey"""
+    if serialized.startswith(X25519_PREFIX):
+        return 'x25519'
+    return 'elgamal'
+
+def serial_pubkey(key):
+    """Serialize the public half of an ElGamal object or an X25519Key"""
+    if isinstance(key, X25519Key):
+        return X25519_PREFIX + b64encode(key.public)
+    return serial_elgamal_pubkey(elgamal_pubkey(key))
+
+def serial_privkey(key):
+    """Serialize both halves of an ElGamal object or an X25519Key"""
+    if isinstance(key, X25519Key):
+        return X25519_PREFIX + b64encode(key.private + key.public)
+    return serial_elgamal_privkey(elgamal_bothkeys(key))
+
+def _unserial_x25519(serialized, length):
+    try:
+        raw = b64decode(str(serialized[len(X25519_PREFIX):]))
+    except (TypeError, UnicodeError), e:
+        raise ValueError("Invalid X25519 key")
+    if len(raw) != length:
+        raise ValueError("Invalid X25519 key")
+    return raw
+
+def unserial_pubkey(pubkey):
+    """Return an ElGamal object or an X25519Key from a serialized pubkey"""
+    if key_algorithm(pubkey) == 'x25519':
+        return X25519Key(_unserial_x25519(pubkey, 32))
+    eg = ElGamal.ElGamalobj()
+    (eg.p, eg.g, eg.y) = unserial_elgamal_pubkey(pubkey)
+    return eg
+
+def unserial_privkey(privkey):
+    """Return an ElGamal object or an X25519Key from a serialized
+    privkey"""
+    if key_algorithm(privkey) == 'x25519':
+        raw = _unserial_x25519(privkey, 64)
+        return X25519Key(raw[32:], raw[:32])
+    eg = ElGamal.ElGamalobj()
+    (eg.p, eg.x, eg.g, eg.y) = unserial_elgamal_privkey(privkey)
+    return eg
+
+def _ecies_keys(shared, ephemeral, public):
+    return hmac.new(shared, 'SFLvault ECIES' + ephemeral + public,
+                    hashlib.sha512).digest()
+
+def _encrypt_ecies(key, message):
+    """Encrypt message for an X25519Key"""
+    _x25519_required()
+    eph = x25519.X25519PrivateKey.generate()
+    ephemeral = _x25519_raw(eph.public_key())
+    shared = eph.exchange(x25519.X25519PublicKey.from_public_bytes(
+        key.public))
+    payload = _aes_seal(_ecies_keys(shared, ephemeral, key.public),
+                        message, ephemeral)
+    return ECIES_PREFIX + b64encode(ephemeral + payload)
+
+def _decrypt_ecies(key, ciphermessage):
+    """Decrypt a message from _encrypt_ecies()"""
+    if not isinstance(key, X25519Key) or not key.has_private():
+        raise DecryptError("Error decrypting: not an X25519 private key")
+    if x25519 is None:
+        raise DecryptError("Error decrypting: X25519 keys need the "
+                           "'cryptography' package")
+    try:
+        raw = b64decode(str(ciphermessage[len(ECIES_PREFIX):]))
+    except (TypeError, UnicodeError), e:
+        raise DecryptError("Error decrypting: inconsistent message")
+    ephemeral, payload = raw[:32], raw[32:]
+    try:
+        priv = x25519.X25519PrivateKey.from_private_bytes(key.private)
+        shared = priv.exchange(x25519.X25519PublicKey.from_public_bytes(
+            ephemeral))
+    except ValueError, e:
+        raise DecryptError("Error decrypting: inconsistent message")
+    return _aes_open(_ecies_keys(shared, ephemeral, key.public), payload,
+                     ephemeral)
+
 
 # Include the '_' function in the public names
 __all__ = [__name for __name in locals().keys() if not __name.startswith('_')]
@@ -0,0 +1,135 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""JSON-RPC 2.0 marshalling, for both client and server.
+
+The vault serves the same methods over JSON-RPC, at JSONRPC_PATH, as over
+XML-RPC, and tells it in the JSONRPC_HEADER of its responses.  Parsing and
+writing JSON is much cheaper than XML for the large `search` results.
+
+To get the same values as with xmlrpclib, the ASCII strings are turned
+back to `str`, dates go through as xmlrpclib.DateTime and binaries as
+xmlrpclib.Binary, using JSON-RPC 1.0's class hinting, and errors come out
+as xmlrpclib.Fault.
+"""
+
+__all__ = ['JSONRPC_PATH', 'JSONRPC_HEADER', 'dumps_request', 'loads_request',
+           'dumps_response', 'dumps_fault', 'loads_response']
+
+import datetime
+import json
+import xmlrpclib
+
+JSONRPC_PATH = '/vault/jsonrpc'
+JSONRPC_HEADER = 'X-SFLvault-JSONRPC'
+
+# From the JSON-RPC 2.0 specification.  Errors raised by the methods keep
+# their xmlrpclib.Fault code, 1 for exceptions.
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+
+
+def _default(obj):
+    if isinstance(obj, datetime.datetime):
+        obj = xmlrpclib.DateTime(obj)
+    if isinstance(obj, xmlrpclib.DateTime):
+        return {'__jsonclass__': ['datetime', [obj.value]]}
+    if isinstance(obj, xmlrpclib.Binary):
+        return {'__jsonclass__': ['binary', [obj.data.encode('base64')]]}
+    raise TypeError("%r is not JSON serializable" % obj)
+
+
+def _str(value):
+    """Return the ASCII strings as `str`, as xmlrpclib does"""
+    value_type = type(value)
+    if value_type is unicode:
+        try:
+            return value.encode('ascii')
+        except UnicodeError:
+            return value
+    if value_type is list:
+        return [_str(x) for x in value]
+    return value
+
+
+def _object_hook(obj):
+    hint = obj.get('__jsonclass__')
+    if hint and len(obj) == 1:
+        if hint[0] == 'datetime':
+            return xmlrpclib.DateTime(str(hint[1][0]))
+        if hint[0] == 'binary':
+            return xmlrpclib.Binary(str(hint[1][0]).decode('base64'))
+    out = {}
+    for key, value in obj.iteritems():
+        out[_str(key)] = _str(value)
+    return out
+
+
+def _loads(data):
+    return _str(json.loads(data, object_hook=_object_hook))
+
+
+def _dumps(obj):
+    return json.dumps(obj, default=_default, separators=(',', ':'))
+
+
+def dumps_request(method, params, id=1):
+    """Return the JSON-RPC call of `method` with the `params` tuple"""
+    return _dumps({'jsonrpc': '2.0', 'method': method,
+                   'params': list(params), 'id': id})
+
+
+def loads_request(data):
+    """Return (method, params, id) of a JSON-RPC call.
+
+    Raises xmlrpclib.Fault if it isn't one."""
+    try:
+        request = _loads(data)
+    except ValueError, e:
+        raise xmlrpclib.Fault(PARSE_ERROR, "Parse error: %s" % e)
+    if not isinstance(request, dict) or \
+       not isinstance(request.get('method'), basestring) or \
+       not isinstance(request.get('params', []), list):
+        raise xmlrpclib.Fault(INVALID_REQUEST, "Invalid request")
+    return (request['method'], tuple(request.get('params', [])),
+            request.get('id'))
+
+
+def dumps_response(result, id):
+    return _dumps({'jsonrpc': '2.0', 'result': result, 'id': id})
+
+
+def dumps_fault(fault, id=None):
+    """Return the JSON-RPC error response for the xmlrpclib.Fault"""
+    return _dumps({'jsonrpc': '2.0', 'id': id,
+                   'error': {'code': fault.faultCode,
+                             'message': fault.faultString}})
+
+
+def loads_response(data):
+    """Return the result of a JSON-RPC response.
+
+    Raises xmlrpclib.Fault for errors, as xmlrpclib.loads() does."""
+    response = _loads(data)
+    if response.get('error'):
+        raise xmlrpclib.Fault(response['error'].get('code', 1),
+                              response['error'].get('message', ''))
+    return response.get('result')
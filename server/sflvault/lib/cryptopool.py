@@ -0,0 +1,108 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Process pool for the ElGamal encryptions fanned out to many recipients.
+
+Encrypting a group key for each global admin, or a service's symkey for
+each of its groups, is CPU bound pure Python work: running it in worker
+processes uses all the CPUs, and doesn't hold the GIL of a threaded
+server.
+
+The number of workers is set with `sflvault.vault.crypto_workers`.  With
+0 (the default), or if the pool can't be used, everything is encrypted
+serially in the calling process.
+"""
+
+import logging
+import multiprocessing
+import threading
+
+from Crypto import Random
+
+from sflvault.common.crypto import encrypt_longmsg
+from sflvault.lib import pubkeys
+
+log = logging.getLogger(__name__)
+
+
+def _encrypt_longmsg_job(job):
+    """Encrypt message for a serialized ElGamal pubkey.
+
+    job - a (pubkey, message) tuple, both str(), to be picklable.
+    """
+    pubkey, message = job
+    return encrypt_longmsg(pubkeys.cache.get(pubkey), message)
+
+
+class CryptoPool(object):
+    """Run encryptions on a pool of worker processes.
+
+    workers - number of processes, 0 to encrypt serially.
+    min_jobs - below that many encryptions, don't bother with the pool.
+
+    The processes are only started when first needed, so that a forking
+    server starts its own pools after the fork.
+    """
+    def __init__(self, workers=0, min_jobs=2):
+        self.workers = int(workers)
+        self.min_jobs = int(min_jobs)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        self._lock.acquire()
+        try:
+            if self._pool is None:
+                # The random pool must be reseeded in each worker.
+                self._pool = multiprocessing.Pool(self.workers,
+                                                  initializer=Random.atfork)
+            return self._pool
+        finally:
+            self._lock.release()
+
+    def encrypt_longmsg_many(self, jobs):
+        """Encrypt each message for its pubkey, and return the ciphertexts in
+        the same order.
+
+        jobs - list of (serialized pubkey, message) tuples.
+        """
+        jobs = list(jobs)
+        if self.workers > 0 and len(jobs) >= self.min_jobs:
+            try:
+                return self._get_pool().map(_encrypt_longmsg_job, jobs)
+            except Exception, e:
+                log.warning("Crypto pool failed, encrypting serially: %s" % e)
+                self.close()
+        return [_encrypt_longmsg_job(job) for job in jobs]
+
+    def close(self):
+        """Stop the worker processes, they'll be restarted when needed"""
+        self._lock.acquire()
+        try:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
+        finally:
+            self._lock.release()
+
+
+# Replaced by the configured pool, see SFLvaultServer.initialize_crypto()
+pool = CryptoPool()
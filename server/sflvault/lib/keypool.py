@@ -0,0 +1,167 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Pool of ElGamal keypairs generated ahead of time.
+
+Generating a 1536-bit keypair takes seconds, sometimes minutes.  Instead of
+doing it in group_add, while the request waits, a worker process keeps
+`sflvault.vault.keypool_size` fresh keypairs ready.  Each keypair is handed
+out only once.
+
+With a size of 0 (the default), or when the pool is empty, the keypair is
+generated in the request, as before.  X25519 keypairs, with
+`sflvault.vault.group_key_algorithm = x25519`, take microseconds and are
+never pooled.
+
+The `keypool.*` metrics tell the pool's depth, its hits and misses, and
+how long generations take.
+"""
+
+import collections
+import logging
+import multiprocessing
+import threading
+import time
+
+from Crypto import Random
+from Crypto.PublicKey import ElGamal
+
+from sflvault.common.crypto import generate_elgamal_keypair, \
+     elgamal_bothkeys, generate_keypair
+from sflvault.lib import metrics
+
+log = logging.getLogger(__name__)
+
+
+def _generate_keypair_job():
+    """Generate a keypair, return its (p, x, g, y) and how long it took, or
+    None on errors"""
+    try:
+        start = time.time()
+        eg = generate_elgamal_keypair()
+        return elgamal_bothkeys(eg), time.time() - start
+    except Exception, e:
+        log.error("Keypair generation failed: %s" % e)
+        return None
+
+
+class KeyPool(object):
+    """Keep `size` keypairs ready, generated by a worker process.
+
+    The worker is started by start(), or on the first get_keypair(), so
+    that a forking server starts its own pools after the fork.
+
+    algorithm - the type of keypairs handed out, one of KEY_ALGORITHMS.
+    """
+    def __init__(self, size=0, algorithm='elgamal'):
+        self.size = int(size)
+        self.algorithm = algorithm
+        if algorithm != 'elgamal':
+            self.size = 0
+        self._keys = collections.deque()
+        self._pending = 0
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start filling the pool"""
+        if self.size <= 0:
+            return
+        self._lock.acquire()
+        try:
+            if self._pool is None:
+                # The random pool must be reseeded in the worker.
+                self._pool = multiprocessing.Pool(1,
+                                                  initializer=Random.atfork)
+            self._refill()
+        finally:
+            self._lock.release()
+
+    def _refill(self):
+        """Ask for as many keypairs as missing.  Call with the lock held."""
+        while len(self._keys) + self._pending < self.size:
+            self._pending += 1
+            self._pool.apply_async(_generate_keypair_job,
+                                   callback=self._add)
+
+    def _add(self, result):
+        """Receive a keypair from the worker"""
+        self._lock.acquire()
+        try:
+            self._pending -= 1
+            if result is None:
+                # Retried on the next get_keypair()
+                metrics.incr('keypool.errors')
+                return
+            keys, elapsed = result
+            self._keys.append(keys)
+            metrics.set_value('keypool.depth', len(self._keys))
+        finally:
+            self._lock.release()
+        metrics.timing('keypool.generate', elapsed)
+
+    def get_keypair(self):
+        """Return an ElGamal object with a newly generated keypair, taken
+        from the pool when there's one ready, or an X25519Key"""
+        if self.algorithm != 'elgamal':
+            return generate_keypair(self.algorithm)
+        if self.size > 0 and self._pool is None:
+            self.start()
+
+        self._lock.acquire()
+        try:
+            keys = self._keys.popleft() if self._keys else None
+            metrics.set_value('keypool.depth', len(self._keys))
+            if self._pool is not None:
+                self._refill()
+        finally:
+            self._lock.release()
+
+        if keys is None:
+            metrics.incr('keypool.misses')
+            start = time.time()
+            eg = generate_elgamal_keypair()
+            metrics.timing('keypool.generate_inline', time.time() - start)
+            return eg
+
+        metrics.incr('keypool.hits')
+        eg = ElGamal.ElGamalobj()
+        (eg.p, eg.x, eg.g, eg.y) = keys
+        return eg
+
+    def __len__(self):
+        return len(self._keys)
+
+    def close(self):
+        """Stop the worker, and forget the keypairs ready"""
+        self._lock.acquire()
+        try:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
+            self._keys.clear()
+            self._pending = 0
+        finally:
+            self._lock.release()
+
+
+# Replaced by the configured pool, see SFLvaultServer.initialize_crypto()
+pool = KeyPool()
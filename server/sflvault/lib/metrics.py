@@ -0,0 +1,84 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Counters and timings of the server's internals.
+
+Admins get them with the `sflvault.metrics` call.  They are kept per
+process: with `sflvault.server.mode = prefork`, each call shows the
+metrics of the worker that answered it.
+"""
+
+import threading
+
+_lock = threading.Lock()
+_values = {}
+
+
+def incr(name, count=1):
+    """Add count to the counter `name`"""
+    _lock.acquire()
+    try:
+        _values[name] = _values.get(name, 0) + count
+    finally:
+        _lock.release()
+
+
+def set_value(name, value):
+    """Set the current value of `name`, e.g. the size of a pool"""
+    _lock.acquire()
+    try:
+        _values[name] = value
+    finally:
+        _lock.release()
+
+
+def timing(name, seconds):
+    """Record one occurrence of `name` that took that many seconds.
+
+    This keeps `name.count`, `name.total`, `name.last` and `name.max`.
+    """
+    _lock.acquire()
+    try:
+        _values[name + '.count'] = _values.get(name + '.count', 0) + 1
+        _values[name + '.total'] = _values.get(name + '.total', 0.0) + seconds
+        _values[name + '.last'] = seconds
+        _values[name + '.max'] = max(_values.get(name + '.max', 0.0),
+                                     seconds)
+    finally:
+        _lock.release()
+
+
+def snapshot():
+    """Return a copy of all the values"""
+    _lock.acquire()
+    try:
+        return dict(_values)
+    finally:
+        _lock.release()
+
+
+def reset():
+    """Forget all the values"""
+    _lock.acquire()
+    try:
+        _values.clear()
+    finally:
+        _lock.release()
@@ -0,0 +1,115 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Cache of the parsed public keys of users and groups.
+
+`User.elgamal()` and `Group.elgamal()` are called on each login, and for
+each recipient when encrypting for many users or groups.  Instead of
+parsing the serialized pubkey each time, the ElGamal objects are kept,
+keyed by the serialized pubkey itself, so a changed key is never served
+stale.
+
+The cache holds `sflvault.vault.pubkey_cache_size` keys, dropping the least
+recently used ones.  With `sflvault.vault.pubkey_cache_warm`, the keys of
+all users and groups are loaded at startup.  The `pubkeys.*` metrics tell
+its hits and misses.
+"""
+
+import collections
+import threading
+
+from sflvault.common.crypto import unserial_pubkey
+from sflvault.lib import metrics
+
+
+class PubkeyCache(object):
+    """Parsed ElGamal public keys, by serialized pubkey.
+
+    size - the most keys kept, 0 not to keep any.
+
+    The objects returned are shared: only encrypt with them, never change
+    them.
+    """
+    def __init__(self, size=1000):
+        self.size = int(size)
+        self._keys = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, pubkey):
+        """Return the ElGamal object of a serialized pubkey"""
+        self._lock.acquire()
+        try:
+            eg = self._keys.pop(pubkey, None)
+            if eg is not None:
+                # Move it back on top, as the most recently used
+                self._keys[pubkey] = eg
+        finally:
+            self._lock.release()
+
+        if eg is not None:
+            metrics.incr('pubkeys.hits')
+            return eg
+
+        metrics.incr('pubkeys.misses')
+        return self._add(pubkey)
+
+    def _add(self, pubkey):
+        eg = unserial_pubkey(pubkey)
+        if self.size <= 0:
+            return eg
+
+        self._lock.acquire()
+        try:
+            self._keys[pubkey] = eg
+            while len(self._keys) > self.size:
+                self._keys.popitem(last=False)
+            metrics.set_value('pubkeys.size', len(self._keys))
+        finally:
+            self._lock.release()
+        return eg
+
+    def warm(self, pubkeys):
+        """Parse and keep these serialized pubkeys ahead of time"""
+        for pubkey in pubkeys[:self.size]:
+            if not pubkey:
+                continue
+            self._lock.acquire()
+            try:
+                known = pubkey in self._keys
+            finally:
+                self._lock.release()
+            if not known:
+                self._add(pubkey)
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._keys.clear()
+            metrics.set_value('pubkeys.size', 0)
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._keys)
+
+
+# Replaced by the configured cache, see SFLvaultServer.initialize_crypto()
+cache = PubkeyCache()
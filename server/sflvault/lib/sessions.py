@@ -0,0 +1,265 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Session stores, keeping track of the authenticated users' tokens.
+
+A session is a dict like:
+
+  {'username': u'admin', 'user_id': 1, 'remote_addr': '127.0.0.1',
+   'timeout': datetime(...)}
+
+Only IDs and plain values are stored, never ORM objects.
+
+Two backends are available, chosen with `sflvault.vault.session_store`:
+
+* ``memory`` (default): in-process dict, with periodic sweeping of expired
+  sessions and a maximum number of sessions.
+* ``sql``: a `sessions` table, in the vault's database by default or in
+  `sflvault.vault.session_store.url`.  Sessions survive restarts and can be
+  shared by several server processes.
+
+Both have the same interface:
+
+  get(authtok) - the session for authtok, or None
+  set(authtok, session) - save the session for authtok
+  delete(authtok) - forget the session for authtok
+  sweep() - remove all expired sessions, return how many were removed
+  len(store) - how many sessions are stored
+
+Past the maximum number of sessions, the least recently used ones are
+dropped, and counted in the `sessions.evicted` metric.
+"""
+
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, MetaData, Table, types, sql
+from sqlalchemy import create_engine, inspect
+
+from sflvault.lib import metrics
+
+log = logging.getLogger(__name__)
+
+
+SESSION_FIELDS = ['username', 'user_id', 'remote_addr', 'timeout']
+
+
+class _SessionStoreBase(object):
+    """What both session stores share.
+
+    max_sessions - when more sessions are stored, the least recently used
+                   are dropped.
+    sweep_interval - seconds between two removals of all expired sessions.
+    """
+    def __init__(self, max_sessions=1000, sweep_interval=60):
+        self.max_sessions = int(max_sessions)
+        self.sweep_interval = int(sweep_interval)
+        self._last_sweep = datetime.now()
+
+    def _maybe_sweep(self):
+        now = datetime.now()
+        if self._last_sweep + timedelta(0, self.sweep_interval) <= now:
+            self._last_sweep = now
+            self.sweep()
+
+    def _clean(self, value):
+        return dict((k, value.get(k)) for k in SESSION_FIELDS)
+
+
+class MemorySessionStore(_SessionStoreBase):
+    """Keep the sessions in a dict, in this process only"""
+    def __init__(self, max_sessions=1000, sweep_interval=60):
+        _SessionStoreBase.__init__(self, max_sessions, sweep_interval)
+        self._sessions = {}
+        # When each session was last used
+        self._used = {}
+        self._lock = threading.Lock()
+
+    def get(self, authtok):
+        self._maybe_sweep()
+        sess = self._sessions.get(authtok)
+        if sess is None:
+            return None
+        self._used[authtok] = datetime.now()
+        return dict(sess)
+
+    def set(self, authtok, value):
+        self._maybe_sweep()
+        self._lock.acquire()
+        try:
+            self._sessions[authtok] = self._clean(value)
+            self._used[authtok] = datetime.now()
+            evicted = 0
+            while len(self._sessions) > self.max_sessions:
+                # Drop the least recently used session
+                oldest = min(self._used.items(), key=lambda x: x[1])[0]
+                del(self._sessions[oldest])
+                del(self._used[oldest])
+                evicted += 1
+        finally:
+            self._lock.release()
+        if evicted:
+            metrics.incr('sessions.evicted', evicted)
+
+    def delete(self, authtok):
+        self._lock.acquire()
+        try:
+            self._sessions.pop(authtok, None)
+            self._used.pop(authtok, None)
+        finally:
+            self._lock.release()
+
+    def sweep(self):
+        self._lock.acquire()
+        try:
+            now = datetime.now()
+            expired = [tok for tok, sess in self._sessions.items()
+                       if sess['timeout'] < now]
+            for tok in expired:
+                del(self._sessions[tok])
+                del(self._used[tok])
+        finally:
+            self._lock.release()
+        if expired:
+            log.debug("Swept %d expired sessions" % len(expired))
+        return len(expired)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class SQLSessionStore(_SessionStoreBase):
+    """Keep the sessions in a database table.
+
+    This doesn't go through the vault's transaction-managed Session: each
+    operation is committed on its own.
+    """
+    # Seconds between two updates of a session's last_used, to spare a
+    # write on most requests.
+    touch_interval = 60
+
+    def __init__(self, engine, max_sessions=1000, sweep_interval=60):
+        _SessionStoreBase.__init__(self, max_sessions, sweep_interval)
+        self.engine = engine
+        self.metadata = MetaData()
+        self.table = Table('sessions', self.metadata,
+                           Column('authtok', types.String(64),
+                                  primary_key=True),
+                           Column('username', types.Unicode(50)),
+                           Column('user_id', types.Integer),
+                           Column('remote_addr', types.String(100)),
+                           Column('timeout', types.DateTime, index=True),
+                           Column('last_used', types.DateTime, index=True),
+                           )
+        if self.engine.has_table('sessions'):
+            columns = [c['name'] for c in
+                       inspect(self.engine).get_columns('sessions')]
+            if 'last_used' not in columns:
+                # Created by an older version, the sessions are only lost
+                log.info("Recreating the sessions table")
+                self.table.drop(self.engine)
+        self.metadata.create_all(self.engine)
+
+    def get(self, authtok):
+        self._maybe_sweep()
+        t = self.table
+        row = self.engine.execute(t.select().where(t.c.authtok == authtok)) \
+                         .first()
+        if row is None:
+            return None
+        now = datetime.now()
+        if row.last_used is None or \
+           row.last_used + timedelta(0, self.touch_interval) <= now:
+            self.engine.execute(t.update().where(t.c.authtok == authtok)
+                                 .values(last_used=now))
+        return dict((k, row[k]) for k in SESSION_FIELDS)
+
+    def set(self, authtok, value):
+        self._maybe_sweep()
+        t = self.table
+        value = self._clean(value)
+        conn = self.engine.connect()
+        trans = conn.begin()
+        try:
+            conn.execute(t.delete().where(t.c.authtok == authtok))
+            conn.execute(t.insert().values(authtok=authtok,
+                                           last_used=datetime.now(),
+                                           **value))
+
+            count = conn.execute(sql.select([sql.func.count(t.c.authtok)])) \
+                        .scalar()
+            toks = []
+            if count > self.max_sessions:
+                # Drop the least recently used sessions
+                oldest = sql.select([t.c.authtok]) \
+                            .order_by(t.c.last_used) \
+                            .limit(count - self.max_sessions)
+                toks = [x.authtok for x in conn.execute(oldest)]
+                conn.execute(t.delete().where(t.c.authtok.in_(toks)))
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        finally:
+            conn.close()
+        if toks:
+            metrics.incr('sessions.evicted', len(toks))
+
+    def delete(self, authtok):
+        t = self.table
+        self.engine.execute(t.delete().where(t.c.authtok == authtok))
+
+    def sweep(self):
+        t = self.table
+        res = self.engine.execute(t.delete().where(t.c.timeout <
+                                                   datetime.now()))
+        if res.rowcount:
+            log.debug("Swept %d expired sessions" % res.rowcount)
+        return res.rowcount
+
+    def __len__(self):
+        t = self.table
+        return self.engine.execute(sql.select([sql.func.count(t.c.authtok)])) \
+                          .scalar()
+
+
+def session_store_from_settings(settings, engine=None):
+    """Create the session store configured in the server's settings.
+
+    engine - the vault's engine, used by the ``sql`` store when no
+             `sflvault.vault.session_store.url` is given.
+    """
+    kind = settings.get('sflvault.vault.session_store', 'memory')
+    max_sessions = settings.get('sflvault.vault.session_store.max', 1000)
+    sweep_interval = settings.get('sflvault.vault.session_store.sweep', 60)
+
+    if kind == 'memory':
+        return MemorySessionStore(max_sessions, sweep_interval)
+    elif kind == 'sql':
+        url = settings.get('sflvault.vault.session_store.url')
+        if url:
+            engine = create_engine(url)
+        if engine is None:
+            raise ValueError("The sql session store requires a database")
+        return SQLSessionStore(engine, max_sessions, sweep_interval)
+
+    raise ValueError("Invalid sflvault.vault.session_store: %s" % kind)
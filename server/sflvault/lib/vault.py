@@ -37,16 +37,18 @@ import xmlrpclib
 
 from sqlalchemy import sql
 from sqlalchemy.exc import InvalidRequestError as InvalidReq
-from sqlalchemy.orm import eagerload_all
 
 from sflvault import model
 from sflvault.model import *
 from sflvault.common import VaultError
+from sflvault.lib import cryptopool
+from sflvault.lib import keypool
 
 
 from datetime import timedelta
 import logging
 import transaction
+from zope.sqlalchemy import mark_changed
 log = logging.getLogger('sflvault')
 
 
@@ -67,15 +69,19 @@ class SFLvaultAccess(object):
         if method:
             return method(*params)
 
-    def __init__(self):
-        """Init obj."""
+    def __init__(self, myself_id=None, myself_username=None):
+        """Init obj.
 
+        One SFLvaultAccess is created for each request, with the identity
+        of the authenticated user (see sflvault.views).  Nothing else is
+        kept on the object, so it is cheap to build.
+        """
         # This gives this object the knowledge of which user_id is currently
         # using the Vault
-        self.myself_id = None
+        self.myself_id = myself_id
         # This gives this object the knowledge of which username is currently
         # using the Vault
-        self.myself_username = None
+        self.myself_username = myself_username
 
     def _log_any(self, log_func, msg, data):
         # Need to do that for user-setup
@@ -116,6 +122,11 @@ class SFLvaultAccess(object):
             return vaultMsg(False, 'User %s already has a public ' \
                                 'key stored' % username)
 
+        try:
+            unserial_pubkey(pubkey)
+        except (ValueError, TypeError, IndexError, DecryptError), e:
+            return vaultMsg(False, 'Invalid public key: %s' % e)
+
         # Ok, let's save the things and reset waiting_setup.
         u.waiting_setup = None
         u.pubkey = pubkey
@@ -207,10 +218,22 @@ class SFLvaultAccess(object):
 
         groups - return the list of groups for each user, or not
         """
-        req = query(User)
+        lst = query(User).order_by(User.id).all()
+
         if groups:
-            req = req.options(eagerload_all('groups_assoc.group'))
-        lst = query(User).all()
+            # All the memberships at once, rather than one query per user
+            ugs = {}
+            req = sql.select([usergroups_table.c.user_id,
+                              usergroups_table.c.group_id,
+                              usergroups_table.c.is_admin,
+                              groups_table.c.name]) \
+                     .select_from(usergroups_table.join(groups_table)) \
+                     .order_by(usergroups_table.c.id)
+            for ug in meta.Session.execute(req):
+                ugs.setdefault(ug.user_id, []).append(
+                    {'is_admin': ug.is_admin,
+                     'name': ug.name,
+                     'id': ug.group_id})
 
         out = []
         for x in lst:
@@ -227,13 +250,7 @@ class SFLvaultAccess(object):
                   'waiting_setup': bool(x.waiting_setup)}
 
             if groups:
-                # Loop group_assocs for that user..
-                nx['groups'] = []
-                for ug in x.groups_assoc:
-                    nxgrp = {'is_admin': ug.is_admin,
-                             'name': ug.group.name,
-                             'id': ug.group_id}
-                    nx['groups'].append(nxgrp)
+                nx['groups'] = ugs.get(x.id, [])
 
             out.append(nx)
 
@@ -283,6 +300,7 @@ class SFLvaultAccess(object):
         if 'metadata' in data:
             s.metadata = data['metadata']
 
+        model.search_index_update('service', [s])
         transaction.commit()
 
         self.log_i('Service s#(service_id)s saved successfully' ,
@@ -301,6 +319,18 @@ class SFLvaultAccess(object):
         # unused
         #me = query(User).get(self.myself_id)
 
+        uciphers = self._service_uciphers([s.id], group_id)
+
+        groups_list = None
+        # Load groups too if required
+        if with_groups:
+            groups_list = self._service_groups([s.id]).get(s.id, [])
+
+        return self._service_data(s, uciphers.get(s.id), groups_list)
+
+    def _service_uciphers(self, services_ids, group_id=None):
+        """Return the first (by group_id) cipher row I have access to, for
+        each of the services_ids, in a {service_id: row} dict."""
         # We need no aliasing, because we'll only use `cryptgroupkey`,
         # `cryptsymkey` and `group_id` in there.
         req = sql.join(servicegroups_table, usergroups_table,
@@ -308,37 +338,47 @@ class SFLvaultAccess(object):
                  .join(users_table, User.id==UserGroup.user_id) \
                  .select(use_labels=True) \
                  .where(User.id==self.myself_id) \
-                 .where(ServiceGroup.service_id==s.id) \
+                 .where(ServiceGroup.service_id.in_(services_ids)) \
                  .order_by(ServiceGroup.group_id)
 
         # Deal with group if specified..
         if group_id:
             req = req.where(ServiceGroup.group_id == group_id)
 
-        res = meta.Session.execute(req)
+        # Take the first one, for each service
+        uciphers = {}
+        for ucipher in meta.Session.execute(req):
+            uciphers.setdefault(ucipher.services_groups_service_id, ucipher)
+        return uciphers
+
+    def _service_groups(self, services_ids):
+        """Return the (group_id, name) of the groups each of the
+        services_ids is in, in a {service_id: [...]} dict."""
+        groups = {}
+        req = sql.join(groups_table, servicegroups_table) \
+                 .select(use_labels=True) \
+                 .where(ServiceGroup.service_id.in_(services_ids))
+        for grp in meta.Session.execute(req):
+            groups.setdefault(grp.services_groups_service_id, []) \
+                  .append((grp.groups_id, grp.groups_name))
+        return groups
+
+    def _service_data(self, s, ucipher, groups_list):
+        """Build the service's data, as returned by service_get.
 
-        # Take the first one
-        uciphers = list(res)
-        if not uciphers:
+        s - a Service object, or a row from the services table
+        ucipher - a row from _service_uciphers(), or None
+        """
+        if ucipher is None:
             ugcgk = ''
             sgcsk = ''
             uggi = ''
         else:
-            ucipher = uciphers[0]
             # WARN: these are table-name dependent!!
             ugcgk = ucipher.users_groups_cryptgroupkey
             sgcsk = ucipher.services_groups_cryptsymkey
             uggi = ucipher.users_groups_group_id
 
-        groups_list = None
-        # Load groups too if required
-        if with_groups:
-            groups_list = []
-            req2 = sql.join(groups_table, servicegroups_table).select(use_labels=True).where(ServiceGroup.service_id == service_id)
-            res2 = meta.Session.execute(req2)
-            for grp in res2:
-                groups_list.append((grp.groups_id, grp.groups_name))
-
         out = {'id': s.id,
                'url': s.url,
                'secret': s.secret,
@@ -356,6 +396,8 @@ class SFLvaultAccess(object):
 
     def service_get_tree(self, service_id, with_groups=False):
         """Get a service tree, starting with service_id"""
+        if model.supports_recursive_cte():
+            return self._service_get_tree_batched(service_id, with_groups)
 
         out = []
         while True:
@@ -386,6 +428,51 @@ class SFLvaultAccess(object):
         return vaultMsg(True, "Here are the services", {'services': out})
 
 
+    def _service_get_tree_batched(self, service_id, with_groups=False):
+        """Same as service_get_tree, but load the whole parent chain in a
+        fixed number of queries, instead of a few queries per level."""
+        try:
+            service_id = int(service_id)
+        except (TypeError, ValueError):
+            return vaultMsg(False, "Service not found: %s" % service_id)
+
+        services = dict((s.id, s) for s in
+                        meta.Session.execute(model.service_chain_query(
+                                                              service_id)))
+        uciphers = self._service_uciphers(services.keys())
+        groups = None
+        if with_groups:
+            groups = self._service_groups(services.keys())
+
+        out = []
+        while True:
+            if service_id not in services:
+                self.log_e('Show service: %(error)s',
+                           {"error": "Service not found: %s" % service_id})
+                return vaultMsg(False, "Service not found: %s" % service_id)
+
+            s = services[service_id]
+            out.append(self._service_data(s, uciphers.get(s.id),
+                                          groups.get(s.id, [])
+                                          if groups is not None else None))
+
+            if not s.parent_service_id:
+                break
+
+            # Load the parent...
+            service_id = s.parent_service_id
+
+            # check if we're not in an infinite loop!
+            if service_id in [x['id'] for x in out]:
+                self.log_e('Circular references of parent services, aborting.', {})
+                return vaultMsg(False, "Circular references of parent services, aborting.")
+
+        out.reverse()
+
+        self.log_i('Service shown: %(service_id)s', {"service_id": service_id})
+        return vaultMsg(True, "Here are the services", {'services': out})
+
+
     def show(self, service_id, with_groups=False):
         """Get the specified service ID and return the hierarchy to connect
         to it or to show it.
@@ -395,13 +482,28 @@ class SFLvaultAccess(object):
         return self.service_get_tree(service_id, with_groups)
 
 
-    def search(self, search_query, filters=None, verbose=False):
+    def search(self, search_query, filters=None, verbose=False, limit=None,
+               offset=0):
         """Do the search, and return the result tree.
 
         filters - must be a dictionary with options on which to constraint
                   results.
+        limit - maximum number of services (or machines and customers without
+                services) to return, None for all.
+        offset - number of those to skip first.
 
+        The total number of matches is returned in 'total', to get the next
+        pages.
         """
+        try:
+            offset = int(offset or 0)
+            if limit is not None:
+                limit = int(limit)
+            if offset < 0 or (limit is not None and limit < 0):
+                raise ValueError()
+        except ValueError:
+            return vaultMsg(False, "limit and offset must be positive integers")
+
         filter_types = ['groups', 'machines', 'customers']
         # Load objects on which to restrict the query:
         newfilters = {}
@@ -424,7 +526,13 @@ class SFLvaultAccess(object):
                     self.log_e('Search error: %(error)s', {"error": str(e)})
                     return vaultMsg(False, str(e))
 
-        search = model.search_query(search_query, newfilters, verbose)
+        search = model.search_query(search_query, newfilters, verbose,
+                                    limit, offset).fetchall()
+        if limit is None and (search or not offset):
+            # Everything from offset onward was fetched
+            total = offset + len(search)
+        else:
+            total = model.search_count(search_query, newfilters)
 
 
         # Quick helper funcs, to create the hierarchical 'out' structure.
@@ -468,7 +576,10 @@ class SFLvaultAccess(object):
         # Return 'out', in a nicely structured hierarchical form.
         #self.log_i('Search successfull for: %(search)s',
         #            {'search': search_query})
-        return vaultMsg(True, "Here are the search results", {'results': out})
+        page = {'results': out, 'total': total, 'offset': offset}
+        if limit is not None:
+            page['limit'] = limit
+        return vaultMsg(True, "Here are the search results", page)
 
 
     def customer_get(self, customer_id):
@@ -496,6 +607,7 @@ class SFLvaultAccess(object):
         if 'name' in data:
             cust.name = data['name']
 
+        model.search_index_update('customer', [cust])
         transaction.commit()
 
         self.log_i('Customer c#%(customer_id)s saved successfully)s',
@@ -517,6 +629,7 @@ class SFLvaultAccess(object):
         meta.Session.add(nc)
         meta.Session.flush()
         cid = nc.id
+        model.search_index_update('customer', [nc])
         transaction.commit()
 #        meta.Session.refresh(nc)
         #self.log_i('Customer add: c#%s' % cid)
@@ -539,6 +652,7 @@ class SFLvaultAccess(object):
         for x in ['ip', 'name', 'fqdn', 'location', 'notes']:
             if x in data:
                 m.__setattr__(x, data[x])
+        model.search_index_update('machine', [m])
         transaction.commit()
 
         self.log_i('Machine m#%(machine_id)s saved successfully',
@@ -581,7 +695,7 @@ class SFLvaultAccess(object):
         meta.Session.add(nm)
         meta.Session.flush()
         nmid = nm.id
-
+        model.search_index_update('machine', [nm])
 
         transaction.commit()
 
@@ -589,8 +703,56 @@ class SFLvaultAccess(object):
         return vaultMsg(True, "Machine added.", {'machine_id': nmid})
 
 
+    def _check_cryptsymkeys(self, groups, cryptsymkeys):
+        """Return the cryptsymkeys a client made for each of the groups, in
+        the same order.
+
+        cryptsymkeys - {group_id: cryptsymkey}, one for each group.  Only
+                       the groups we're a member of can have their symkeys
+                       wrapped (see GROUP_WRAP_PREFIX), the others' must be
+                       encrypted for their pubkey.
+
+        Raises ValueError if one is missing or doesn't look right.
+        """
+        try:
+            cryptsymkeys = dict((int(gid), cryptsymkey)
+                                for gid, cryptsymkey in cryptsymkeys.items())
+        except (AttributeError, TypeError, ValueError), e:
+            raise ValueError("cryptsymkeys must be a dictionary")
+        if set(cryptsymkeys) != set(g.id for g in groups):
+            raise ValueError("one cryptsymkey per group is needed")
+        mine = set(ug.group_id for ug in
+                   query(UserGroup).filter_by(user_id=self.myself_id))
+        out = []
+        for g in groups:
+            cryptsymkey = cryptsymkeys[g.id]
+            if str(cryptsymkey).startswith(GROUP_WRAP_PREFIX) and \
+               g.id not in mine:
+                raise ValueError("can't wrap symkeys for g#%s without being "
+                                 "a member" % g.id)
+            check_cryptsymkey(cryptsymkey, key_algorithm(g.pubkey))
+            out.append(cryptsymkey)
+        return out
+
+    def _check_secret(self, ciphertext):
+        """Raise ValueError unless ciphertext looks like the output of
+        encrypt_secret()"""
+        try:
+            size = len(b64decode(ciphertext))
+        except (TypeError, UnicodeError), e:
+            size = 0
+        if not size or size % 16:
+            raise ValueError("the secret isn't encrypted")
+
     def service_add(self, machine_id, parent_service_id, url,
-                    group_ids, secret, notes, metadata):
+                    group_ids, secret, notes, metadata, cryptsymkeys=None):
+        """Add a service, with its secret encrypted for each of the groups.
+
+        cryptsymkeys - see _check_cryptsymkeys(), made by a client that
+                       encrypted the secret itself with encrypt_secret():
+                       secret is then that ciphertext, and the symkey is
+                       never sent.
+        """
         # Get groups
         try:
             groups, group_ids = model.get_objects_list(group_ids, 'groups',
@@ -608,8 +770,17 @@ class SFLvaultAccess(object):
                 return vaultMsg(False, "No such parent service ID.",
                                 {'parent_service_id': parent_service_id})
 
-        # seckey is the AES256 symmetric key, to be encrypted for each user.
-        (seckey, ciphertext) = encrypt_secret(secret)
+        if cryptsymkeys is None:
+            # seckey is the AES256 symmetric key, to be encrypted for each
+            # user.
+            (seckey, ciphertext) = encrypt_secret(secret)
+        else:
+            ciphertext = secret
+            try:
+                self._check_secret(ciphertext)
+                cryptsymkeys = self._check_cryptsymkeys(groups, cryptsymkeys)
+            except ValueError, e:
+                return vaultMsg(False, "Invalid encrypted keys: %s" % e)
 
         # Add service effectively..
         ns = Service()
@@ -623,21 +794,22 @@ class SFLvaultAccess(object):
 
         meta.Session.add(ns)
 
-        # Encrypt symkey for each group, using it's own ElGamal pubkey
-        for g in groups:
-            eg = g.elgamal()
-
+        if cryptsymkeys is None:
+            # Encrypt symkey for each group, using it's own ElGamal pubkey
+            cryptsymkeys = cryptopool.pool.encrypt_longmsg_many(
+                [(g.pubkey, seckey) for g in groups])
+            del(seckey)
+        for g, cryptsymkey in zip(groups, cryptsymkeys):
             nsg = ServiceGroup()
             nsg.group_id = g.id
-            nsg.cryptsymkey = encrypt_longmsg(eg, seckey)
+            nsg.cryptsymkey = cryptsymkey
 
             ns.groups_assoc.append(nsg)
 
-        del(seckey)
-
         meta.Session.flush()
         grouplist = [g.name for g in groups]
         nsid = ns.id
+        model.search_index_update('service', [ns])
         transaction.commit()
         return vaultMsg(True, "Service added.", {'service_id': nsid,
                                                  'encrypted_for': grouplist})
@@ -657,7 +829,8 @@ class SFLvaultAccess(object):
 
         out = {'id': grp.id,
                'name': grp.name,
-               'hidden': grp.hidden}
+               'hidden': grp.hidden,
+               'pubkey': grp.pubkey}
 
         if grp.hidden and (not ug or not ug.is_admin):
             return vaultMsg(False, "Group not found*")
@@ -705,33 +878,37 @@ class SFLvaultAccess(object):
         me = query(User).get(self.myself_id)
         myeg = me.elgamal()
 
-        # Generate keypair
-        newkeys = generate_elgamal_keypair()
+        # Generate keypair, or take one generated in advance
+        newkeys = keypool.pool.get_keypair()
 
         ng = Group()
         ng.name = group_name
         ng.hidden = hidden
-        ng.pubkey = serial_elgamal_pubkey(elgamal_pubkey(newkeys))
+        ng.pubkey = serial_pubkey(newkeys)
 
         meta.Session.add(ng)
 
         # Add myself to the group and all other global admins.
         admins = set(query(User).filter_by(is_admin=True).all())
         admins.add(me)
+        admins = list(admins)
+
+        privkey = serial_privkey(newkeys)
+        cryptgroupkeys = cryptopool.pool.encrypt_longmsg_many(
+            [(usr.pubkey, privkey) for usr in admins])
+        del(privkey)
 
-        for usr in list(admins):
+        for usr, cryptgroupkey in zip(admins, cryptgroupkeys):
             nug = UserGroup()
             # Make sure I'm admin of my newly created group
             if usr == me:
                 nug.is_admin = True
+                key = cryptgroupkey
             nug.user_id = usr.id
-            nug.cryptgroupkey = encrypt_longmsg(usr.elgamal(),
-                                                serial_elgamal_privkey(
-                                                    elgamal_bothkeys(newkeys)))
+            nug.cryptgroupkey = cryptgroupkey
             ng.users_assoc.append(nug)
         name = ng.name
         gid = ng.id
-        key = nug.cryptgroupkey
         transaction.commit()
 
         return vaultMsg(True, "Added group '%s'" % name,
@@ -778,16 +955,36 @@ class SFLvaultAccess(object):
         # FIXME: list_users is not used
         # FIXME: show_hidden is not used
 
-        groups = query(Group).options(eagerload_all('users_assoc.user')).all()
         me = query(User).get(self.myself_id)
+        groups = meta.Session.execute(
+            sql.select([groups_table.c.id, groups_table.c.name,
+                        groups_table.c.hidden])
+               .order_by(groups_table.c.id))
+
+        # All the members of all groups, in one query
+        members = {}
+        req = sql.select([usergroups_table.c.group_id,
+                          usergroups_table.c.user_id,
+                          usergroups_table.c.is_admin,
+                          users_table.c.username]) \
+                 .select_from(usergroups_table.join(users_table)) \
+                 .order_by(usergroups_table.c.id)
+        for ug in meta.Session.execute(req):
+            members.setdefault(ug.group_id, []).append((ug.user_id,
+                                                        ug.username,
+                                                        ug.is_admin))
+
+        # Only my own memberships carry the cryptgroupkey
+        myugs = dict((ug.group_id, ug) for ug in
+                     query(UserGroup).filter_by(user_id=me.id))
 
         out = []
         for grp in groups:
-            myug = [ug for ug in grp.users_assoc if ug.user_id == me.id]
+            myug = myugs.get(grp.id)
 
             res = {'id': grp.id,
                    'name': grp.name,
-                   'member': me in grp.users,
+                   'member': myug is not None,
                    'hidden': False,
                    'admin': False}
 
@@ -798,26 +995,28 @@ class SFLvaultAccess(object):
                     continue
                 res['hidden'] = True
 
-            if len(myug):
-                res['cryptgroupkey'] = myug[0].cryptgroupkey
-                if myug[0].is_admin:
+            if myug:
+                res['cryptgroupkey'] = myug.cryptgroupkey
+                if myug.is_admin:
                     res['admin'] = True
 
-            res['members'] = [(u.user_id, u.user.username, u.is_admin)
-                              for u in grp.users_assoc]
+            res['members'] = members.get(grp.id, [])
 
             out.append(res)
 
         return vaultMsg(True, 'Here is the list of groups', {'list': out})
 
 
-    def group_add_service(self, group_id, service_id, symkey):
+    def group_add_service(self, group_id, service_id, symkey,
+                          cryptsymkey=None):
         """Add a service to a group.
 
         Call servie_get() first to get the information and decrypt the symkey
         on your side, then call this function to store the symkey.
 
-        The server-side Vault will encrypt it for the given group.
+        The server-side Vault will encrypt it for the given group, unless
+        the client sends it already encrypted or wrapped for the group as
+        cryptsymkey (see _check_cryptsymkeys()), with no symkey.
         """
         transaction.begin()
         try:
@@ -825,8 +1024,6 @@ class SFLvaultAccess(object):
         except InvalidReq, e:
             return vaultMsg(False, "Group not found: %s" % str(e))
 
-        grpeg = grp.elgamal()
-
         sg = query(ServiceGroup).filter_by(group_id=group_id,
                                            service_id=service_id).all()
         if len(sg):
@@ -836,7 +1033,14 @@ class SFLvaultAccess(object):
         nsg = ServiceGroup()
         nsg.group_id = group_id
         nsg.service_id = service_id
-        nsg.cryptsymkey = encrypt_longmsg(grpeg, symkey)
+        if cryptsymkey:
+            try:
+                nsg.cryptsymkey = self._check_cryptsymkeys(
+                    [grp], {grp.id: cryptsymkey})[0]
+            except ValueError, e:
+                return vaultMsg(False, "Invalid encrypted key: %s" % e)
+        else:
+            nsg.cryptsymkey = encrypt_longmsg(grp.elgamal(), symkey)
 
         meta.Session.add(nsg)
         transaction.commit()
@@ -1005,6 +1209,108 @@ class SFLvaultAccess(object):
         return vaultMsg(True, "Removed user from group successfully" + ohoh, {})
 
 
+    def _group_ciphers_column(self, kind):
+        """Return the table and column holding the ciphers of that kind, see
+        group_ciphers_get()"""
+        if kind == 'services':
+            return servicegroups_table, servicegroups_table.c.cryptsymkey
+        elif kind == 'users':
+            return usergroups_table, usergroups_table.c.cryptgroupkey
+        raise ValueError("Invalid kind of ciphers: %s" % kind)
+
+    def group_ciphers_get(self, group_id, kind, after_id=0, limit=100,
+                          version=None):
+        """Return a batch of a group's ciphers, to re-encrypt them in another
+        format with group_ciphers_put().
+
+        kind - 'services': the services' symkeys, encrypted for the group.
+               'users': the group's key, encrypted for each member (their
+               pubkey is returned with it).
+        after_id - only return the rows with a greater ID, the batches are
+                   ordered by ID.
+        version - skip the ciphers already in that encrypt_longmsg() format.
+
+        'remaining' tells how many rows are left after this batch.
+        """
+        try:
+            table, column = self._group_ciphers_column(kind)
+            group_id, after_id, limit = int(group_id), int(after_id), \
+                                        int(limit)
+        except ValueError, e:
+            return vaultMsg(False, str(e))
+
+        cols = [table.c.id, column.label('cipher')]
+        sel = table
+        if kind == 'users':
+            cols.append(users_table.c.pubkey)
+            sel = sel.join(users_table)
+        req = sql.select(cols).select_from(sel) \
+                 .where(table.c.group_id == group_id)
+        if version == 2:
+            req = req.where(sql.not_(column.like(LONGMSG_V2_PREFIX + '%')))
+        elif version == 1:
+            req = req.where(column.like(LONGMSG_V2_PREFIX + '%'))
+        # Wrapped symkeys and ciphers for X25519 keys have no version
+        req = req.where(sql.not_(column.like(GROUP_WRAP_PREFIX + '%')))
+        req = req.where(sql.not_(column.like(ECIES_PREFIX + '%')))
+
+        left = req.where(table.c.id > after_id) \
+                  .order_by(table.c.id)
+        rows = meta.Session.execute(left.limit(limit)).fetchall()
+        remaining = meta.Session.execute(
+            sql.select([sql.func.count()]).select_from(left.alias())) \
+            .scalar() - len(rows)
+
+        out = []
+        for row in rows:
+            cipher = {'id': row.id, 'cipher': row.cipher}
+            if kind == 'users':
+                cipher['pubkey'] = row.pubkey
+            out.append(cipher)
+
+        return vaultMsg(True, "Here are the group's ciphers",
+                        {'ciphers': out, 'remaining': remaining})
+
+    def group_ciphers_put(self, group_id, kind, ciphers):
+        """Save ciphers re-encrypted from group_ciphers_get().
+
+        ciphers - list of {'id': row id, 'cipher': new ciphertext,
+                  'old_cipher': the ciphertext it was made from}
+
+        A row is only saved if it still holds old_cipher: one changed in
+        the meantime (a new password, a new member key) would otherwise be
+        overwritten with the stale value.  The IDs of those rows are
+        returned in 'skipped', to fetch and re-encrypt them again.
+        """
+        try:
+            table, column = self._group_ciphers_column(kind)
+            group_id = int(group_id)
+            values = [{'_id': int(c['id']), '_cipher': c['cipher'],
+                       '_old': c['old_cipher']}
+                      for c in ciphers if c['cipher']]
+        except (ValueError, KeyError, TypeError), e:
+            return vaultMsg(False, "Invalid ciphers: %s" % e)
+
+        skipped = []
+        if values:
+            req = table.update() \
+                       .where(table.c.id == sql.bindparam('_id')) \
+                       .where(table.c.group_id == group_id) \
+                       .where(column == sql.bindparam('_old')) \
+                       .values({column.name: sql.bindparam('_cipher')})
+            # One row at a time, executemany() doesn't tell which matched.
+            for value in values:
+                if not meta.Session.execute(req, value).rowcount:
+                    skipped.append(value['_id'])
+            mark_changed(meta.Session())
+        transaction.commit()
+
+        count = len(values) - len(skipped)
+        return vaultMsg(True, "Saved %d ciphers, skipped %d changed since" %
+                              (count, len(skipped)),
+                        {'count': count, 'skipped': skipped})
+
+
     def customer_del(self, customer_id):
         """Delete a customer from database, bringing along all it's machines
         and services
@@ -1064,6 +1370,9 @@ class SFLvaultAccess(object):
         #        .where(model.customers_table.c.id == customer_id)
 
         query(model.Customer).filter(model.Customer.id==customer_id).delete(synchronize_session=False)
+        model.search_index_remove('service', servs_ids)
+        model.search_index_remove('machine', mach_ids)
+        model.search_index_remove('customer', [int(customer_id)])
         # meta.Session.execute(d)
         # meta.Session.execute(d2)
         # meta.Session.execute(d3)
@@ -1117,6 +1426,8 @@ class SFLvaultAccess(object):
                 .filter(model.Service.id.in_(servs_ids))\
                 .delete(synchronize_session=False)
         query(model.Machine).filter(model.Machine.id==machine_id).delete(synchronize_session=False)
+        model.search_index_remove('service', servs_ids)
+        model.search_index_remove('machine', [int(machine_id)])
         # Delete all related groupciphers
 #        raise Exception
 #        d = sql.delete(model.servicegroups_table) \
@@ -1166,6 +1477,7 @@ class SFLvaultAccess(object):
         query(model.ServiceGroup).filter(model.ServiceGroup.service_id == service_id).delete(synchronize_session=False)
         # Delete the service
         query(Service).filter(model.Service.id==service_id).delete(synchronize_session=False)
+        model.search_index_remove('service', [service_id])
         transaction.commit()
 
         return vaultMsg(True, 'Deleted service s#%s successfully' % service_id)
@@ -1234,8 +1546,11 @@ class SFLvaultAccess(object):
     #    return vaultMsg(True, "Here is the machines list", {'list': out})
 
 
-    def service_passwd(self, service_id, newsecret):
-        """Change the passwd for a given service"""
+    def service_passwd(self, service_id, newsecret, cryptsymkeys=None):
+        """Change the passwd for a given service
+
+        cryptsymkeys - see service_add(), newsecret is then encrypted.
+        """
         transaction.begin()
         # number please
         service_id = int(service_id)
@@ -1243,7 +1558,18 @@ class SFLvaultAccess(object):
         serv = query(Service).get(service_id)
         groups = serv.groups
 
-        (seckey, ciphertext) = encrypt_secret(newsecret)
+        if cryptsymkeys is None:
+            (seckey, ciphertext) = encrypt_secret(newsecret)
+        else:
+            ciphertext = newsecret
+            try:
+                self._check_secret(ciphertext)
+                bygroup = dict((g.id, g) for g in groups)
+                cryptsymkeys = self._check_cryptsymkeys(
+                    [bygroup[sg.group_id] for sg in serv.groups_assoc],
+                    cryptsymkeys)
+            except ValueError, e:
+                return vaultMsg(False, "Invalid encrypted keys: %s" % e)
         serv.secret = ciphertext
         serv.secret_last_modified = datetime.now()
 
@@ -1254,9 +1580,13 @@ class SFLvaultAccess(object):
         # TODO: for traceability, mark the date we changed the password.
         #
 
-        for sg in serv.groups_assoc:
-            eg = [g for g in groups if g.id == sg.group_id][0].elgamal()
-            sg.cryptsymkey = encrypt_longmsg(eg, seckey)
+        if cryptsymkeys is None:
+            pubkeys = dict((g.id, g.pubkey) for g in groups)
+            cryptsymkeys = cryptopool.pool.encrypt_longmsg_many(
+                [(pubkeys[sg.group_id], seckey) for sg in serv.groups_assoc])
+            del(seckey)
+        for sg, cryptsymkey in zip(serv.groups_assoc, cryptsymkeys):
+            sg.cryptsymkey = cryptsymkey
 
         grouplist = [g.name for g in groups]
         transaction.commit()
@@ -24,7 +24,7 @@ from datetime import datetime
 import re
 
 from Crypto.PublicKey import ElGamal
-from sqlalchemy import Column, MetaData, Table, types, ForeignKey
+from sqlalchemy import Column, MetaData, Table, types, ForeignKey, Index
 from sqlalchemy.orm import mapper, relation, backref
 from sqlalchemy.orm import scoped_session, sessionmaker, eagerload, lazyload
 from sqlalchemy.orm import eagerload_all
@@ -35,13 +35,19 @@ from sflvault.model import meta
 from sflvault.model.meta import Session, metadata
 from sflvault.model.custom_types import JSONEncodedDict
 from sflvault.common.crypto import *
-from zope.sqlalchemy import ZopeTransactionExtension
+from sflvault.lib import pubkeys
+from zope.sqlalchemy import ZopeTransactionExtension, mark_changed
 
 # TODO: add an __all__ statement here, to speed up loading...
 
 
-def init_model(engine):
-    """Call me before using any of the tables or classes in the model."""
+def init_model(engine, search_index=False):
+    """Call me before using any of the tables or classes in the model.
+
+    search_index - maintain the search_index table and use it to speed
+                   up search_query().  Call search_index_rebuild() once
+                   the tables are created.
+    """
     sm = sessionmaker(autoflush=True,
                       bind=engine,
                       expire_on_commit=False,
@@ -49,6 +55,7 @@ def init_model(engine):
 
     meta.engine = engine
     meta.Session = scoped_session(sm)
+    meta.search_index = search_index
 
 
 users_table = Table("users", metadata,
@@ -145,6 +152,19 @@ services_table = Table('services', metadata,
                               default=datetime.now)
                        )
 
+# Inverted index of the searchable text, see search_index_update().  Each
+# customer, machine and service has one row per distinct trigram (three
+# lowercased characters) found in its searchable fields.
+searchindex_table = Table('search_index', metadata,
+                          # 'customer', 'machine' or 'service'
+                          Column('kind', types.String(10), primary_key=True),
+                          Column('obj_id', types.Integer, primary_key=True),
+                          Column('trigram', types.Unicode(3),
+                                 primary_key=True),
+                          )
+Index('ix_search_index_trigram', searchindex_table.c.trigram,
+      searchindex_table.c.kind)
+
 
 class Service(object):
     def __repr__(self):
@@ -163,10 +183,11 @@ class User(object):
             return False
 
     def elgamal(self):
-        """Return the ElGamal object, ready to encrypt stuff."""
-        e = ElGamal.ElGamalobj()
-        (e.p, e.g, e.y) = unserial_elgamal_pubkey(self.pubkey)
-        return e
+        """Return the ElGamal object (or X25519Key), ready to encrypt
+        stuff.
+
+        It is shared through the pubkey cache, don't modify it."""
+        return pubkeys.cache.get(self.pubkey)
     
     def __repr__(self):
         return "<User u#%d: %s>" % (self.id, self.username)
@@ -194,10 +215,11 @@ class Group(object):
         return "<Group: %s>" % (self.name)
     
     def elgamal(self):
-        """Return the ElGamal object, ready to encrypt stuff."""
-        e = ElGamal.ElGamalobj()
-        (e.p, e.g, e.y) = unserial_elgamal_pubkey(self.pubkey)
-        return e
+        """Return the ElGamal object (or X25519Key), ready to encrypt
+        stuff.
+
+        It is shared through the pubkey cache, don't modify it."""
+        return pubkeys.cache.get(self.pubkey)
 
 class Customer(object):
     def __repr__(self):
@@ -349,7 +371,150 @@ def get_objects_list(objects_ids, object_type, eagerload_all_=None,
     return (objects if return_objects else None, objects_ids)
 
 
-def search_query(swords, filters=None, verbose=False):
+def supports_recursive_cte():
+    """Tell whether the bound database can run ``WITH RECURSIVE`` queries"""
+    dialect = meta.engine.dialect
+    if dialect.name == 'sqlite':
+        import sqlite3
+        return sqlite3.sqlite_version_info >= (3, 8, 3)
+    if dialect.name == 'postgresql':
+        return True
+    if dialect.name == 'mysql':
+        return (dialect.server_version_info or (0,)) >= (8,)
+    return False
+
+
+def service_chain_query(service_id):
+    """Return a select() of the service `service_id` and all of its parents,
+    following parent_service_id, in a single recursive query.
+
+    UNION (and not UNION ALL) is used on purpose: a circular chain of
+    parents will yield already seen rows, and the recursion will stop.
+    The chain order must be rebuilt by the caller, which must also check
+    for circular references.
+    """
+    chain = sql.select([services_table.c.id,
+                        services_table.c.parent_service_id]) \
+               .where(services_table.c.id == service_id) \
+               .cte('service_chain', recursive=True)
+    parents = services_table.alias('parents')
+    chain = chain.union(sql.select([parents.c.id,
+                                    parents.c.parent_service_id])
+                           .where(parents.c.id == chain.c.parent_service_id))
+
+    return services_table.select() \
+               .where(services_table.c.id.in_(sql.select([chain.c.id])))
+
+
+# Fields searched by search_query(), per kind of object
+SEARCH_FIELDS = {'customer': ['name'],
+                 'machine': ['name', 'fqdn', 'ip', 'location', 'notes'],
+                 'service': ['url', 'notes']}
+
+
+def _trigrams(text):
+    """Return the set of lowercased trigrams found in text"""
+    if not text:
+        return set()
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+    text = text.lower()
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def search_index_update(kind, objs):
+    """Index the searchable fields of objs, replacing their previous entries.
+
+    kind - 'customer', 'machine' or 'service'
+    objs - Customer, Machine or Service objects (or rows), with their id set.
+
+    This runs in the current transaction, call it before committing.  It
+    does nothing unless the search index is enabled.
+    """
+    if not meta.search_index or not objs:
+        return
+    t = searchindex_table
+    search_index_remove(kind, [obj.id for obj in objs])
+
+    rows = []
+    for obj in objs:
+        trigrams = set()
+        for field in SEARCH_FIELDS[kind]:
+            # Trigrams never span two fields, just like the ilike() matches
+            trigrams.update(_trigrams(getattr(obj, field)))
+        rows.extend({'kind': kind, 'obj_id': obj.id, 'trigram': tri}
+                    for tri in trigrams)
+    if rows:
+        meta.Session.execute(t.insert(), rows)
+    mark_changed(meta.Session())
+
+
+def search_index_remove(kind, ids):
+    """Remove the objects of that kind from the search index"""
+    if not meta.search_index or not ids:
+        return
+    t = searchindex_table
+    meta.Session.execute(t.delete().where(t.c.kind == kind)
+                                   .where(t.c.obj_id.in_(ids)))
+    mark_changed(meta.Session())
+
+
+def search_index_rebuild():
+    """Index all the customers, machines and services from scratch.
+
+    The index isn't kept up to date while it is disabled, so this is run on
+    startup when it is enabled.
+    """
+    if not meta.search_index:
+        return
+    meta.Session.execute(searchindex_table.delete())
+    for kind, table in [('customer', customers_table),
+                        ('machine', machines_table),
+                        ('service', services_table)]:
+        cols = [table.c.id] + [table.c[f] for f in SEARCH_FIELDS[kind]]
+        search_index_update(kind,
+                            meta.Session.execute(sql.select(cols)).fetchall())
+    mark_changed(meta.Session())
+
+
+def pubkeys_list():
+    """Return the serialized pubkeys of all the users and groups, to load
+    them in the pubkey cache"""
+    out = []
+    for table in [users_table, groups_table]:
+        req = sql.select([table.c.pubkey]).where(table.c.pubkey != None)
+        out.extend([row[0] for row in meta.Session.execute(req)])
+    return out
+
+
+def _search_index_match(word):
+    """Return a clause narrowing the search to the customers, machines or
+    services that contain all of word's trigrams, or None if the index
+    can't tell.
+
+    This is only a pre-selection, the ilike() matches must still be
+    checked: having all the trigrams doesn't mean having the substring.
+    """
+    # LIKE wildcards and short words can't be looked up.
+    if len(word) < 3 or '%' in word or '_' in word:
+        return None
+    trigrams = _trigrams(word)
+    t = searchindex_table
+    orlist = []
+    for kind, col in [('customer', Customer.id),
+                      ('machine', Machine.id),
+                      ('service', Service.id)]:
+        found = sql.select([t.c.obj_id]) \
+                   .where(t.c.kind == kind) \
+                   .where(t.c.trigram.in_(trigrams)) \
+                   .group_by(t.c.obj_id) \
+                   .having(sql.func.count(t.c.trigram) == len(trigrams))
+        orlist.append(col.in_(found))
+    return sql.or_(*orlist)
+
+
+def _search_select(swords, filters=None):
+    """Build the search's select(), see search_query()"""
 
     # Create the join..
     sel = sql.outerjoin(customers_table, machines_table).outerjoin(services_table)
@@ -363,15 +528,20 @@ def search_query(swords, filters=None, verbose=False):
 
         if [True for x in filters if not isinstance(filters[x], list)]:
             raise RuntimeError("filters themselves must be a list of ints")
-        
-        if 'groups' in filters:
-            sel = sel.join(servicegroups_table)
 
     sel = sel.select(use_labels=True)
 
     if filters:
         if 'groups' in filters:
-            sel = sel.where(ServiceGroup.group_id.in_(filters['groups']))
+            # Match on the distinct service ids rather than joining
+            # services_groups: a service in several of the groups would
+            # otherwise come back once per group, and be counted and
+            # paged over as many times.
+            t = servicegroups_table
+            in_groups = sql.select([t.c.service_id]) \
+                           .where(t.c.group_id.in_(filters['groups'])) \
+                           .distinct()
+            sel = sel.where(Service.id.in_(in_groups))
         if 'machines' in filters:
             sel = sel.where(Machine.id.in_(filters['machines']))
         if 'customers' in filters:
@@ -400,11 +570,43 @@ def search_query(swords, filters=None, verbose=False):
             # Search numeric fields too
             orlist += [field == int(word) for field in numfields]
         orword = sql.or_(*orlist)
+        if meta.search_index:
+            indexed = _search_index_match(word)
+            if indexed is not None:
+                if word.isdigit():
+                    indexed = sql.or_(indexed,
+                                      *[field == int(word)
+                                        for field in numfields])
+                # Check the indexed candidates first, it avoids running
+                # the ilike() on every row.
+                orword = sql.and_(indexed, orword)
         andlist.append(orword)
 
-    sel = sel.where(sql.and_(*andlist))
+    return sel.where(sql.and_(*andlist))
+
 
-    sel = sel.order_by(Machine.name, Service.url)
+def search_query(swords, filters=None, verbose=False, limit=None, offset=None):
+    """Search customers, machines and services for all of swords.
+
+    One row is returned per service, and per machine or customer without
+    services.  limit and offset select a page of those rows.
+    """
+    sel = _search_select(swords, filters)
+
+    # Ordered up to the IDs, so that pages don't overlap.
+    sel = sel.order_by(Machine.name, Service.url, Customer.id, Machine.id,
+                       Service.id)
+    if offset:
+        sel = sel.offset(offset)
+    if limit is not None:
+        sel = sel.limit(limit)
 
     return meta.Session.execute(sel)
 
+
+def search_count(swords, filters=None):
+    """Count the rows search_query() would return without limit"""
+    sel = _search_select(swords, filters).alias('search')
+    return meta.Session.execute(sql.select([sql.func.count()])
+                                   .select_from(sel)).scalar()
+
@@ -30,6 +30,9 @@ engine = None
 # SQLAlchemy session manager.  Updated by model.init_model().
 Session = None
 
+# Maintain and use the search_index table.  Updated by model.init_model().
+search_index = False
+
 # Global metadata. If you have multiple databases with overlapping table 
 # names, you'll need a metadata for each database.
 metadata = MetaData()
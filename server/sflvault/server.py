@@ -9,19 +9,52 @@ import logging
 import logging.config
 import argparse
 import socket
+import select
+import signal
+import threading
+import time
+import zlib
+import Queue
+import xmlrpclib
 
 import transaction
 from sqlalchemy import engine_from_config
 from OpenSSL import SSL
+from Crypto import Random
 
+import sflvault.common.crypto
+from sflvault.common import jsonrpc
 import sflvault.model
+import sflvault.views
+import sflvault.lib.cryptopool
+import sflvault.lib.keypool
+import sflvault.lib.pubkeys
+from sflvault.lib import metrics
 from sflvault.views import XMLRPCDispatcher
+from sflvault.lib.sessions import session_store_from_settings
+from sflvault.lib.sessions import MemorySessionStore
+from sflvault.lib.cryptopool import CryptoPool
+from sflvault.lib.keypool import KeyPool
+from sflvault.lib.pubkeys import PubkeyCache
 
 log = logging.getLogger(__name__)
 
+def gzip_encode(data, level=6):
+    """Like xmlrpclib.gzip_encode(), with a faster compression level"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def gzip_decode(data):
+    """Like xmlrpclib.gzip_decode(), which is missing before Python 2.7"""
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
 # SSL handling based on http://code.activestate.com/recipes/496786-simple-xml-rpc-server-over-https/
 
 class SFLvaultRequestHandler(SimpleXMLRPCRequestHandler):
+    # SimpleXMLRPCRequestHandler's default, which it lacks before Python 2.7
+    encode_threshold = 1400
 
     def __init__(self, request, client_address, server):
         self.client_address = client_address
@@ -31,8 +64,143 @@ class SFLvaultRequestHandler(SimpleXMLRPCRequestHandler):
         self.connection = self.request
         self.rfile = socket._fileobject(self.request, "rb", self.rbufsize)
         self.wfile = socket._fileobject(self.request, "wb", self.wbufsize)
+        # Gzip the responses above that size, 0 never to
+        self.encode_threshold = getattr(self.server, 'gzip_threshold',
+                                        self.encode_threshold)
+        # Answer in HTTP/1.1 to keep the connection open, see handle()
+        self.keepalive = getattr(self.server, 'keepalive', 0)
+        if self.keepalive:
+            self.protocol_version = 'HTTP/1.1'
+
+    def handle(self):
+        """Serve the requests of the connection, until the client closes
+        it or leaves it idle for sflvault.server.keepalive seconds."""
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection and self._wait_for_request():
+            try:
+                self.handle_one_request()
+            except (SSL.ZeroReturnError, SSL.SysCallError, socket.error):
+                # The client went away between two requests
+                break
+
+    def _wait_for_request(self):
+        pending = getattr(self.connection, 'pending', None)
+        if pending is not None and pending():
+            # Already decrypted by OpenSSL, select() wouldn't see it
+            return True
+        try:
+            readable = select.select([self.connection], [], [],
+                                     self.keepalive)[0]
+        except (select.error, socket.error):
+            return False
+        return bool(readable)
+
+    def end_headers(self):
+        if getattr(self.server, 'jsonrpc', False):
+            # Tell the clients they can use JSON-RPC instead
+            self.send_header(jsonrpc.JSONRPC_HEADER, jsonrpc.JSONRPC_PATH)
+        if self.encode_threshold:
+            # and that they can gzip their requests (RFC 7694)
+            self.send_header("Accept-Encoding", "gzip")
+        SimpleXMLRPCRequestHandler.end_headers(self)
+
+    def do_POST(self):
+        """Handle an XML-RPC call, or a JSON-RPC one on JSONRPC_PATH"""
+        use_jsonrpc = self.path == jsonrpc.JSONRPC_PATH and \
+                      getattr(self.server, 'jsonrpc', False)
+        if not use_jsonrpc and not self.is_rpc_path_valid():
+            self.report_404()
+            return
+
+        data = self.decode_request_content(
+            self.rfile.read(int(self.headers["content-length"])))
+        if data is None:
+            return # response has been sent
+
+        if use_jsonrpc:
+            self.send_rpc_response(self._jsonrpc_dispatch(data),
+                                   "application/json")
+            return
+        try:
+            response = self.server._marshaled_dispatch(data, self._dispatch,
+                                                       self.path)
+        except Exception:
+            # As SimpleXMLRPCRequestHandler.do_POST() does
+            self.send_response(500)
+            self.send_header("Content-length", "0")
+            self.end_headers()
+        else:
+            self.send_rpc_response(response, "text/xml")
+
+    def _jsonrpc_dispatch(self, data):
+        """Return the JSON-RPC response to the call in `data`"""
+        id = None
+        try:
+            method, params, id = jsonrpc.loads_request(data)
+            return jsonrpc.dumps_response(self._dispatch(method, params), id)
+        except xmlrpclib.Fault, fault:
+            return jsonrpc.dumps_fault(fault, id)
+        except:
+            # As SimpleXMLRPCDispatcher._marshaled_dispatch() does
+            exc_type, exc_value = sys.exc_info()[:2]
+            return jsonrpc.dumps_fault(
+                xmlrpclib.Fault(1, "%s:%s" % (exc_type, exc_value)), id)
+
+    def send_rpc_response(self, response, content_type):
+        """Send the response, gzipped above sflvault.server.gzip_threshold
+        bytes if the client accepts it"""
+        self.send_response(200)
+        self.send_header("Content-type", content_type)
+        if self.encode_threshold and len(response) > self.encode_threshold \
+           and self._accepts_gzip():
+            start = time.time()
+            compressed = gzip_encode(response)
+            metrics.timing('gzip.compress', time.time() - start)
+            metrics.incr('gzip.response_bytes_saved',
+                         len(response) - len(compressed))
+            response = compressed
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def _accepts_gzip(self):
+        """Whether the client takes gzipped responses"""
+        if sys.version_info < (2, 7):
+            # accept_encodings() is missing before Python 2.7, don't gzip
+            return False
+        return self.accept_encodings().get("gzip", 0)
+
+    def decode_request_content(self, data):
+        """Gunzip the request if needed, as SimpleXMLRPCRequestHandler does
+        from Python 2.7 on.  Returns None once an error has been sent."""
+        encoding = self.headers.get("content-encoding", "identity").lower()
+        if encoding == "identity":
+            return data
+        if encoding == "gzip":
+            start = time.time()
+            try:
+                decoded = gzip_decode(data)
+            except zlib.error:
+                self.send_response(400, "error decoding gzip content")
+            else:
+                metrics.timing('gzip.decompress', time.time() - start)
+                metrics.incr('gzip.request_bytes_saved',
+                             len(decoded) - len(data))
+                return decoded
+        else:
+            self.send_response(501, "encoding %r not supported" % encoding)
+        self.send_header("Content-length", "0")
+        self.end_headers()
 
     def _dispatch(self, method, params):
+        if method == 'system.multicall':
+            return self._multicall(*params)
+        if method in self.server.funcs:
+            # The other introspection functions
+            return self.server.funcs[method](*params)
+
         address = self.client_address
 
         request = {
@@ -42,7 +210,35 @@ class SFLvaultRequestHandler(SimpleXMLRPCRequestHandler):
             'settings': SFLvaultServer.settings,
         }
 
-        return self.server.instance._dispatch(request, method, params)
+        try:
+            return self.server.instance._dispatch(request, method, params)
+        finally:
+            # Don't leak a transaction or a DB session to the next request
+            # handled by this thread.
+            transaction.abort()
+            sflvault.model.meta.Session.remove()
+
+    def _multicall(self, calls):
+        """system.multicall, each call being dispatched, and authenticated
+        with its own authtok, on its own.
+
+        Returns, for each call, [its result] or a fault struct."""
+        results = []
+        for call in calls:
+            try:
+                if call['methodName'] == 'system.multicall':
+                    raise ValueError("system.multicall can't be nested")
+                results.append([self._dispatch(call['methodName'],
+                                               tuple(call['params']))])
+            except xmlrpclib.Fault, fault:
+                results.append({'faultCode': fault.faultCode,
+                                'faultString': fault.faultString})
+            except:
+                exc_type, exc_value = sys.exc_info()[:2]
+                results.append({'faultCode': 1,
+                                'faultString': "%s:%s" % (exc_type,
+                                                          exc_value)})
+        return results
 
     rpc_paths = ('/vault', '/vault/rpc', '/',)
 
@@ -59,6 +255,10 @@ class SecureXMLRPCServer(HTTPServer, SimpleXMLRPCDispatcher):
         ctx = SSL.Context(SSL.SSLv23_METHOD)
         ctx.use_privatekey_file(keyfile)
         ctx.use_certificate_file(certfile)
+        # Let the clients that reconnect resume their TLS session, rather
+        # than doing a full handshake again.  OpenSSL caches the server
+        # sessions by default, it only needs a session id context.
+        ctx.set_session_id('sflvault')
         self.socket = SSL.Connection(ctx, socket.socket(self.address_family, self.socket_type))
         self.server_bind()
         self.server_activate()
@@ -74,6 +274,45 @@ class SecureXMLRPCServer(HTTPServer, SimpleXMLRPCDispatcher):
             pass #some platforms may raise ENOTCONN here
         self.close_request(request)
 
+class WorkerPoolMixIn:
+    """Handle each request in one of a fixed pool of worker threads.
+
+    Call start_workers() before serving.  When all workers are busy,
+    accepted requests wait in a bounded queue, and then the listening
+    socket's backlog.
+    """
+    workers = 10
+
+    def start_workers(self, workers=None):
+        if workers:
+            self.workers = int(workers)
+        self.requests_queue = Queue.Queue(self.workers)
+        for i in range(self.workers):
+            t = threading.Thread(target=self.process_request_worker,
+                                 name="sflvault-worker-%d" % i)
+            t.setDaemon(True)
+            t.start()
+
+    def process_request_worker(self):
+        while True:
+            request, client_address = self.requests_queue.get()
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self.requests_queue.put((request, client_address))
+
+
+class ThreadedXMLRPCServer(WorkerPoolMixIn, SimpleXMLRPCServer):
+    pass
+
+class ThreadedSecureXMLRPCServer(WorkerPoolMixIn, SecureXMLRPCServer):
+    pass
+
+
 class SFLvaultServer(object):
 
     def __init__(self, config_file_name):
@@ -82,15 +321,32 @@ class SFLvaultServer(object):
 
         self.start_sqlalchemy()
         self.initialize_models()
+        self.initialize_sessions()
+        self.initialize_crypto()
         self.create_admin_if_necessary()
         self.initialize_server()
         
     def get_settings(self, config_file_name=None):
         result = {
             'sflvault.vault.session_timeout': '15',
+            'sflvault.vault.session_renew': 'false',
             'sflvault.vault.setup_timeout': '300',
+            'sflvault.vault.search_index': 'false',
+            'sflvault.vault.crypto_workers': '0',
+            'sflvault.vault.keypool_size': '0',
+            'sflvault.vault.group_key_algorithm': 'elgamal',
+            'sflvault.vault.pubkey_cache_size': '1000',
+            'sflvault.vault.pubkey_cache_warm': 'false',
+            'sflvault.vault.longmsg_version': '1',
+            'sflvault.vault.fixedbase_cache_size': '0',
+            'sflvault.vault.bigint_backend': 'auto',
             'sflvault.host': 'localhost',
             'sflvault.port': '5000',
+            'sflvault.server.mode': 'single',
+            'sflvault.server.workers': '10',
+            'sflvault.server.keepalive': '0',
+            'sflvault.server.jsonrpc': 'true',
+            'sflvault.server.gzip_threshold': '1400',
             'sqlalchemy.url': 'sqlite:///%s/sflvault.db' % os.getcwd()
         }
         if config_file_name:
@@ -104,8 +360,41 @@ class SFLvaultServer(object):
                                     'sqlalchemy.')
 
     def initialize_models(self):
-        sflvault.model.init_model(self.engine)
+        search_index = SFLvaultServer.settings['sflvault.vault.search_index']
+        sflvault.model.init_model(self.engine,
+            search_index=search_index.lower() in ['1', 'true', 't'])
         sflvault.model.meta.metadata.create_all(self.engine)
+        if sflvault.model.meta.search_index:
+            log.info("Rebuilding the search index")
+            sflvault.model.search_index_rebuild()
+            transaction.commit()
+
+    def initialize_sessions(self):
+        sflvault.views.session_store = session_store_from_settings(
+            SFLvaultServer.settings, self.engine)
+
+    def initialize_crypto(self):
+        sflvault.common.crypto.LONGMSG_VERSION = int(
+            SFLvaultServer.settings['sflvault.vault.longmsg_version'])
+        sflvault.common.crypto.FIXEDBASE_CACHE_SIZE = int(
+            SFLvaultServer.settings['sflvault.vault.fixedbase_cache_size'])
+        backend = SFLvaultServer.settings['sflvault.vault.bigint_backend']
+        sflvault.common.crypto.BIGINT_BACKEND = backend
+        if backend == 'gmpy2' and \
+           sflvault.common.crypto.bigint_backend() != 'gmpy2':
+            log.warning("gmpy2 is not installed, using Python longs")
+        sflvault.lib.cryptopool.pool = CryptoPool(
+            SFLvaultServer.settings['sflvault.vault.crypto_workers'])
+        sflvault.lib.keypool.pool = KeyPool(
+            SFLvaultServer.settings['sflvault.vault.keypool_size'],
+            SFLvaultServer.settings['sflvault.vault.group_key_algorithm'])
+        sflvault.lib.pubkeys.cache = PubkeyCache(
+            SFLvaultServer.settings['sflvault.vault.pubkey_cache_size'])
+        warm = SFLvaultServer.settings['sflvault.vault.pubkey_cache_warm']
+        if warm.lower() in ['1', 'true', 't']:
+            log.info("Loading the public keys of all users and groups")
+            sflvault.lib.pubkeys.cache.warm(sflvault.model.pubkeys_list())
+            transaction.commit()
 
     def create_admin_if_necessary(self):
         if not sflvault.model.query(sflvault.model.User).filter_by(username='admin').first():
@@ -127,9 +416,18 @@ class SFLvaultServer(object):
         address = (host, port)
         keyfile = SFLvaultServer.settings.get('sflvault.keyfile')
         certfile = SFLvaultServer.settings.get('sflvault.certfile')
+        mode = SFLvaultServer.settings['sflvault.server.mode']
+        workers = int(SFLvaultServer.settings['sflvault.server.workers'])
+        if mode not in ('single', 'threaded', 'prefork'):
+            raise ValueError("Invalid sflvault.server.mode: %s" % mode)
+        threaded = (mode == 'threaded')
+
         if keyfile and certfile:
             log.info("Starting in SSL mode")
-            self.server = SecureXMLRPCServer(
+            server_class = SecureXMLRPCServer
+            if threaded:
+                server_class = ThreadedSecureXMLRPCServer
+            self.server = server_class(
                 address,
                 requestHandler=SFLvaultRequestHandler,
                 keyfile=keyfile,
@@ -139,22 +437,114 @@ class SFLvaultServer(object):
             )
         else:
             log.info("Starting in insecure mode")
-            self.server = SimpleXMLRPCServer(
+            server_class = SimpleXMLRPCServer
+            if threaded:
+                server_class = ThreadedXMLRPCServer
+            self.server = server_class(
                 address,
                 requestHandler=SFLvaultRequestHandler,
                 logRequests=False,
                 allow_none=True,
             )
+        # Seconds to keep idle connections open, 0 to close them after
+        # each request
+        keepalive = float(SFLvaultServer.settings['sflvault.server.keepalive'])
+        if keepalive and not threaded:
+            # One idle client would keep all the others waiting
+            log.warning("sflvault.server.keepalive needs "
+                        "sflvault.server.mode = threaded, ignoring it")
+            keepalive = 0
+        elif keepalive:
+            log.info("Keeping idle connections open for %g seconds, each "
+                     "holds one of the %d worker threads" % (keepalive,
+                                                             workers))
+        self.server.keepalive = keepalive
+        # Serve JSON-RPC too, see sflvault.common.jsonrpc
+        self.server.jsonrpc = SFLvaultServer.settings[
+            'sflvault.server.jsonrpc'].lower() in ['1', 'true', 't']
+        self.server.gzip_threshold = int(
+            SFLvaultServer.settings['sflvault.server.gzip_threshold'])
         self.server.register_introspection_functions()
+        # Dispatched by SFLvaultRequestHandler._multicall()
+        self.server.register_multicall_functions()
         self.server.register_instance(dispatcher)
 
+        if threaded:
+            log.info("Serving requests with %d worker threads" % workers)
+            self.server.start_workers(workers)
+        elif mode == 'prefork':
+            log.info("Serving requests with %d worker processes" % workers)
+            if isinstance(sflvault.views.session_store, MemorySessionStore):
+                log.warning("Sessions are not shared between worker "
+                            "processes, use: sflvault.vault.session_store "
+                            "= sql")
+
     def _create_request_dispatcher(self):
         dispatcher = XMLRPCDispatcher()
         dispatcher.scan(sflvault.views)
         return dispatcher
 
     def start_server(self):
-        self.server.serve_forever()
+        if SFLvaultServer.settings['sflvault.server.mode'] == 'prefork':
+            self._serve_prefork(
+                int(SFLvaultServer.settings['sflvault.server.workers']))
+        else:
+            sflvault.lib.keypool.pool.start()
+            self.server.serve_forever()
+
+    def _serve_prefork(self, workers):
+        """Fork `workers` processes, all accepting requests on the already
+        bound listening socket, and replace the ones that exit."""
+        # Each process fills its own key pool, share the configured size
+        # between them rather than generating workers times as many keys.
+        pool = sflvault.lib.keypool.pool
+        if pool.size > 0:
+            pool.size = max(1, (pool.size + workers - 1) // workers)
+
+        children = {}
+        for i in range(workers):
+            children[self._fork_worker()] = time.time()
+
+        def terminate(signum, frame):
+            raise SystemExit()
+        signal.signal(signal.SIGTERM, terminate)
+
+        try:
+            while children:
+                pid, status = os.wait()
+                started = children.pop(pid, None)
+                if started is None:
+                    continue
+                log.warning("Worker process %d exited (status %d), "
+                            "restarting it" % (pid, status))
+                if time.time() - started < 1:
+                    # Don't spin if the workers die on startup
+                    time.sleep(1)
+                children[self._fork_worker()] = time.time()
+        finally:
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+    def _fork_worker(self):
+        """Fork a process serving requests until it's killed, return its
+        pid in the parent"""
+        pid = os.fork()
+        if pid == 0:
+            # Child: don't share the parent's database connections,
+            # nor its random number generator state.
+            try:
+                self.engine.dispose()
+                Random.atfork()
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                sflvault.lib.keypool.pool.start()
+                self.server.serve_forever()
+            finally:
+                os._exit(0)
+        return pid
 
     def get_dict_for_config_section(self, config, section):
         my_dict = {} 
@@ -0,0 +1,159 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import tempfile
+import threading
+import time
+
+from unittest import TestCase
+
+from sflvault.tests import TestController
+from sflvault.common.crypto import *
+from sflvault.client.client import SFLvaultClient
+from sflvault.client.agent import Agent, AgentServer, AgentClient, \
+     AgentError, AGENT_SOCK_ENV
+
+
+class TestAgentState(TestCase):
+
+    def setUp(self):
+        self.key = generate_elgamal_keypair()
+        self.agent = Agent(self.key, 'admin', 'http://vault/rpc')
+
+    def test_challenge(self):
+        rnd = randfunc(32)
+        cryptok = serial_elgamal_msg(elgamal_encrypt(self.key, rnd,
+                                                     randfunc(32)))
+        response = self.agent.handle({'op': 'challenge', 'cryptok': cryptok})
+        self.assertEquals(b64decode(response['token']), rnd)
+
+    def test_symkeys(self):
+        groupkey = generate_elgamal_keypair()
+        grouppacked = serial_privkey(groupkey)
+        cryptgroupkey = encrypt_longmsg(self.key, grouppacked)
+        symkeys = [encrypt_secret('secret')[0] for x in range(2)]
+        cryptsymkeys = [encrypt_longmsg(groupkey, symkeys[0]),
+                        wrap_symkey(group_wrapkey(grouppacked), symkeys[1])]
+        response = self.agent.handle({'op': 'symkeys', 'group_id': 1,
+                                      'cryptgroupkey': cryptgroupkey,
+                                      'cryptsymkeys': cryptsymkeys})
+        self.assertEquals(response['symkeys'], symkeys)
+        self.assertEquals(len(self.agent.groupkeys), 1)
+
+    def test_group_ops(self):
+        """ Group keys are used by the agent, never given out """
+        groupkey = generate_elgamal_keypair()
+        grouppacked = serial_privkey(groupkey)
+        cryptgroupkey = encrypt_longmsg(self.key, grouppacked)
+        response = self.agent.handle({'op': 'groupkey', 'group_id': 1,
+                                      'cryptgroupkey': cryptgroupkey})
+        self.assertTrue('error' in response)
+
+        symkey = encrypt_secret('secret')[0]
+        response = self.agent.handle({'op': 'wrap_symkey', 'group_id': 1,
+                                      'cryptgroupkey': cryptgroupkey,
+                                      'symkey': symkey})
+        self.assertEquals(unwrap_symkey(group_wrapkey(grouppacked),
+                                        response['cryptsymkey']), symkey)
+
+        member = generate_elgamal_keypair()
+        response = self.agent.handle({'op': 'groupkey_for', 'group_id': 1,
+                                      'cryptgroupkey': cryptgroupkey,
+                                      'pubkey': serial_pubkey(member)})
+        self.assertEquals(decrypt_longmsg(member, response['cryptgroupkey']),
+                          grouppacked)
+
+    def test_lock(self):
+        self.agent.handle({'op': 'authtok_set', 'authtok': 'tok'})
+        self.assertEquals(self.agent.handle({'op': 'lock'}), {})
+        self.assertTrue(self.agent.handle({'op': 'status'})['locked'])
+        self.assertTrue('error' in self.agent.handle({'op': 'authtok_get'}))
+        self.assertTrue('error' in self.agent.handle({'op': 'nothing'}))
+
+    def test_lifetime(self):
+        agent = Agent(self.key, 'admin', 'http://vault/rpc', lifetime=1)
+        self.assertFalse(agent.locked())
+        agent.expires = time.time() - 1
+        self.assertTrue(agent.locked())
+        self.assertEquals(agent.privkey, None)
+
+
+class TestAgent(TestController):
+
+    def setUp(self):
+        self.vault = self.getVault()
+        privkey = unserial_privkey(decrypt_privkey(
+            self.vault.cfg.get('SFLvault', 'key'), 'test'))
+        self.path = tempfile.mktemp()
+        self.server = AgentServer(self.path,
+                                  Agent(privkey, 'admin',
+                                        self.vault.cfg.get('SFLvault', 'url')))
+        t = threading.Thread(target=self.server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        TestController.tearDown(self)
+
+    def test_client(self):
+        """ Commands use the agent instead of asking the passphrase """
+        gid = self.vault.group_add(u'agent_group')['group_id']
+        cid = self.vault.customer_add(u'Agent customer')['customer_id']
+        mid = self.vault.machine_add(cid, 'agent', 'agent.example.com',
+                                     '10.0.0.5', None, None)['machine_id']
+        sid = self.vault.service_add(mid, 0, u'ssh://agent@example.com',
+                                     [gid], 'agent secret', '')['service_id']
+
+        os.environ[AGENT_SOCK_ENV] = self.path
+        try:
+            vault = SFLvaultClient(self.vault.cfg.config_file)
+        finally:
+            del(os.environ[AGENT_SOCK_ENV])
+        def nopass():
+            raise AssertionError("Passphrase asked")
+        vault.set_getpassfunc(nopass)
+
+        self.assertEquals(vault.service_get(sid)['plaintext'],
+                          'agent secret')
+        self.assertEquals(vault.service_get_tree(sid)[-1]['plaintext'],
+                          'agent secret')
+        self.assertEquals(self.server.agent.authtok, vault.authtok)
+
+        # Wrapped by the agent
+        vault.wrap_symkeys = True
+        sid = vault.service_add(mid, 0, u'ssh://wrapped@example.com', [gid],
+                                'wrapped secret', '')['service_id']
+        serv = self.vault.vault.service_get(self.vault.authtok,
+                                            sid)['service']
+        self.assertTrue(serv['cryptsymkey'].startswith(GROUP_WRAP_PREFIX))
+        self.assertEquals(vault.service_get(sid)['plaintext'],
+                          'wrapped secret')
+        self.assertEquals(len(self.server.agent.groupkeys), 1)
+        self.assertFalse(hasattr(vault, 'privkey'))
+
+        # Falls back on the passphrase once locked
+        AgentClient(self.path).call('lock')
+        self.assertRaises(AssertionError, vault.service_get, sid)
+        self.assertRaises(AgentError, AgentClient(self.path).call,
+                          'challenge', cryptok='')
@@ -0,0 +1,317 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing
+from unittest import TestCase
+
+from nose import SkipTest
+
+from sflvault.common import crypto
+from sflvault.common.crypto import *
+
+
+class TestLongMsg(TestCase):
+
+    def setUp(self):
+        # SFLVAULT_IN_TEST gives pre-generated keypairs
+        self.eg = generate_elgamal_keypair()
+        self.groupkey = serial_elgamal_privkey(elgamal_bothkeys(self.eg))
+        self.symkey = encrypt_secret('secret')[0]
+
+    def test_v1(self):
+        for message in [self.groupkey, self.symkey]:
+            cipher = encrypt_longmsg(self.eg, message, version=1)
+            self.assertFalse(cipher.startswith(LONGMSG_V2_PREFIX))
+            self.assertEquals(decrypt_longmsg(self.eg, cipher), message)
+
+    def test_v2(self):
+        for message in [self.groupkey, self.symkey, '', '\x00' * 16]:
+            cipher = encrypt_longmsg(self.eg, message, version=2)
+            self.assertTrue(cipher.startswith(LONGMSG_V2_PREFIX))
+            # One ElGamal operation only
+            self.assertFalse('&' in cipher)
+            self.assertEquals(decrypt_longmsg(self.eg, cipher), message)
+            # As read from the database
+            self.assertEquals(decrypt_longmsg(self.eg, unicode(cipher)),
+                              message)
+
+    def test_default_version(self):
+        default = crypto.LONGMSG_VERSION
+        try:
+            crypto.LONGMSG_VERSION = 2
+            cipher = encrypt_longmsg(self.eg, self.symkey)
+            self.assertTrue(cipher.startswith(LONGMSG_V2_PREFIX))
+        finally:
+            crypto.LONGMSG_VERSION = default
+
+    def test_v2_tampered(self):
+        cipher = encrypt_longmsg(self.eg, self.groupkey, version=2)
+        wrapped, payload = cipher[len(LONGMSG_V2_PREFIX):].split('$')
+        payload = b64decode(payload)
+        tampered = payload[:20] + chr(ord(payload[20]) ^ 1) + payload[21:]
+        self.assertRaises(DecryptError, decrypt_longmsg, self.eg,
+                          LONGMSG_V2_PREFIX + wrapped + '$' +
+                          b64encode(tampered))
+        self.assertRaises(DecryptError, decrypt_longmsg, self.eg,
+                          LONGMSG_V2_PREFIX + wrapped)
+
+    def test_constant_time_compare(self):
+        # Used by _aes_open() where hmac.compare_digest() is missing
+        compare = crypto._constant_time_compare
+        self.assertTrue(compare('a' * 32, 'a' * 32))
+        self.assertFalse(compare('a' * 32, 'a' * 31 + 'b'))
+        self.assertFalse(compare('a' * 32, 'a' * 31))
+        original = crypto._compare_digest
+        crypto._compare_digest = compare
+        try:
+            self.test_v2()
+            self.test_v2_tampered()
+        finally:
+            crypto._compare_digest = original
+
+
+class TestLongMsgMany(TestCase):
+
+    def setUp(self):
+        self.eg = generate_elgamal_keypair()
+        self.messages = [encrypt_secret('secret%d' % i)[0] for i in range(7)]
+
+    def test_serial(self):
+        ciphers = list(encrypt_longmsg_many(self.eg, self.messages,
+                                            version=2))
+        self.assertTrue(all(x.startswith(LONGMSG_V2_PREFIX) for x in ciphers))
+        self.assertEquals(list(decrypt_longmsg_many(self.eg, ciphers)),
+                          self.messages)
+
+    def test_workers(self):
+        ciphers = list(encrypt_longmsg_many(self.eg, self.messages,
+                                            workers=2, chunk_size=2))
+        self.assertEquals(list(decrypt_longmsg_many(self.eg, ciphers,
+                                                    workers=2,
+                                                    chunk_size=2)),
+                          self.messages)
+
+        ciphers[5] = ciphers[5][:-8]
+        results = decrypt_longmsg_many(self.eg, ciphers, workers=2,
+                                       chunk_size=2)
+        # The workers are stopped before returning
+        self.assertEquals(multiprocessing.active_children(), [])
+        self.assertEquals([results.next() for x in range(4)],
+                          self.messages[:4])
+        self.assertRaises(DecryptError, list, results)
+
+
+class TestSerial(TestCase):
+
+    def setUp(self):
+        self.eg = generate_elgamal_keypair()
+
+    def test_unchanged(self):
+        # Same output as the PyCrypto long_to_bytes() based version
+        for keys, serial in [(elgamal_bothkeys(self.eg),
+                              serial_elgamal_privkey),
+                             (elgamal_pubkey(self.eg),
+                              serial_elgamal_pubkey)]:
+            self.assertEquals(serial(keys), ':'.join(
+                [b64encode(long_to_bytes(x)) for x in keys]))
+
+    def test_roundtrip(self):
+        keys = elgamal_bothkeys(self.eg)
+        pubkey = elgamal_pubkey(self.eg)
+        msg = self.eg.encrypt('\x00message', randfunc(32))
+        self.assertEquals(unserial_elgamal_privkey(
+                              serial_elgamal_privkey(keys)), keys)
+        # Also as unicode from the database
+        self.assertEquals(unserial_elgamal_pubkey(
+                              unicode(serial_elgamal_pubkey(pubkey))), pubkey)
+        self.assertEquals(unserial_elgamal_msg(serial_elgamal_msg(msg)), msg)
+        self.assertEquals(unserial_elgamal_pubkey('AA==:AQ==:'), (0, 1, 0))
+
+    def test_inconsistent(self):
+        for broken in ['YQ==', 'YQ==:Y']:
+            self.assertRaises(DecryptError, unserial_elgamal_msg, broken)
+
+
+class TestFixedBase(TestCase):
+
+    def setUp(self):
+        self.eg = generate_elgamal_keypair()
+        self.defaults = (crypto.FIXEDBASE_CACHE_SIZE,
+                         crypto.FIXEDBASE_MIN_USES, crypto.BIGINT_BACKEND)
+        crypto._fixedbase_keys.clear()
+        # gmpy2 doesn't need the tables
+        crypto.BIGINT_BACKEND = 'python'
+
+    def tearDown(self):
+        (crypto.FIXEDBASE_CACHE_SIZE,
+         crypto.FIXEDBASE_MIN_USES, crypto.BIGINT_BACKEND) = self.defaults
+        crypto._fixedbase_keys.clear()
+
+    def test_same_ciphertexts(self):
+        crypto.FIXEDBASE_CACHE_SIZE = 2
+        crypto.FIXEDBASE_MIN_USES = 2
+        for K in [randfunc(32), randfunc(32), '\x00', '\xff' * 32,
+                  randfunc(40), 12345L]:
+            for message in ['\x02' + randfunc(64), 42L]:
+                self.assertEquals(elgamal_encrypt(self.eg, message, K),
+                                  self.eg.encrypt(message, K))
+        self.assertTrue(crypto._fixedbase_keys.values()[0][1])
+        cipher = encrypt_longmsg(self.eg, 'message')
+        self.assertEquals(decrypt_longmsg(self.eg, cipher), 'message')
+
+    def test_bounded(self):
+        crypto.FIXEDBASE_CACHE_SIZE = 2
+        crypto.FIXEDBASE_MIN_USES = 1
+        for y in range(2, 5):
+            eg = ElGamal.ElGamalobj()
+            (eg.p, eg.g, eg.y) = (self.eg.p, self.eg.g, y)
+            elgamal_encrypt(eg, 'message', randfunc(32))
+        self.assertEquals(len(crypto._fixedbase_keys), 2)
+
+    def test_disabled(self):
+        crypto.FIXEDBASE_CACHE_SIZE = 0
+        elgamal_encrypt(self.eg, 'message', randfunc(32))
+        self.assertEquals(len(crypto._fixedbase_keys), 0)
+
+
+class TestBigintBackend(TestCase):
+
+    def setUp(self):
+        if crypto.gmpy2 is None:
+            raise SkipTest("gmpy2 is not installed")
+        self.eg = generate_elgamal_keypair()
+        self.default = crypto.BIGINT_BACKEND
+
+    def tearDown(self):
+        crypto.BIGINT_BACKEND = self.default
+
+    def test_same_results(self):
+        K = randfunc(32)
+        results = []
+        for crypto.BIGINT_BACKEND in ['python', 'gmpy2']:
+            cipher = elgamal_encrypt(self.eg, '\x02message', K)
+            results.append((cipher, elgamal_decrypt(self.eg, cipher),
+                            elgamal_encrypt(self.eg, 42L, K),
+                            elgamal_decrypt(self.eg, (3L, 4L))))
+        self.assertEquals(results[0], results[1])
+        self.assertEquals(results[1][1], '\x02message')
+        self.assertEquals(type(results[1][2][0]), long)
+
+    def test_fallback(self):
+        crypto.BIGINT_BACKEND = 'python'
+        self.assertEquals(bigint_backend(), 'python')
+        gmpy2, crypto.gmpy2 = crypto.gmpy2, None
+        try:
+            crypto.BIGINT_BACKEND = 'gmpy2'
+            self.assertEquals(bigint_backend(), 'python')
+            cipher = encrypt_longmsg(self.eg, 'message')
+        finally:
+            crypto.gmpy2 = gmpy2
+        self.assertEquals(bigint_backend(), 'gmpy2')
+        self.assertEquals(decrypt_longmsg(self.eg, cipher), 'message')
+
+    def test_generate(self):
+        eg = crypto._gmpy2_generate(256, randfunc)
+        self.assertEquals(eg.p.bit_length(), 256)
+        self.assertTrue(isinstance(eg.y, long))
+        cipher = elgamal_encrypt(eg, 'message', randfunc(16))
+        self.assertEquals(elgamal_decrypt(eg, cipher), 'message')
+
+
+class TestGroupWrap(TestCase):
+
+    def setUp(self):
+        self.eg = generate_elgamal_keypair()
+        self.groupkey = serial_elgamal_privkey(elgamal_bothkeys(self.eg))
+        self.symkey = encrypt_secret('secret')[0]
+
+    def test_wrap(self):
+        wrapkey = group_wrapkey(self.groupkey)
+        self.assertEquals(group_wrapkey(self.groupkey), wrapkey)
+        cipher = wrap_symkey(wrapkey, self.symkey)
+        self.assertTrue(cipher.startswith(GROUP_WRAP_PREFIX))
+        self.assertEquals(unwrap_symkey(wrapkey, unicode(cipher)),
+                          self.symkey)
+
+    def test_tampered(self):
+        wrapkey = group_wrapkey(self.groupkey)
+        payload = b64decode(wrap_symkey(wrapkey, self.symkey)
+                            [len(GROUP_WRAP_PREFIX):])
+        tampered = payload[:20] + chr(ord(payload[20]) ^ 1) + payload[21:]
+        self.assertRaises(DecryptError, unwrap_symkey, wrapkey,
+                          GROUP_WRAP_PREFIX + b64encode(tampered))
+        self.assertRaises(DecryptError, unwrap_symkey, wrapkey,
+                          encrypt_longmsg(self.eg, self.symkey))
+
+    def test_bad_key(self):
+        self.assertRaises(ValueError, wrap_symkey, 'short', self.symkey)
+
+    def test_check_cryptsymkey(self):
+        wrapped = wrap_symkey(group_wrapkey(self.groupkey), self.symkey)
+        for version in [1, 2]:
+            cipher = encrypt_longmsg(self.eg, self.symkey, version)
+            check_cryptsymkey(cipher)
+            self.assertRaises(ValueError, check_cryptsymkey, cipher,
+                              'x25519')
+        check_cryptsymkey(unicode(wrapped))
+        check_cryptsymkey(wrapped, 'x25519')
+        for junk in ['', 'junk', wrapped[:-4], GROUP_WRAP_PREFIX,
+                     LONGMSG_V2_PREFIX + 'a$b', ECIES_PREFIX + 'AAAA']:
+            self.assertRaises(ValueError, check_cryptsymkey, junk)
+
+
+class TestX25519(TestCase):
+
+    def setUp(self):
+        if x25519 is None:
+            raise SkipTest("cryptography is not installed")
+        self.key = generate_keypair('x25519')
+        self.symkey = encrypt_secret('secret')[0]
+
+    def test_serial(self):
+        pubkey = serial_pubkey(self.key)
+        privkey = serial_privkey(self.key)
+        self.assertEquals(key_algorithm(pubkey), 'x25519')
+        self.assertEquals(key_algorithm(privkey), 'x25519')
+        self.assertFalse(unserial_pubkey(unicode(pubkey)).has_private())
+        self.assertEquals(unserial_privkey(privkey).private, self.key.private)
+        self.assertRaises(ValueError, unserial_pubkey, privkey)
+        self.assertRaises(ValueError, generate_keypair, 'rsa')
+
+    def test_ecies(self):
+        pubkey = unserial_pubkey(serial_pubkey(self.key))
+        cipher = encrypt_longmsg(pubkey, self.symkey, version=1)
+        self.assertTrue(cipher.startswith(ECIES_PREFIX))
+        self.assertEquals(decrypt_longmsg(self.key, unicode(cipher)),
+                          self.symkey)
+        # Not for the public half, another key, or an ElGamal key
+        other = generate_keypair('x25519')
+        eg = generate_elgamal_keypair()
+        for key in [pubkey, other, eg]:
+            self.assertRaises(DecryptError, decrypt_longmsg, key, cipher)
+        self.assertRaises(DecryptError, decrypt_longmsg, self.key,
+                          encrypt_longmsg(eg, self.symkey))
+
+    def test_group_wrapkey(self):
+        wrapkey = group_wrapkey(serial_privkey(self.key))
+        self.assertEquals(unwrap_symkey(wrapkey,
+                                        wrap_symkey(wrapkey, self.symkey)),
+                          self.symkey)
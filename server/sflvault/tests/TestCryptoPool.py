@@ -0,0 +1,65 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from unittest import TestCase
+
+from sflvault.common.crypto import *
+from sflvault.lib.cryptopool import CryptoPool
+
+
+class TestCryptoPool(TestCase):
+
+    def setUp(self):
+        # SFLVAULT_IN_TEST gives pre-generated keypairs
+        self.keys = [generate_elgamal_keypair() for x in range(4)]
+        self.jobs = [(serial_elgamal_pubkey(elgamal_pubkey(eg)),
+                      'message %d' % i)
+                     for i, eg in enumerate(self.keys)]
+
+    def check(self, ciphertexts):
+        self.assertEquals(len(ciphertexts), len(self.jobs))
+        for eg, ciphertext, job in zip(self.keys, ciphertexts, self.jobs):
+            self.assertEquals(decrypt_longmsg(eg, ciphertext), job[1])
+
+    def test_workers(self):
+        pool = CryptoPool(2)
+        try:
+            self.check(pool.encrypt_longmsg_many(self.jobs))
+            self.assertNotEquals(pool._pool, None)
+        finally:
+            pool.close()
+
+    def test_serial(self):
+        pool = CryptoPool(0)
+        self.check(pool.encrypt_longmsg_many(self.jobs))
+        self.assertEquals(pool._pool, None)
+
+        # Too few jobs to use the workers
+        pool = CryptoPool(2, min_jobs=10)
+        self.check(pool.encrypt_longmsg_many(self.jobs))
+        self.assertEquals(pool._pool, None)
+
+    def test_fallback(self):
+        pool = CryptoPool(2)
+        def broken():
+            raise OSError("Cannot fork")
+        pool._get_pool = broken
+        self.check(pool.encrypt_longmsg_many(self.jobs))
@@ -0,0 +1,68 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from unittest import TestCase
+
+from sflvault.common.crypto import *
+from sflvault.lib import metrics
+from sflvault.lib.keypool import KeyPool
+
+
+class TestKeyPool(TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def wait_full(self, pool):
+        for x in range(100):
+            if len(pool) == pool.size:
+                return
+            time.sleep(0.1)
+        self.fail("The key pool wasn't filled")
+
+    def test_pool(self):
+        pool = KeyPool(2)
+        try:
+            pool.start()
+            self.wait_full(pool)
+            self.assertEquals(metrics.snapshot()['keypool.generate.count'], 2)
+
+            keys = [pool.get_keypair() for x in range(2)]
+            for eg in keys:
+                self.assertEquals(decrypt_longmsg(eg,
+                                      encrypt_longmsg(eg, 'message')),
+                                  'message')
+            self.assertEquals(metrics.snapshot()['keypool.hits'], 2)
+            self.assertEquals(metrics.snapshot().get('keypool.misses'), None)
+
+            # And the pool is refilled
+            self.wait_full(pool)
+        finally:
+            pool.close()
+
+    def test_disabled(self):
+        pool = KeyPool(0)
+        pool.start()
+        eg = pool.get_keypair()
+        self.assertTrue(eg.x)
+        self.assertEquals(len(pool), 0)
+        self.assertEquals(metrics.snapshot()['keypool.misses'], 1)
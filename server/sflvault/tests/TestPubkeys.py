@@ -0,0 +1,75 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from unittest import TestCase
+
+from sflvault.common.crypto import *
+from sflvault.lib import metrics
+from sflvault.lib.pubkeys import PubkeyCache
+
+
+class TestPubkeyCache(TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.eg = generate_elgamal_keypair()
+        # Distinct keys, only parsed, never used to encrypt
+        self.pubkeys = [serial_elgamal_pubkey((self.eg.p, self.eg.g, y))
+                        for y in range(2, 6)]
+
+    def test_cache(self):
+        cache = PubkeyCache(2)
+        pubkey = serial_elgamal_pubkey(elgamal_pubkey(self.eg))
+        eg = cache.get(pubkey)
+        self.assertEquals(elgamal_pubkey(eg), elgamal_pubkey(self.eg))
+        self.assertTrue(cache.get(pubkey) is eg)
+        # Also as read from the database
+        self.assertTrue(cache.get(unicode(pubkey)) is eg)
+        self.assertEquals(metrics.snapshot()['pubkeys.hits'], 2)
+        self.assertEquals(metrics.snapshot()['pubkeys.misses'], 1)
+
+    def test_least_recently_used(self):
+        cache = PubkeyCache(2)
+        first = cache.get(self.pubkeys[0])
+        cache.get(self.pubkeys[1])
+        cache.get(self.pubkeys[0])
+        cache.get(self.pubkeys[2])
+        self.assertEquals(len(cache), 2)
+        self.assertTrue(cache.get(self.pubkeys[0]) is first)
+        self.assertEquals(metrics.snapshot()['pubkeys.misses'], 3)
+        cache.get(self.pubkeys[1])
+        self.assertEquals(metrics.snapshot()['pubkeys.misses'], 4)
+
+    def test_warm(self):
+        cache = PubkeyCache(3)
+        cache.warm(self.pubkeys + [None])
+        self.assertEquals(len(cache), 3)
+        for pubkey in self.pubkeys[:3]:
+            self.assertEquals(cache.get(pubkey).y,
+                              unserial_elgamal_pubkey(pubkey)[2])
+        self.assertEquals(metrics.snapshot()['pubkeys.hits'], 3)
+
+    def test_disabled(self):
+        cache = PubkeyCache(0)
+        cache.warm(self.pubkeys)
+        self.assertEquals(len(cache), 0)
+        self.assertFalse(cache.get(self.pubkeys[0]) is
+                         cache.get(self.pubkeys[0]))
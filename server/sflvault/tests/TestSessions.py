@@ -0,0 +1,115 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+
+from sflvault.lib import metrics
+from sflvault.lib.sessions import MemorySessionStore, SQLSessionStore
+from sflvault.lib.sessions import session_store_from_settings
+
+
+def _session(user_id, seconds):
+    return {'username': u'user%d' % user_id,
+            'user_id': user_id,
+            'remote_addr': '127.0.0.1',
+            'timeout': datetime.now() + timedelta(0, seconds)}
+
+
+class SessionStoreTests(object):
+    """Tests shared by all session stores"""
+
+    def test_set_get_delete(self):
+        sess = _session(1, 60)
+        sess['userobj'] = object()
+        self.store.set('tok1', sess)
+
+        got = self.store.get('tok1')
+        self.assertEquals(got['user_id'], 1)
+        self.assertEquals(got['username'], u'user1')
+        # Only plain values are kept
+        self.assertFalse('userobj' in got)
+
+        self.store.delete('tok1')
+        self.assertEquals(self.store.get('tok1'), None)
+
+    def test_sweep(self):
+        self.store.set('expired', _session(1, -10))
+        self.store.set('valid', _session(2, 60))
+        self.assertEquals(self.store.sweep(), 1)
+        self.assertEquals(len(self.store), 1)
+        self.assertEquals(self.store.get('expired'), None)
+
+    def test_max_sessions(self):
+        self.store.max_sessions = 2
+        self.store.set('tok1', _session(1, 10))
+        time.sleep(0.01)
+        self.store.set('tok2', _session(2, 30))
+        time.sleep(0.01)
+        # Still in use, though closest to expiry
+        self.store.get('tok1')
+        time.sleep(0.01)
+        before = metrics.snapshot().get('sessions.evicted', 0)
+        self.store.set('tok3', _session(3, 20))
+        self.assertEquals(len(self.store), 2)
+        # The least recently used was dropped
+        self.assertEquals(self.store.get('tok2'), None)
+        self.assertEquals(self.store.get('tok1')['user_id'], 1)
+        self.assertEquals(metrics.snapshot()['sessions.evicted'], before + 1)
+
+
+class TestMemorySessionStore(SessionStoreTests, TestCase):
+    def setUp(self):
+        self.store = MemorySessionStore()
+
+
+class TestSQLSessionStore(SessionStoreTests, TestCase):
+    def setUp(self):
+        self.store = SQLSessionStore(create_engine('sqlite://'))
+        self.store.touch_interval = 0
+
+    def test_shared_between_stores(self):
+        """ Two stores on the same database see the same sessions """
+        other = SQLSessionStore(self.store.engine)
+        self.store.set('tok1', _session(1, 60))
+        self.assertEquals(other.get('tok1')['user_id'], 1)
+
+    def test_old_table(self):
+        """ A sessions table without last_used is recreated """
+        engine = self.store.engine
+        engine.execute("DROP TABLE sessions")
+        engine.execute("CREATE TABLE sessions (authtok VARCHAR(64) "
+                       "PRIMARY KEY, username VARCHAR(50), user_id INTEGER, "
+                       "remote_addr VARCHAR(100), timeout DATETIME)")
+        store = SQLSessionStore(engine)
+        store.set('tok1', _session(1, 60))
+        self.assertEquals(store.get('tok1')['user_id'], 1)
+
+    def test_from_settings(self):
+        store = session_store_from_settings({
+            'sflvault.vault.session_store': 'sql',
+            'sflvault.vault.session_store.url': 'sqlite://',
+            'sflvault.vault.session_store.max': '5'})
+        self.assertTrue(isinstance(store, SQLSessionStore))
+        self.assertEquals(store.max_sessions, 5)
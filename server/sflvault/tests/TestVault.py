@@ -22,14 +22,19 @@
 from sflvault.tests import TestController
 
 from sflvault.common.crypto import *
+from sflvault.common import crypto
 from sflvault.common import VaultError
 
 from sflvault.client.client import authenticate
 from sflvault.client.client import SFLvaultConfig, SFLvaultClient
+from sflvault.client.migrate import Checkpoint
 
 import logging
+import os
 import random
 
+from nose import SkipTest
+
 log = logging.getLogger('tester')
 
 class TestVaultController(TestController):
@@ -378,6 +383,98 @@ class TestVaultController(TestController):
 
         self.assertTrue(len(search2['results'].items()) ==1)        
                               
+    def test_search_index(self):
+        """ The search index gives the same results as a full scan, and
+        follows additions, changes and deletions """
+        from sflvault import model
+        from sflvault.model import meta
+        import transaction
+        meta.search_index = True
+        try:
+            # As on startup with sflvault.vault.search_index
+            model.search_index_rebuild()
+            transaction.commit()
+            self._check_search_index()
+        finally:
+            meta.search_index = False
+
+    def _check_search_index(self):
+        from sflvault.model import meta
+        cres = self.vault.customer_add(u"Indexed Cústomer")
+        mres = self.vault.machine_add(str(cres['customer_id']),
+                                      "Indexed machine",
+                                      "indexed.example.com",
+                                      '10.9.8.7',
+                                      u"Datacenter Montréal",
+                                      "rack 12")
+        sres = self.vault.service_add(mres['machine_id'], 0,
+                                      u'ssh://root@indexed.example.com',
+                                      [], 'test', 'Backup notes')
+
+        def search(query):
+            results = {}
+            for indexed in [True, False]:
+                meta.search_index = indexed
+                try:
+                    results[indexed] = self.vault.search(query,
+                                                         verbose=False)
+                finally:
+                    meta.search_index = True
+            self.assertEquals(results[True]['results'],
+                              results[False]['results'])
+            return results[True]['results']
+
+        for query in [u'cústomer', u'montr', u'ROOT@', u'kup', u'rack 12',
+                      u'10.9.8', str(sres['service_id']), u'ck no',
+                      u'indexed', u'in%ed', u'xyz']:
+            search([query])
+        self.assertEquals(len(search([u'montréal', u'backup'])), 1)
+        self.assertEquals(search([u'xyz']), {})
+
+        self.vault.machine_put(mres['machine_id'], {'location': u'Québec'})
+        self.assertEquals(search([u'montr']), {})
+        self.assertEquals(len(search([u'québ'])), 1)
+
+        self.vault.service_del(sres['service_id'])
+        self.assertEquals(search([u'backup']), {})
+        self.vault.customer_del(cres['customer_id'])
+        self.assertEquals(search([u'indexed']), {})
+
+    def test_search_pages(self):
+        """ Search results can be loaded one page at a time """
+        cres = self.vault.customer_add(u"Paged customer")
+        mres = self.vault.machine_add(str(cres['customer_id']),
+                                      "Paged machine", "paged.example.com",
+                                      '10.0.0.1', None, None)
+        services = []
+        for i in range(5):
+            sres = self.vault.service_add(mres['machine_id'], 0,
+                                          u'ssh://paged%d@example.com' % i,
+                                          [], 'test', '')
+            services.append(str(sres['service_id']))
+
+        everything = self.vault.search([u'paged'], verbose=False)
+        self.assertEquals(everything['total'], 5)
+
+        found = []
+        for offset in range(0, 6, 2):
+            page = self.vault.search([u'paged'], verbose=False, limit=2,
+                                     offset=offset)
+            self.assertEquals(page['total'], 5)
+            self.assertEquals(page['limit'], 2)
+            machines = page['results'][str(cres['customer_id'])]['machines']
+            found += machines[str(mres['machine_id'])]['services'].keys()
+        self.assertEquals(sorted(found), sorted(services))
+
+        # Without a limit, and past the end
+        for offset in [3, 10]:
+            page = self.vault.search([u'paged'], verbose=False,
+                                     offset=offset)
+            self.assertEquals(page['total'], 5)
+
+        self.assertRaises(VaultError, self.vault.search, [u'paged'],
+                          verbose=False, limit=-1)
+
     def test_search_fail_on_invalid_filters(self):
         """ When an invalid filter value is specified, it should fail """
         self.assertRaises(VaultError,
@@ -436,6 +533,21 @@ class TestVaultController(TestController):
 
         self.assertEquals(len(search2['results']), 2)
 
+    def test_search_groups_filter_no_duplicates(self):
+        """ A service in several of the filtered groups is found once """
+        mid = self._add_new_machine()
+        gid1 = self._add_new_group()['group_id']
+        gid2 = self._add_new_group()['group_id']
+        sres = self.vault.service_add(mid['machine_id'], 0,
+                                      u'ssh://twogroups@example.com',
+                                      [gid1, gid2], 'secret')
+        for limit in [None, 1]:
+            search = self.vault.search([u'twogroups'],
+                                       filters={'groups': [gid1, gid2]},
+                                       limit=limit)
+            self.assertEquals(search['total'], 1)
+        self.vault.service_del(sres['service_id'])
+
 
     def test_user_del(self):
         """testing delete a user from the vault"""
@@ -774,3 +886,595 @@ class TestVaultController(TestController):
         machine_list3 = machine_list_response3['list']
         self.assertEquals(len(machine_list3), 0)
 
+
+    def test_service_get_caches_groupkey(self):
+        """ Decrypted group keys are kept in the client's cache and
+        wiped along with the private key """
+        service = self._add_new_service()
+        self.vault.groupkeys.clear()
+
+        response = self.vault.service_get(service['service_id'])
+        self.assertEquals(response['plaintext'], 'secret')
+        self.assertEquals(len(self.vault.groupkeys), 1)
+        self.assertTrue(self.vault.groupkeys.get(response['group_id'],
+                                                 response['cryptgroupkey']))
+
+        # Second time around, the cached groupkey is used
+        response2 = self.vault.service_get(service['service_id'])
+        self.assertEquals(response2['plaintext'], 'secret')
+        self.assertEquals(len(self.vault.groupkeys), 1)
+
+        self.vault.forget_privkey()
+        self.assertEquals(len(self.vault.groupkeys), 0)
+        self.assertFalse(hasattr(self.vault, 'privkey'))
+
+    def test_groupkey_cache_eviction(self):
+        """ The group keys cache is bounded, and expires its entries """
+        from sflvault.client.utils import GroupKeyCache
+        cache = GroupKeyCache(size=2, ttl=600)
+        cache.set(1, 'crypt1', 'plain1')
+        cache.set(2, 'crypt2', 'plain2')
+        self.assertEquals(cache.get(1, 'crypt1'), 'plain1')
+        cache.set(3, 'crypt3', 'plain3')
+
+        # g#2 was the least recently used
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.get(2, 'crypt2'), None)
+        self.assertEquals(cache.get(3, 'crypt3'), 'plain3')
+
+        # A new cryptgroupkey for the same group doesn't hit
+        self.assertEquals(cache.get(1, 'other crypt'), None)
+
+        cache.ttl = -1
+        self.assertEquals(cache.get(1, 'crypt1'), None)
+
+    def _count_queries(self, func, *args, **kwargs):
+        """Call func, and return the number of SQL statements the vault
+        executed meanwhile"""
+        from sqlalchemy import event
+        from sflvault.model import meta
+        if not hasattr(meta.engine, '_test_statements'):
+            # Can't remove engine listeners in SQLAlchemy 0.8, so we only
+            # add one.
+            meta.engine._test_statements = []
+            def count(conn, cursor, statement, *args):
+                meta.engine._test_statements.append(statement)
+            event.listen(meta.engine, 'before_cursor_execute', count)
+            # Connections already opened by the server won't see the
+            # listener until their transaction ends.
+            self.vault.customer_list()
+
+        before = len(meta.engine._test_statements)
+        func(*args, **kwargs)
+        return len(meta.engine._test_statements) - before
+
+    def test_service_get_tree_chain(self):
+        """ service_get_tree returns the whole chain of parents, root first,
+        with a number of queries that doesn't depend on the depth """
+        services = [self._add_new_service()['service_id'] for x in range(4)]
+        for parent, child in zip(services, services[1:]):
+            self.vault.service_put(child, {'parent_service_id': parent})
+
+        tree = self.vault.service_get_tree(services[-1], with_groups=True)
+        self.assertEquals([x['id'] for x in tree], services)
+        for x in tree:
+            self.assertEquals(x['plaintext'], 'secret')
+            self.assertEquals(len(x['groups_list']), 1)
+            self.assertEquals(x['groups_list'][0][0], x['group_id'])
+
+        short = self._count_queries(self.vault.service_get_tree, services[1])
+        deep = self._count_queries(self.vault.service_get_tree, services[-1])
+        self.assertEquals(short, deep)
+
+    def test_listings_query_count(self):
+        """ user_list and group_list run a fixed number of queries, whatever
+        the number of users and groups """
+        self.vault.user_add(u'listed_user')
+        self.vault.group_add(u'listed_group')
+        few_users = self._count_queries(self.vault.user_list, groups=True)
+        few_groups = self._count_queries(self.vault.group_list)
+
+        for i in range(3):
+            self.vault.user_add(u'listed_user%d' % i)
+            self.vault.group_add(u'listed_group%d' % i)
+        users = self.vault.user_list(groups=True)['list']
+        admin = [u for u in users if u['username'] == u'admin'][0]
+        self.assertEquals(len(admin['groups']), 4)
+        self.assertEquals(len(self.vault.group_list()['list']), 4)
+
+        self.assertEquals(few_users,
+                          self._count_queries(self.vault.user_list,
+                                              groups=True))
+        self.assertEquals(few_groups,
+                          self._count_queries(self.vault.group_list))
+
+    def test_metrics(self):
+        """ Admins can see the server's metrics """
+        self.vault.group_add(u'metrics_group')
+        metrics = self.vault.metrics()['metrics']
+        self.assertTrue(metrics.get('keypool.hits', 0) +
+                        metrics.get('keypool.misses', 0) > 0)
+
+    def test_crypto_workers(self):
+        """ Keys can be encrypted for their groups on worker processes """
+        from sflvault.lib import cryptopool
+        from sflvault.lib.cryptopool import CryptoPool
+        default = cryptopool.pool
+        # As with sflvault.vault.crypto_workers
+        cryptopool.pool = CryptoPool(2, min_jobs=1)
+        try:
+            group_id = self.vault.group_add(u'pooled_group')['group_id']
+            mid = self._add_new_machine()['machine_id']
+            service_id = self.vault.service_add(mid, 0,
+                                                u'ssh://pooled@example.com',
+                                                [group_id], 'pooled',
+                                                '')['service_id']
+            self.assertNotEquals(cryptopool.pool._pool, None)
+            self.vault.forget_privkey()
+            self.assertEquals(self.vault.service_get(service_id)['plaintext'],
+                              'pooled')
+        finally:
+            cryptopool.pool.close()
+            cryptopool.pool = default
+
+    def test_keypool(self):
+        """ New groups take their keypair from the key pool """
+        import time
+        from sflvault.lib import keypool, metrics
+        from sflvault.lib.keypool import KeyPool
+        default = keypool.pool
+        # As with sflvault.vault.keypool_size
+        keypool.pool = KeyPool(1)
+        try:
+            keypool.pool.start()
+            for x in range(100):
+                if len(keypool.pool):
+                    break
+                time.sleep(0.1)
+            before = metrics.snapshot()
+            self.vault.group_add(u'pooled_group')
+            self.assertEquals(metrics.snapshot()['keypool.hits'],
+                              before.get('keypool.hits', 0) + 1)
+        finally:
+            keypool.pool.close()
+            keypool.pool = default
+
+    def test_pubkey_cache_warm(self):
+        """ Public keys loaded at startup are used without parsing them """
+        import transaction
+        from sflvault import model
+        from sflvault.lib import metrics, pubkeys
+        from sflvault.lib.pubkeys import PubkeyCache
+        default = pubkeys.cache
+        # As with sflvault.vault.pubkey_cache_warm
+        pubkeys.cache = PubkeyCache()
+        try:
+            pubkeys.cache.warm(model.pubkeys_list())
+            transaction.commit()
+            # At least the admin's
+            self.assertTrue(len(pubkeys.cache))
+            before = metrics.snapshot()
+            self.vault.group_add(u'warm_group')
+            self.assertTrue(metrics.snapshot().get('pubkeys.hits', 0) >
+                            before.get('pubkeys.hits', 0))
+        finally:
+            pubkeys.cache = default
+
+    def test_migrate_ciphers(self):
+        """ A group's ciphers can be re-encrypted in another format """
+        import tempfile
+        # Written in version 2, to migrate them back to version 1
+        default = crypto.LONGMSG_VERSION
+        crypto.LONGMSG_VERSION = 2
+        try:
+            gres = self.vault.group_add(u'migrate_group')
+            group_id = gres['group_id']
+            cres = self.vault.customer_add(u"Migrated customer")
+            mres = self.vault.machine_add(str(cres['customer_id']),
+                                          "Migrated machine",
+                                          "mig.example.com",
+                                          '10.0.0.2', None, None)
+            services = [self.vault.service_add(mres['machine_id'], 0,
+                                               u'ssh://mig%d@example.com' % i,
+                                               [group_id], 'secret%d' % i,
+                                               '')['service_id']
+                        for i in range(3)]
+        finally:
+            crypto.LONGMSG_VERSION = default
+
+        # A cipher changed since it was fetched isn't overwritten
+        row = self.vault.group_ciphers_get(group_id, 'services',
+                                           limit=1)['ciphers'][0]
+        saved = self.vault.group_ciphers_put(group_id, 'services',
+            [{'id': row['id'], 'cipher': 'stale',
+              'old_cipher': row['cipher'] + 'changed'}])
+        self.assertEquals(saved['count'], 0)
+        self.assertEquals(saved['skipped'], [row['id']])
+        self.assertEquals(self.vault.group_ciphers_get(group_id, 'services',
+                              limit=1)['ciphers'][0], row)
+
+        checkpoint = tempfile.mktemp()
+        try:
+            migration = self.vault.migrate_ciphers([group_id], version=1,
+                                                   batch_size=2, workers=0,
+                                                   checkpoint_file=checkpoint)
+            # Three services, and our own copy of the group key
+            self.assertEquals(migration.count, 4)
+            self.assertTrue(Checkpoint(checkpoint).get(group_id, 'services'))
+        finally:
+            if os.path.exists(checkpoint):
+                os.unlink(checkpoint)
+
+        for kind in ('services', 'users'):
+            left = self.vault.group_ciphers_get(group_id, kind, version=1)
+            self.assertEquals(left['ciphers'], [])
+
+        self.vault.forget_privkey()
+        for i, service_id in enumerate(services):
+            serv = self.vault.service_get(service_id)
+            self.assertEquals(serv['plaintext'], 'secret%d' % i)
+
+        self.assertRaises(VaultError, self.vault.group_ciphers_get,
+                          group_id, 'nothing')
+
+    def test_wrap_symkeys(self):
+        """ Symkeys can be wrapped with the groups' wrapping keys """
+        gres = self.vault.group_add(u'wrap_group')
+        group_id = gres['group_id']
+        cres = self.vault.customer_add(u"Wrapped customer")
+        mres = self.vault.machine_add(str(cres['customer_id']),
+                                      "Wrapped machine", "wrap.example.com",
+                                      '10.0.0.3', None, None)
+        self.vault.wrap_symkeys = True
+        try:
+            service_id = self.vault.service_add(mres['machine_id'], 0,
+                                                u'ssh://wrap@example.com',
+                                                [group_id], 'wrapped',
+                                                '')['service_id']
+            serv = self.vault.service_get(service_id)
+            self.assertTrue(serv['cryptsymkey'].startswith(GROUP_WRAP_PREFIX))
+            self.assertEquals(serv['plaintext'], 'wrapped')
+
+            self.vault.service_passwd(service_id, 'rewrapped')
+            serv = self.vault.service_get(service_id)
+            self.assertTrue(serv['cryptsymkey'].startswith(GROUP_WRAP_PREFIX))
+            self.assertEquals(serv['plaintext'], 'rewrapped')
+
+            # With one multicall for the service and the groups
+            group2_id = self.vault.group_add(u'wrap_group2')['group_id']
+            res = self.vault.group_add_service(group2_id, service_id)
+            self.assertFalse(res['error'])
+            left = self.vault.group_ciphers_get(group2_id, 'services',
+                                                version=1)
+            self.assertEquals(left['ciphers'], [])
+
+            # The groups we're not a member of get an ElGamal cipher
+            group3_id = self.vault.group_add(u'wrap_group3')['group_id']
+            # Admins are put in every group, leave this one
+            import transaction
+            from sflvault import model
+            model.query(model.UserGroup).filter_by(group_id=group3_id) \
+                 .delete()
+            transaction.commit()
+            service2_id = self.vault.service_add(mres['machine_id'], 0,
+                                                 u'ssh://wrap2@example.com',
+                                                 [group_id, group3_id],
+                                                 'wrapped2', '')['service_id']
+            ciphers = self.vault.vault.service_get(self.vault.authtok,
+                                                   service2_id, group3_id)
+            self.assertFalse(ciphers['service']['cryptsymkey']
+                             .startswith(GROUP_WRAP_PREFIX))
+        finally:
+            self.vault.wrap_symkeys = False
+
+        # The vault checks what it is given
+        seckey, ciphertext = encrypt_secret('checked')
+        wrapped = wrap_symkey('k' * 64, seckey)
+        cryptsymkeys_ok = {str(group_id): wrapped}
+        for secret, cryptsymkeys in [
+                (ciphertext, {str(group_id): 'junk'}),
+                (ciphertext, {str(group_id): wrapped[:-4]}),
+                (ciphertext, {}),
+                (ciphertext, {str(group_id): wrapped,
+                              str(group3_id): wrapped}),
+                ('not encrypted', {str(group_id): wrapped}),
+                (ciphertext, cryptsymkeys_ok)]:
+            res = self.vault.vault.service_add(self.vault.authtok,
+                                               mres['machine_id'], None,
+                                               u'ssh://bad@example.com',
+                                               [group_id], secret, '', '',
+                                               cryptsymkeys)
+            # Only the last one is well formed
+            self.assertEquals(bool(res['error']),
+                              cryptsymkeys is not cryptsymkeys_ok)
+        res = self.vault.vault.group_add_service(self.vault.authtok,
+                                                 group3_id, service_id, None,
+                                                 wrapped)
+        self.assertTrue(res['error'])
+
+        # Readable by clients not wrapping, and left alone by migrations
+        self.vault.forget_privkey()
+        self.assertEquals(self.vault.service_get(service_id)['plaintext'],
+                          'rewrapped')
+        left = self.vault.group_ciphers_get(group_id, 'services', version=1)
+        self.assertEquals(left['ciphers'], [])
+
+    def test_x25519_keys(self):
+        """ Users and groups can have X25519 keys, next to ElGamal ones """
+        from sflvault.lib import keypool
+        if x25519 is None:
+            raise SkipTest("cryptography is not installed")
+        self.vault.user_add('x25519_user')
+        user_vault = SFLvaultClient(self.getConfFileUser(), shell=True)
+        user_vault.user_setup('x25519_user',
+                              'http://localhost:6555/vault/rpc',
+                              'passphrase', algorithm='x25519')
+        user_vault.set_getpassfunc(lambda: 'passphrase')
+        # Logs in with the X25519 key
+        user_vault.customer_list()
+
+        algorithm = keypool.pool.algorithm
+        keypool.pool.algorithm = 'x25519'
+        try:
+            group_id = self.vault.group_add(u'x25519_group')['group_id']
+        finally:
+            keypool.pool.algorithm = algorithm
+        cres = self.vault.customer_add(u"X25519 customer")
+        mres = self.vault.machine_add(str(cres['customer_id']),
+                                      "X25519 machine", "ec.example.com",
+                                      '10.0.0.4', None, None)
+        service_id = self.vault.service_add(mres['machine_id'], 0,
+                                            u'ssh://ec@example.com',
+                                            [group_id], 'ecies',
+                                            '')['service_id']
+        self.vault.group_add_user(group_id, 'x25519_user')
+
+        serv = self.vault.service_get(service_id)
+        self.assertTrue(serv['cryptsymkey'].startswith(ECIES_PREFIX))
+        self.assertEquals(serv['plaintext'], 'ecies')
+        self.assertEquals(user_vault.service_get(service_id)['plaintext'],
+                          'ecies')
+        # Nothing to migrate
+        left = self.vault.group_ciphers_get(group_id, 'services', version=2)
+        self.assertEquals(left['ciphers'], [])
+
+        self.vault.user_add('bad_key_user')
+        res = self.vault.vault.user_setup('bad_key_user',
+                                          X25519_PREFIX + 'AAAA')
+        self.assertTrue(res['error'])
+
+    def test_authtok_reuse(self):
+        """ The last authtok is used until the vault says its session is
+        gone """
+        from sflvault import views
+        vault = SFLvaultClient(self.vault.cfg.config_file)
+        vault.set_getpassfunc(lambda: 'test')
+        vault.customer_list()
+
+        calls = []
+        proxy = vault.vault._proxy
+        class Counting(object):
+            def __getattr__(_, name):
+                calls.append(name)
+                return getattr(proxy, name)
+        vault.vault._proxy = Counting()
+        vault.customer_list()
+        self.assertEquals(calls, ['customer_list'])
+
+        authtok = vault.authtok
+        views.session_store.delete(authtok)
+        del(calls[:])
+        vault.customer_list()
+        self.assertEquals(calls, ['customer_list', 'login', 'authenticate',
+                                  'customer_list'])
+        self.assertNotEquals(vault.authtok, authtok)
+
+    def test_session_renew(self):
+        """ Sessions in use are pushed back with session_renew """
+        from sflvault import views
+        from datetime import datetime, timedelta
+        request = {'REMOTE_ADDR': '127.0.0.1',
+                   'settings': {'sflvault.vault.session_renew': 'true',
+                                'sflvault.vault.session_timeout': '60'}}
+        for left, renewed in [(10, True), (50, False)]:
+            timeout = datetime.now() + timedelta(0, left)
+            views.set_session('tok-renew', {'username': u'admin',
+                                            'user_id': 1,
+                                            'remote_addr': '127.0.0.1',
+                                            'timeout': timeout})
+            sess = views.get_session('tok-renew', request)
+            views.renew_session('tok-renew', sess, request)
+            sess = views.get_session('tok-renew', request)
+            self.assertEquals(sess['timeout'] > timeout, renewed)
+
+        self.assertRaises(views.SessionSourceAddressMismatchError,
+                          views.get_session, 'tok-renew',
+                          {'REMOTE_ADDR': '10.0.0.1'})
+
+    def test_jsonrpc(self):
+        """ The client switches to JSON-RPC, with the same values """
+        import xmlrpclib
+        from sflvault.common import jsonrpc
+        self.vault.customer_list()
+        self.assertEquals(self.vault.transport.jsonrpc_path,
+                          jsonrpc.JSONRPC_PATH)
+        cid = self.vault.customer_add(u"Testing \xe9 JSON")['customer_id']
+        customer = self.vault.vault.customer_get(self.vault.authtok, cid)
+        self.assertEquals(customer['customer']['name'], u"Testing \xe9 JSON")
+        self.assertEquals(type(customer['message']), str)
+        admin = self.vault.user_list()['list'][0]
+        self.assertTrue(isinstance(admin['created_stamp'], xmlrpclib.DateTime))
+
+        self.assertRaises(xmlrpclib.Fault, self.vault.vault.customer_get,
+                          self.vault.authtok)
+        for data in ['{', '[]', '{"params": []}']:
+            self.assertRaises(xmlrpclib.Fault, jsonrpc.loads_request, data)
+
+    def test_gzip(self):
+        """ Large requests and responses are gzipped, and measured """
+        from sflvault.lib import metrics
+        before = metrics.snapshot()
+        self.vault.customer_list()
+        self.assertEquals(self.vault.transport.encode_threshold, 1400)
+        for x in range(20):
+            self.vault.customer_add('Customer with a long name %d ' % x * 60)
+        customers = self.vault.vault.customer_list(self.vault.authtok)['list']
+        self.assertEquals(len(customers), 20)
+        after = metrics.snapshot()
+        for name in ['gzip.request_bytes_saved', 'gzip.response_bytes_saved',
+                     'gzip.compress.count', 'gzip.decompress.count']:
+            self.assertTrue(after.get(name, 0) > before.get(name, 0), name)
+
+        # A request that isn't gzip data is refused
+        import httplib
+        conn = httplib.HTTPConnection('localhost', 6555)
+        conn.request('POST', '/vault/rpc', 'not gzipped',
+                     {'Content-Encoding': 'gzip'})
+        self.assertEquals(conn.getresponse().status, 400)
+        conn.close()
+
+    def test_multicall(self):
+        """ Independent calls are batched, authenticated and fail each """
+        import xmlrpclib
+        vault = self.vault
+        vault.customer_list()
+        methods = vault.server.system.listMethods()
+        self.assertTrue('system.multicall' in methods)
+        self.assertTrue('sflvault.customer_list' in methods)
+
+        # An expired authtok gets the whole batch made again
+        vault.authtok = 'expired-authtok'
+        batch = vault.multicall()
+        batch.customer_add('Batched customer')
+        batch.customer.get()
+        batch.customer_list()
+        batch.user_list(False)
+        added, fault, customers, users = batch()
+        self.assertNotEquals(vault.authtok, 'expired-authtok')
+        self.assertFalse(added['error'])
+        self.assertTrue(isinstance(fault, xmlrpclib.Fault))
+        self.assertEquals([x['id'] for x in customers['list']],
+                          [added['customer_id']])
+        self.assertEquals(users['list'][0]['username'], 'admin')
+        self.assertEquals(vault.multicall()(), [])
+
+    def _start_threaded_server(self, workers):
+        """Serve the vault on another port in sflvault.server.mode =
+        threaded, return the server and its URL"""
+        import threading
+        from sflvault.server import SFLvaultRequestHandler, \
+             ThreadedXMLRPCServer
+        from sflvault.views import XMLRPCDispatcher
+        from sflvault import views
+        server = ThreadedXMLRPCServer(('localhost', 0),
+                                      requestHandler=SFLvaultRequestHandler,
+                                      logRequests=False, allow_none=True)
+        dispatcher = XMLRPCDispatcher()
+        dispatcher.scan(views)
+        server.register_instance(dispatcher)
+        server.start_workers(workers)
+        t = threading.Thread(target=server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        return server, 'http://localhost:%d/vault/rpc' % \
+                       server.server_address[1]
+
+    def test_keepalive(self):
+        """ The connection is kept open between calls with keepalive """
+        from sflvault.client.client import vault_server
+        server, url = self._start_threaded_server(2)
+        server.keepalive = 5
+        try:
+            for keepalive in [True, False]:
+                proxy, transport = vault_server(url, keepalive)
+                socks = []
+                for x in range(3):
+                    retval = proxy.sflvault.user_list('invalid-authtok', False)
+                    self.assertTrue(retval['error'])
+                    connection = transport._connection[1]
+                    socks.append(connection and connection.sock)
+                if keepalive:
+                    self.assertTrue(socks[0] is not None)
+                    self.assertEquals(len(set(socks)), 1)
+                else:
+                    self.assertEquals(socks, [None] * 3)
+                transport.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_request_context(self):
+        """ Each request carries its own identity down to SFLvaultAccess """
+        from sflvault import views
+        from datetime import datetime, timedelta
+        timeout = datetime.now() + timedelta(0, 60)
+        requests = []
+        for authtok, user_id, username in [('tok-one', 1, u'one'),
+                                           ('tok-two', 2, u'two')]:
+            views.set_session(authtok, {'username': username,
+                                        'user_id': user_id,
+                                        'remote_addr': '127.0.0.1',
+                                        'timeout': timeout})
+            request = {'REMOTE_ADDR': '127.0.0.1', 'rpc_args': (authtok,)}
+            self.assertEquals(views._authenticated_user_first(request,
+                                                              authtok),
+                              None)
+            requests.append(request)
+            views.session_store.delete(authtok)
+
+        self.assertEquals(views.get_vault(requests[0]).myself_id, 1)
+        self.assertEquals(views.get_vault(requests[0]).myself_username, u'one')
+        self.assertEquals(views.get_vault(requests[1]).myself_id, 2)
+        self.assertEquals(views.get_vault(requests[1]).myself_username, u'two')
+        # Unauthenticated requests are anonymous
+        self.assertEquals(views.get_vault({}).myself_id, None)
+
+    def test_concurrent_requests(self):
+        """ Requests from several clients can be served in parallel, each
+        with its own identity """
+        import threading
+        self.vault.user_add('concurrent_user')
+        user_vault = SFLvaultClient(self.getConfFileUser(), shell=True)
+        user_vault.user_setup('concurrent_user',
+                              'http://localhost:6555/vault/rpc',
+                              'passphrase')
+
+        server, url = self._start_threaded_server(4)
+        # One client per thread, xmlrpclib proxies aren't thread-safe.
+        clients = []
+        for config, passphrase, admin in [
+                (self.vault.cfg.config_file, 'test', True),
+                (user_vault.cfg.config_file, 'passphrase', False)] * 2:
+            vault = SFLvaultClient(config, shell=True)
+            vault._set_vault(url)
+            vault.set_getpassfunc(lambda p=passphrase: p)
+            # Authenticate one at a time, the login challenge is per user.
+            vault.customer_list()
+            clients.append((vault, admin))
+
+        results = []
+        def work(vault, admin):
+            for x in range(5):
+                try:
+                    if admin:
+                        vault.user_list()
+                    else:
+                        # Only admins can delete users
+                        self.assertRaises(VaultError, vault.user_del,
+                                          'concurrent_user')
+                    results.append(True)
+                except Exception, e:
+                    results.append(e)
+
+        threads = [threading.Thread(target=work, args=client)
+                   for client in clients]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for vault, admin in clients:
+            vault.close()
+        server.shutdown()
+        server.server_close()
+
+        self.assertEquals(results, [True] * 20)
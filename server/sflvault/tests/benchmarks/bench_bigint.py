@@ -0,0 +1,93 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Compare the 'python' and 'gmpy2' big-integer backends on a login
+challenge, decrypt_longmsg() of a group key, and the generation of a
+keypair.
+
+  python -m sflvault.tests.benchmarks.bench_bigint [rounds] [keygen bits]
+
+Generating a full 1536-bit keypair with Python longs can take minutes, so
+keypairs are generated with `keygen bits` (512 by default).
+"""
+
+import os
+import sys
+import time
+
+# Use the pre-generated test keypairs
+os.environ['SFLVAULT_IN_TEST'] = 'true'
+
+from Crypto.PublicKey import ElGamal
+
+from sflvault.common import crypto
+from sflvault.common.crypto import *
+
+
+def timed(rounds, func, *args):
+    """Return the average time of func"""
+    start = time.time()
+    for x in range(rounds):
+        func(*args)
+    return (time.time() - start) / rounds
+
+
+def generate(bits):
+    if bigint_backend() == 'gmpy2':
+        return crypto._gmpy2_generate(bits, randfunc)
+    return ElGamal.generate(bits, randfunc)
+
+
+def main(rounds=20, bits=512):
+    rounds, bits = int(rounds), int(bits)
+    if crypto.gmpy2 is None:
+        print "gmpy2 is not installed"
+        return 1
+
+    eg = generate_elgamal_keypair()
+    groupkey = serial_elgamal_privkey(elgamal_bothkeys(eg))
+    ciphers = dict([(version, encrypt_longmsg(eg, groupkey, version=version))
+                    for version in [1, 2]])
+
+    def login():
+        rnd = randfunc(32)
+        cryptok = serial_elgamal_msg(elgamal_encrypt(eg, rnd, randfunc(32)))
+        elgamal_decrypt(eg, unserial_elgamal_msg(cryptok))
+
+    tests = [('login', rounds, login),
+             ('decrypt_longmsg v1', rounds,
+              lambda: decrypt_longmsg(eg, ciphers[1])),
+             ('decrypt_longmsg v2', rounds,
+              lambda: decrypt_longmsg(eg, ciphers[2])),
+             ('keypair (%d bits)' % bits, 3, lambda: generate(bits))]
+
+    print "%d-bit key, times in ms" % eg.p.bit_length()
+    print "%-22s %10s %10s %8s" % ("", "python", "gmpy2", "speedup")
+    for name, count, func in tests:
+        times = []
+        for crypto.BIGINT_BACKEND in ['python', 'gmpy2']:
+            times.append(timed(count, func))
+        print "%-22s %10.2f %10.2f %7.1fx" % (name, times[0] * 1000,
+                                             times[1] * 1000,
+                                             times[0] / times[1])
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv[1:]))
@@ -0,0 +1,71 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time the encryption of a group key for many recipients, serially and on
+the crypto pool, as done by group_add (and service_passwd for symkeys).
+
+  python -m sflvault.tests.benchmarks.bench_fanout [workers]
+"""
+
+import multiprocessing
+import os
+import sys
+import time
+
+# Use the pre-generated test keypairs, generating 40 keys would take ages.
+os.environ['SFLVAULT_IN_TEST'] = 'true'
+
+from sflvault.common.crypto import *
+from sflvault.lib.cryptopool import CryptoPool
+
+RECIPIENTS = [1, 2, 5, 10, 20, 40]
+
+
+def main(workers=None):
+    workers = int(workers or multiprocessing.cpu_count())
+    eg = generate_elgamal_keypair()
+    pubkey = serial_elgamal_pubkey(elgamal_pubkey(eg))
+    # What group_add encrypts for each admin
+    groupkey = serial_elgamal_privkey(elgamal_bothkeys(eg))
+
+    serial = CryptoPool(0)
+    parallel = CryptoPool(workers)
+    # Start the workers before timing
+    parallel.encrypt_longmsg_many([(pubkey, 'warmup')] * workers)
+
+    print "%d workers, %d bytes message" % (workers, len(groupkey))
+    print "%10s %10s %10s %8s" % ("recipients", "serial", "pool", "speedup")
+    try:
+        for count in RECIPIENTS:
+            jobs = [(pubkey, groupkey)] * count
+            times = []
+            for pool in [serial, parallel]:
+                start = time.time()
+                pool.encrypt_longmsg_many(jobs)
+                times.append(time.time() - start)
+            print "%10d %9.3fs %9.3fs %7.1fx" % (count, times[0], times[1],
+                                                 times[0] / times[1])
+    finally:
+        parallel.close()
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,77 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Compare ElGamal encryption with PyCrypto's eg.encrypt() and with the
+fixed-base tables of elgamal_encrypt(), to a key encrypted to over and
+over (a login challenge, and a version 2 service symkey).
+
+  python -m sflvault.tests.benchmarks.bench_fixedbase [rounds]
+"""
+
+import os
+import sys
+import time
+
+# Use the pre-generated test keypairs
+os.environ['SFLVAULT_IN_TEST'] = 'true'
+
+from sflvault.common import crypto
+from sflvault.common.crypto import *
+
+
+def timed(rounds, func, *args):
+    """Return the average time of func"""
+    start = time.time()
+    for x in range(rounds):
+        func(*args)
+    return (time.time() - start) / rounds
+
+
+def main(rounds=200):
+    rounds = int(rounds)
+    eg = generate_elgamal_keypair()
+    symkey = encrypt_secret('secret')[0]
+
+    crypto.FIXEDBASE_CACHE_SIZE = 1
+    start = time.time()
+    for x in range(crypto.FIXEDBASE_MIN_USES):
+        elgamal_encrypt(eg, randfunc(32), randfunc(32))
+    print "%d-bit key, tables built in %.1fms" % (eg.p.bit_length(),
+                                                 (time.time() - start) * 1000)
+
+    # Same ciphertexts
+    K = randfunc(32)
+    assert elgamal_encrypt(eg, symkey, K) == eg.encrypt(symkey, K)
+
+    print "%d rounds, times in ms" % rounds
+    print "%-12s %10s %10s" % ("", "PyCrypto", "tables")
+    for name, func in [
+        ('challenge', lambda: elgamal_encrypt(eg, randfunc(32), randfunc(32))),
+        ('longmsg v2', lambda: encrypt_longmsg(eg, symkey, version=2))]:
+        # Without a cache, elgamal_encrypt() is eg.encrypt()
+        crypto.FIXEDBASE_CACHE_SIZE = 0
+        stock = timed(rounds, func)
+        crypto.FIXEDBASE_CACHE_SIZE = 1
+        fast = timed(rounds, func)
+        print "%-12s %10.2f %10.2f" % (name, stock * 1000, fast * 1000)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
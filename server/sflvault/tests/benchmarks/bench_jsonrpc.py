@@ -0,0 +1,88 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Compare XML-RPC and JSON-RPC on a `search` result: the time to encode it
+on the vault, to decode it in the client, and its size on the wire.
+
+  python -m sflvault.tests.benchmarks.bench_jsonrpc [services] [rounds]
+
+The result has the shape of SFLvaultAccess.search()'s, with 10 services
+per machine and 10 machines per customer.
+"""
+
+import sys
+import time
+import xmlrpclib
+
+from sflvault.common import jsonrpc
+
+
+def timed(rounds, func, *args):
+    """Return the average time of func"""
+    start = time.time()
+    for x in range(rounds):
+        func(*args)
+    return (time.time() - start) / rounds
+
+
+def search_result(services):
+    out = {}
+    for i in range(services):
+        c, m = str(i / 100), str(i / 10)
+        customer = out.setdefault(c, {'name': 'Customer %s' % c,
+                                      'machines': {}})
+        machine = customer['machines'].setdefault(m, {
+            'name': 'machine%s' % m, 'fqdn': 'machine%s.example.com' % m,
+            'ip': '10.0.%d.%d' % (i / 2560 % 256, i / 10 % 256),
+            'location': 'Rack %s' % c, 'notes': '', 'services': {}})
+        machine['services'][str(i)] = {
+            'url': 'ssh://root@machine%s.example.com/' % m,
+            'parent_service_id': '', 'metadata': '',
+            'notes': u'Service n\xb0%d' % i}
+    return {'error': False, 'message': 'Search results',
+            'results': out, 'total': services, 'offset': 0}
+
+
+def main(services=10000, rounds=5):
+    services, rounds = int(services), int(rounds)
+    result = search_result(services)
+
+    xml = xmlrpclib.dumps((result,), methodresponse=True, allow_none=True)
+    json = jsonrpc.dumps_response(result, 1)
+    assert xmlrpclib.loads(xml)[0][0] == jsonrpc.loads_response(json)
+
+    print "%d services" % services
+    print "%-9s %12s %12s %12s" % ('', 'encode (ms)', 'decode (ms)',
+                                   'size (KB)')
+    for name, encode, decode, data in [
+        ('XML-RPC',
+         lambda: xmlrpclib.dumps((result,), methodresponse=True,
+                                 allow_none=True),
+         lambda: xmlrpclib.loads(xml), xml),
+        ('JSON-RPC', lambda: jsonrpc.dumps_response(result, 1),
+         lambda: jsonrpc.loads_response(json), json)]:
+        print "%-9s %12.1f %12.1f %12.1f" % (name, timed(rounds, encode) * 1000,
+                                             timed(rounds, decode) * 1000,
+                                             len(data) / 1024.)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv[1:]))
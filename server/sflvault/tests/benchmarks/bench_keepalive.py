@@ -0,0 +1,134 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Per-RPC latency against a local server, with and without keep-alive
+(sflvault.server.keepalive and the client's VaultTransport), over HTTP and
+HTTPS.
+
+  python -m sflvault.tests.benchmarks.bench_keepalive [calls]
+
+The server is threaded and answers a trivial method, so that the
+difference is the TCP setup and the TLS handshake.  The certificate is a
+throw-away self-signed one.
+"""
+
+import os
+import ssl
+import sys
+import tempfile
+import threading
+import time
+
+from OpenSSL import crypto
+
+from sflvault.server import SFLvaultRequestHandler, ThreadedXMLRPCServer, \
+     ThreadedSecureXMLRPCServer
+from sflvault.client.client import vault_server
+
+
+def timed(rounds, func, *args):
+    """Return the average time of func"""
+    start = time.time()
+    for x in range(rounds):
+        func(*args)
+    return (time.time() - start) / rounds
+
+
+class EchoRequestHandler(SFLvaultRequestHandler):
+    """No database behind, only the connection handling"""
+    def _dispatch(self, method, params):
+        return params
+
+
+def make_cert(directory):
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = 'localhost'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(3600)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+    keyfile = os.path.join(directory, 'key.pem')
+    certfile = os.path.join(directory, 'cert.pem')
+    open(keyfile, 'w').write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+    open(certfile, 'w').write(crypto.dump_certificate(crypto.FILETYPE_PEM,
+                                                      cert))
+    return keyfile, certfile
+
+
+def start_server(keepalive, certs=None):
+    kwargs = dict(requestHandler=EchoRequestHandler, logRequests=False,
+                  allow_none=True)
+    if certs:
+        server = ThreadedSecureXMLRPCServer(('localhost', 0), keyfile=certs[0],
+                                            certfile=certs[1], **kwargs)
+    else:
+        server = ThreadedXMLRPCServer(('localhost', 0), **kwargs)
+    server.keepalive = keepalive
+    server.start_workers(2)
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    return server
+
+
+def bench(calls, scheme, keepalive, certs):
+    """Return the average time of an RPC"""
+    server = start_server(keepalive and 5,
+                          certs if scheme == 'https' else None)
+    url = '%s://localhost:%d/vault/rpc' % (scheme, server.server_address[1])
+    kwargs = {}
+    if scheme == 'https':
+        kwargs['context'] = ssl._create_unverified_context()
+    proxy, transport = vault_server(url, keepalive, **kwargs)
+    try:
+        proxy.sflvault.ping('warm-up')
+        return timed(calls, proxy.sflvault.ping, 'x' * 64)
+    finally:
+        transport.close()
+        server.shutdown()
+        server.server_close()
+
+
+def main(calls=200):
+    calls = int(calls)
+    directory = tempfile.mkdtemp()
+    try:
+        certs = make_cert(directory)
+        print "%-8s %14s %16s %8s" % ('', 'close (ms)', 'keep-alive (ms)',
+                                     'speedup')
+        for scheme in ['http', 'https']:
+            close, keepalive = [bench(calls, scheme, keepalive, certs)
+                                for keepalive in [False, True]]
+            print "%-8s %14.3f %16.3f %7.1fx" % (scheme, close * 1000,
+                                                 keepalive * 1000,
+                                                 close / keepalive)
+    finally:
+        for name in os.listdir(directory):
+            os.unlink(os.path.join(directory, name))
+        os.rmdir(directory)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv[1:]))
@@ -0,0 +1,116 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Count the SQL statements and time of the user and group listings, on a
+vault seeded with many users and groups.
+
+  python -m sflvault.tests.benchmarks.bench_listing [users] [groups]
+
+Exits with an error if a listing runs more statements than expected.
+"""
+
+import random
+import sys
+import time
+from datetime import datetime
+
+from sqlalchemy import create_engine, event
+
+from sflvault import model
+from sflvault.model import meta
+from sflvault.lib.vault import SFLvaultAccess
+
+# Each user is a member of that many groups
+GROUPS_PER_USER = 5
+
+# The most statements each listing is allowed to run
+MAX_STATEMENTS = {'user_list': 1,
+                  'user_list(groups=True)': 2,
+                  'group_list': 4}
+
+
+def seed(engine, users, groups):
+    """Add `users` users and `groups` groups, the first user being a global
+    admin"""
+    now = datetime.now()
+    engine.execute(model.users_table.insert(),
+                   [{'id': i + 1, 'username': u'user%d' % i,
+                     'created_time': now, 'is_admin': i == 0}
+                    for i in range(users)])
+    engine.execute(model.groups_table.insert(),
+                   [{'id': i + 1, 'name': u'group%d' % i,
+                     'hidden': i % 10 == 0}
+                    for i in range(groups)])
+    rand = random.Random(42)
+    memberships = []
+    for user_id in range(1, users + 1):
+        for group_id in rand.sample(range(1, groups + 1),
+                                    min(GROUPS_PER_USER, groups)):
+            memberships.append({'user_id': user_id, 'group_id': group_id,
+                                'is_admin': False,
+                                'cryptgroupkey': 'x' * 600})
+    engine.execute(model.usergroups_table.insert(), memberships)
+
+
+def measure(statements, func, *args, **kwargs):
+    """Return the number of statements func added to `statements`, and how
+    long it took"""
+    before = len(statements)
+    start = time.time()
+    try:
+        func(*args, **kwargs)
+    finally:
+        elapsed = time.time() - start
+        meta.Session.remove()
+    return len(statements) - before, elapsed
+
+
+def main(users=1000, groups=200):
+    engine = create_engine('sqlite://')
+    model.init_model(engine)
+    meta.metadata.create_all(engine)
+    seed(engine, users, groups)
+
+    statements = []
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', count)
+
+    # Listing as the global admin
+    vault = SFLvaultAccess(1, u'user0')
+    calls = [('user_list', vault.user_list, {}),
+             ('user_list(groups=True)', vault.user_list, {'groups': True}),
+             ('group_list', vault.group_list, {})]
+
+    print "%d users, %d groups, %d memberships each" % (users, groups,
+                                                        GROUPS_PER_USER)
+    failed = False
+    for name, func, kwargs in calls:
+        ran, elapsed = measure(statements, func, **kwargs)
+        ok = ran <= MAX_STATEMENTS[name]
+        failed = failed or not ok
+        print "%-25s %4d statements %8.3fs%s" % (name, ran, elapsed,
+                                                  '' if ok else '  (!!)')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*[int(x) for x in sys.argv[1:]]))
@@ -0,0 +1,68 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compare the version 1 (chunked ElGamal) and version 2 (ElGamal-wrapped
+AES key) formats of encrypt_longmsg(), for a group key and a service
+symkey.
+
+  python -m sflvault.tests.benchmarks.bench_longmsg [rounds]
+"""
+
+import os
+import sys
+import time
+
+# Use the pre-generated test keypairs
+os.environ['SFLVAULT_IN_TEST'] = 'true'
+
+from sflvault.common.crypto import *
+
+
+def timed(rounds, func, *args, **kwargs):
+    """Return the average time of func, and its last result"""
+    start = time.time()
+    for x in range(rounds):
+        result = func(*args, **kwargs)
+    return (time.time() - start) / rounds, result
+
+
+def main(rounds=10):
+    rounds = int(rounds)
+    eg = generate_elgamal_keypair()
+    messages = [('group key', serial_elgamal_privkey(elgamal_bothkeys(eg))),
+                ('symkey', encrypt_secret('secret')[0])]
+
+    print "%d rounds, times in ms" % rounds
+    print "%-10s %6s %8s %8s %8s %8s" % ("message", "bytes", "version",
+                                         "encrypt", "decrypt", "size")
+    for name, message in messages:
+        for version in [1, 2]:
+            enc, cipher = timed(rounds, encrypt_longmsg, eg, message,
+                                version=version)
+            dec, plain = timed(rounds, decrypt_longmsg, eg, cipher)
+            assert plain == message
+            print "%-10s %6d %8d %8.1f %8.1f %8d" % (name, len(message),
+                                                     version, enc * 1000,
+                                                     dec * 1000, len(cipher))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,83 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Compare the parse time of the serialized ElGamal keys and messages:
+the PyCrypto bytes_to_long() based readers, and the current hexlify based
+ones.
+
+  python -m sflvault.tests.benchmarks.bench_serial [rounds]
+"""
+
+import os
+import sys
+import time
+from base64 import b64decode
+
+from Crypto.Util.number import bytes_to_long
+
+# Use the pre-generated test keypairs
+os.environ['SFLVAULT_IN_TEST'] = 'true'
+
+from sflvault.common.crypto import *
+
+
+def old_unserial_pubkey(pubkey):
+    """unserial_elgamal_pubkey() as it was with PyCrypto's bytes_to_long()"""
+    x = pubkey.split(':')
+    return (bytes_to_long(b64decode(x[0])),
+            bytes_to_long(b64decode(x[1])),
+            bytes_to_long(b64decode(x[2])))
+
+
+def timed(rounds, func, *args):
+    """Return the average time of func, and its last result"""
+    start = time.time()
+    for x in range(rounds):
+        result = func(*args)
+    return (time.time() - start) / rounds, result
+
+
+def main(rounds=2000):
+    rounds = int(rounds)
+    eg = generate_elgamal_keypair()
+    pubkey = elgamal_pubkey(eg)
+    msg = eg.encrypt('\x02' + randfunc(64), randfunc(32))
+
+    print "%d rounds, times in us" % rounds
+    print "%-8s %-10s %6s %8s %8s" % ("what", "reader", "size", "serial",
+                                      "parse")
+    serial = serial_elgamal_pubkey(pubkey)
+    parse, result = timed(rounds, old_unserial_pubkey, serial)
+    assert result == pubkey
+    print "%-8s %-10s %6d %8s %8.1f" % ("pubkey", "PyCrypto", len(serial),
+                                        "", parse * 1e6)
+
+    for name, value, serial, unserial in [
+        ('pubkey', pubkey, serial_elgamal_pubkey, unserial_elgamal_pubkey),
+        ('msg', msg, serial_elgamal_msg, unserial_elgamal_msg)]:
+        write, packed = timed(rounds, serial, value)
+        parse, result = timed(rounds, unserial, packed)
+        assert result == value
+        print "%-8s %-10s %6d %8.1f %8.1f" % (name, "hexlify", len(packed),
+                                              write * 1e6, parse * 1e6)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,102 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Compare ElGamal and X25519 keys on a login challenge, decrypt_longmsg()
+of a group key and of a service's symkey, the size of the ciphertexts, and
+the generation of a keypair.
+
+  python -m sflvault.tests.benchmarks.bench_x25519 [rounds]
+
+ElGamal uses the pre-generated 1536-bit test keypairs, with the default
+big-integer backend (gmpy2 when installed), and v2 longmsgs.  Its keypair
+generation isn't timed, it takes seconds.
+"""
+
+import os
+import sys
+import time
+
+# Use the pre-generated test keypairs
+os.environ['SFLVAULT_IN_TEST'] = 'true'
+
+from sflvault.common import crypto
+from sflvault.common.crypto import *
+
+
+def timed(rounds, func, *args):
+    """Return the average time of func"""
+    start = time.time()
+    for x in range(rounds):
+        func(*args)
+    return (time.time() - start) / rounds
+
+
+def login(key):
+    # As done by views.login() and the client's authenticate()
+    rnd = randfunc(32)
+    if isinstance(key, X25519Key):
+        decrypt_longmsg(key, encrypt_longmsg(key, rnd))
+    else:
+        cryptok = serial_elgamal_msg(elgamal_encrypt(key, rnd, randfunc(32)))
+        elgamal_decrypt(key, unserial_elgamal_msg(cryptok))
+
+
+def main(rounds=50):
+    rounds = int(rounds)
+    if crypto.x25519 is None:
+        print "cryptography is not installed"
+        return 1
+
+    keys = [generate_elgamal_keypair(), generate_keypair('x25519')]
+    groupkeys = [serial_privkey(key) for key in keys]
+    symkey = encrypt_secret('secret')[0]
+    groupciphers = [encrypt_longmsg(key, groupkey, version=2)
+                    for key, groupkey in zip(keys, groupkeys)]
+    symciphers = [encrypt_longmsg(key, symkey, version=2) for key in keys]
+
+    tests = [('login', lambda i: login(keys[i])),
+             ('decrypt group key',
+              lambda i: decrypt_longmsg(keys[i], groupciphers[i])),
+             ('decrypt symkey',
+              lambda i: decrypt_longmsg(keys[i], symciphers[i])),
+             ('encrypt symkey',
+              lambda i: encrypt_longmsg(keys[i], symkey, version=2))]
+
+    print "Backend: %s, times in ms" % bigint_backend()
+    print "%-22s %10s %10s %8s" % ("", "elgamal", "x25519", "speedup")
+    for name, func in tests:
+        times = [timed(rounds, func, i) for i in range(2)]
+        print "%-22s %10.3f %10.3f %7.1fx" % (name, times[0] * 1000,
+                                             times[1] * 1000,
+                                             times[0] / times[1])
+    print "%-22s %10.3f %10s" % ('x25519 keypair',
+        timed(rounds, generate_keypair, 'x25519') * 1000, '')
+
+    print
+    print "Sizes in bytes"
+    for name, values in [('pubkey', [serial_pubkey(key) for key in keys]),
+                         ('group key', groupkeys),
+                         ('cryptgroupkey', groupciphers),
+                         ('cryptsymkey', symciphers)]:
+        print "%-22s %10d %10d" % (name, len(values[0]), len(values[1]))
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv[1:]))
@@ -24,6 +24,8 @@ import transaction
 
 from sflvault.common.crypto import *
 from sflvault.lib.vault import SFLvaultAccess, vaultMsg
+from sflvault.lib.sessions import MemorySessionStore
+from sflvault.lib import metrics
 from sflvault.model import *
 import datetime
 from decorator import decorator
@@ -39,19 +41,29 @@ MINIMAL_CLIENT_VERSION = LooseVersion('0.7.6')
 # Permissions decorators for XML-RPC calls
 #
 
-vaultSessions = {}
-vault = SFLvaultAccess()
+# Replaced by the configured store, see SFLvaultServer.initialize_sessions()
+session_store = MemorySessionStore()
+
+def get_vault(request):
+    """Return the SFLvaultAccess bound to the request's authenticated user.
+
+    It is set by the authenticated_* decorators.  Unauthenticated calls
+    get an anonymous one.
+    """
+    if 'vault' not in request:
+        request['vault'] = SFLvaultAccess()
+    return request['vault']
 
 def test_group_admin(request, group_id):
     if not query(Group).filter_by(id=group_id).first():
         return vaultMsg(False, "Group not found: %s" % str(group_id))
     
-    sess = get_session(request['rpc_args'][0], request)
+    myself_id = get_vault(request).myself_id
 
     # Verify if I'm is_admin on that group
     ug = query(UserGroup).filter_by(group_id=group_id,
-                                    user_id=sess['user_id']).first()
-    me = query(User).get(sess['user_id'])
+                                    user_id=myself_id).first()
+    me = query(User).get(myself_id)
     
     # Make sure I'm in that group (to be able to decrypt the groupkey)
     if not ug or (not ug.is_admin and not me.is_admin):
@@ -71,6 +83,10 @@ class XMLRPCDispatcher(object):
         self.registry = {}
         self.scan(sys.modules[__name__])
 
+    def _listMethods(self):
+        # For system.listMethods
+        return sorted(self.registry.keys())
+
     def scan(self, module):
         scanner = venusian.Scanner(registry=self.registry)
         scanner.scan(module)
@@ -140,17 +156,22 @@ def _authenticated_user_first(request, cryptok):
     except SessionExpiredError:
         s = None
         error_msg = 'session expired'
+    except SessionSourceAddressMismatchError:
+        s = None
+        error_msg = 'session used from another address'
 
 
     if not s:
-        return vaultMsg(False, "Permission denied (%s)" % error_msg)
+        # session_error tells the client to authenticate again
+        return vaultMsg(False, "Permission denied (%s)" % error_msg,
+                        {'session_error': True})
 
     sess = s
+    renew_session(cryptok, sess, request)
 
-    if 'user_id' in sess:
-        vault.myself_id = sess['user_id']
-    if 'username' in sess:
-        vault.myself_username = sess['username']
+    # Carry who made this request down to the SFLvaultAccess methods
+    request['vault'] = SFLvaultAccess(sess.get('user_id'),
+                                      sess.get('username'))
 
 @decorator
 def authenticated_admin(func, request, *args, **kwargs):
@@ -162,14 +183,9 @@ def authenticated_admin(func, request, *args, **kwargs):
     ret = _authenticated_user_first(request, cryptok)
     if ret:
         return ret
-    try:
-        sess = get_session(cryptok, request)
-    except SessionNotFoundError:
-        sess = None
-
-    if sess:
-        if not sess['userobj'].is_admin:
-            return vaultMsg(False, "Permission denied, admin priv. required")
+    me = query(User).get(request['vault'].myself_id)
+    if not me or not me.is_admin:
+        return vaultMsg(False, "Permission denied, admin priv. required")
 
     return func(request, *args, **kwargs)
 
@@ -193,6 +209,8 @@ def sflvault_authenticate(request, username, cryptok):
             except SessionExpiredError:
                 sess = None
                 print "Session expired... "
+            except SessionSourceAddressMismatchError:
+                sess = None
 
             if sess:
                 return vaultMsg(True, 'Authentication successful (cached)', {'authtok': cryptok})
@@ -219,7 +237,6 @@ def sflvault_authenticate(request, username, cryptok):
         set_session(newtok, {'username': username,
                                 'timeout': datetime.now() + timedelta(0, int(settings['sflvault.vault.session_timeout'])),
                                 'remote_addr': request.get('REMOTE_ADDR', None),
-                                'userobj': u,
                                 'user_id': u.id
                                 })
         return vaultMsg(True, 'Authentication successful', {'authtok': newtok})
@@ -255,7 +272,10 @@ def sflvault_login(request, username, version):
     
     #a = meta.Session.query(User).filter_by(username=username).one()
     e = u.elgamal()
-    cryptok = serial_elgamal_msg(e.encrypt(rnd, randfunc(32)))
+    if isinstance(e, X25519Key):
+        cryptok = encrypt_longmsg(e, rnd)
+    else:
+        cryptok = serial_elgamal_msg(elgamal_encrypt(e, rnd, randfunc(32)))
     
     transaction.commit()
     #meta.Session.close()
@@ -268,37 +288,38 @@ def user_add(request, authtok, username, is_admin):
         setup_timeout = request['settings']['sflvault.vault.setup_timeout']
     except KeyError, e:
         setup_timeout = 300
-    return vault.user_add(username, is_admin, setup_timeout=setup_timeout)
+    return get_vault(request).user_add(username, is_admin,
+                                       setup_timeout=setup_timeout)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.user_setup')
 def user_setup(request, username, pubkey):
-    return vault.user_setup(username, pubkey)
+    return get_vault(request).user_setup(username, pubkey)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.user_del')
 @authenticated_admin
 def sflvault_user_del(request, authtok, user):
-    return vault.user_del(user)
+    return get_vault(request).user_del(user)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.user_list')
 @authenticated_user
 def sflvault_user_list(request, authtok, groups):
-    return vault.user_list(groups)
+    return get_vault(request).user_list(groups)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.machine_get')
 @xmlrpc_method(endpoint='sflvault', method='sflvault.machine.get')
 @authenticated_user
 def sflvault_machine_get(request, authtok, machine_id):
-    return vault.machine_get(machine_id)
+    return get_vault(request).machine_get(machine_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.machine_put')
 @authenticated_user
 def sflvault_machine_put(request, authtok, machine_id, data):
-    return vault.machine_put(machine_id, data)
+    return get_vault(request).machine_put(machine_id, data)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.service_get')
 @authenticated_user
 def sflvault_service_get(request, authtok, service_id, group_id=None):
-    return vault.service_get(service_id, group_id)
+    return get_vault(request).service_get(service_id, group_id)
 
 
 # si ça arrive via /jsonrpc .. on convertie en JSON en sortant
@@ -312,120 +333,124 @@ def sflvault_service_get(request, authtok, service_id, group_id=None):
 @xmlrpc_method(endpoint='sflvault', method='sflvault.service_get_tree')
 @authenticated_user
 def sflvault_service_get_tree(request, authtok, service_id, with_groups):
-    return vault.service_get_tree(service_id, with_groups)
+    return get_vault(request).service_get_tree(service_id, with_groups)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.service_put')
 @authenticated_user
 def sflvault_service_put(request, authtok, service_id, data):
-    # 'user_id' required in session.
     # TODO: verify I had access to the service previously.
-    sess = get_session(authtok, request)
+    myself_id = get_vault(request).myself_id
     req = sql.join(servicegroups_table, usergroups_table,
                     ServiceGroup.group_id==UserGroup.group_id) \
                 .join(users_table, User.id==UserGroup.user_id) \
                 .select() \
-                .where(User.id==sess['user_id']) \
+                .where(User.id==myself_id) \
                 .where(ServiceGroup.service_id==service_id)
     res = list(meta.Session.execute(req))
     if not res:
         return vaultMsg(False, "You don't have access to that service.")
     else:
-        return vault.service_put(service_id, data)
+        return get_vault(request).service_put(service_id, data)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.search')
 @authenticated_user
-def sflvault_search(request, authtok, search_query, group_ids, verbose, filters):
+def sflvault_search(request, authtok, search_query, group_ids, verbose, filters,
+                    limit=None, offset=0):
     if group_ids and not filters:
         filters = {'groups': group_ids}
     if group_ids and isinstance(filters, dict) and 'groups' not in filters:
         # Please don't do that, use filters instead.
         filters['groups'] = group_ids
 
-    return vault.search(search_query, filters, verbose)
+    return get_vault(request).search(search_query, filters, verbose, limit,
+                                     offset)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.service_add')
 @authenticated_user
 def sflvault_service_add(request, authtok, machine_id, parent_service_id, url, group_ids, secret,
-        notes, metadata):
-    return vault.service_add(machine_id, parent_service_id, url, group_ids, secret, notes,
-        metadata)
+        notes, metadata, cryptsymkeys=None):
+    return get_vault(request).service_add(machine_id, parent_service_id, url,
+                                          group_ids, secret, notes, metadata,
+                                          cryptsymkeys)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.service_del')
 @authenticated_admin
 def sflvault_service_del(request, authtok, service_id):
-    return vault.service_del(service_id)
+    return get_vault(request).service_del(service_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.service_list')
 @authenticated_user
 def sflvault_service_list(request, authtok, machine_id=None, customer_id=None):
-    return vault.service_list(machine_id, customer_id)
+    return get_vault(request).service_list(machine_id, customer_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.machine_add')
 @authenticated_user
 def sflvault_machine_add(request, authtok, customer_id, name, fqdn, ip, location, notes):
-    return vault.machine_add(customer_id, name, fqdn, ip, location, notes)
+    return get_vault(request).machine_add(customer_id, name, fqdn, ip, location, notes)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.machine_del')
 @authenticated_admin
 def sflvault_machine_del(request, authtok, machine_id):
-    return vault.machine_del(machine_id)
+    return get_vault(request).machine_del(machine_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.machine_list')
 @authenticated_user
 def sflvault_machine_list(request, authtok, customer_id=None):
-    return vault.machine_list(customer_id)
+    return get_vault(request).machine_list(customer_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.customer_get')
 @xmlrpc_method(endpoint='sflvault', method='sflvault.customer.get')
 @authenticated_user
 def sflvault_customer_get(request, authtok, customer_id):
-    return vault.customer_get(customer_id)
+    return get_vault(request).customer_get(customer_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.customer_put')
 @authenticated_user
 def sflvault_customer_put(request, authtok, customer_id, data):
-    return vault.customer_put(customer_id, data)
+    return get_vault(request).customer_put(customer_id, data)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.customer_add')
 @authenticated_user
 def sflvault_customer_add(request, authtok, customer_name):
-    return vault.customer_add(customer_name)
+    return get_vault(request).customer_add(customer_name)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.customer_del')
 @authenticated_admin
 def sflvault_customer_del(request, authtok, customer_id):
-    return vault.customer_del(customer_id)
+    return get_vault(request).customer_del(customer_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.customer_list')
 @authenticated_user
 def sflvault_customer_list(request, authtok):
-    return vault.customer_list()
+    return get_vault(request).customer_list()
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_get')
 @authenticated_user
 def sflvault_group_get(request, authtok, group_id):
-    return vault.group_get(group_id)
+    return get_vault(request).group_get(group_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_put')
 @authenticated_user
 def sflvault_group_put(request, authtok, group_id, data):
-    return vault.group_put(group_id, data)
+    return get_vault(request).group_put(group_id, data)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_add')
 @authenticated_user
 def sflvault_group_add(request, authtok, group_name):
-    return vault.group_add(group_name)
+    return get_vault(request).group_add(group_name)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_del')
 @authenticated_admin
 def sflvault_group_del(request, authtok, group_id, delete_cascade):
-    return vault.group_del(group_id,
+    return get_vault(request).group_del(group_id,
                            delete_cascade=delete_cascade)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_add_service')
 @authenticated_user
-def sflvault_group_add_service(request, authtok, group_id, service_id, symkey):
-    return vault.group_add_service(group_id, service_id, symkey)
+def sflvault_group_add_service(request, authtok, group_id, service_id, symkey,
+                               cryptsymkey=None):
+    return get_vault(request).group_add_service(group_id, service_id, symkey,
+                                                cryptsymkey)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_del_service')
 @authenticated_user
@@ -433,12 +458,13 @@ def sflvault_group_del_service(request, authtok, group_id, service_id):
     fail = test_group_admin(request, group_id)
     if fail:
         return fail
-    return vault.group_del_service(group_id, service_id)
+    return get_vault(request).group_del_service(group_id, service_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_add_user')
 @authenticated_user
 def sflvault_group_add_user(request, authtok, group_id, user, is_admin=False, cryptgroupkey=None):
-    return vault.group_add_user(group_id, user, is_admin, cryptgroupkey)
+    return get_vault(request).group_add_user(group_id, user, is_admin,
+                                             cryptgroupkey)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_del_user')
 @authenticated_user
@@ -446,54 +472,86 @@ def sflvault_group_del_user(request, authtok, group_id, user):
     fail = test_group_admin(request, group_id)
     if fail:
         return fail
-    return vault.group_del_user(group_id, user)
+    return get_vault(request).group_del_user(group_id, user)
+
+@xmlrpc_method(endpoint='sflvault', method='sflvault.group_ciphers_get')
+@authenticated_user
+def sflvault_group_ciphers_get(request, authtok, group_id, kind, after_id=0,
+                               limit=100, version=None):
+    fail = test_group_admin(request, group_id)
+    if fail:
+        return fail
+    return get_vault(request).group_ciphers_get(group_id, kind, after_id,
+                                                limit, version)
+
+@xmlrpc_method(endpoint='sflvault', method='sflvault.group_ciphers_put')
+@authenticated_user
+def sflvault_group_ciphers_put(request, authtok, group_id, kind, ciphers):
+    fail = test_group_admin(request, group_id)
+    if fail:
+        return fail
+    return get_vault(request).group_ciphers_put(group_id, kind, ciphers)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_list')
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group.list')
 @authenticated_user
 def sflvault_group_list(request, authtok, list_users=False):
-    return vault.group_list(False, list_users)
+    return get_vault(request).group_list(False, list_users)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.service_passwd')
 @authenticated_user
-def sflvault_service_passwd(request, authtok, service_id, newsecret):
-    return vault.service_passwd(service_id, newsecret)
+def sflvault_service_passwd(request, authtok, service_id, newsecret,
+                            cryptsymkeys=None):
+    return get_vault(request).service_passwd(service_id, newsecret,
+                                             cryptsymkeys)
+
+@xmlrpc_method(endpoint='sflvault', method='sflvault.metrics')
+@authenticated_admin
+def sflvault_metrics(request, authtok):
+    return vaultMsg(True, "Here are the server metrics",
+                    {'metrics': metrics.snapshot()})
 
-#def _setup_sessions():
-#    """DRY out set_session and get_session"""
-#    if not hasattr(, 'vaultSessions'):
-#        .vaultSessions = {}
 def set_session(authtok, value):
-    """Sets in 'g.vaultSessions':
+    """Sets in the session store:
     {authtok1: {'username':  , 'timeout': datetime}, authtok2: {}..}
-    
+
+    Only IDs and plain values are kept, see sflvault.lib.sessions
     """
- #   _setup_sessions();
-    vaultSessions[authtok] = value;
+    session_store.set(authtok, value)
 
 def get_session(authtok, request):
     """Return the values associated with a session"""
-    #_setup_sessions();
-    
-    if not vaultSessions.has_key(authtok):
+    sess = session_store.get(authtok)
+
+    if sess is None:
         raise SessionNotFoundError
         return None
 
-    # XXX: where does the SESSION_TIMEOUT come from?
-    if not vaultSessions[authtok].has_key('timeout'):
-        vaultSessions[authtok]['timeout'] = datetime.now() + timedelta(0, SESSION_TIMEOUT)
-
-    if vaultSessions[authtok]['timeout'] < datetime.now():
-        del(vaultSessions[authtok])
+    if sess['timeout'] < datetime.now():
+        session_store.delete(authtok)
         raise SessionExpiredError
         return None
 
-    if vaultSessions[authtok]['remote_addr'] != request.get('REMOTE_ADDR', 'gibberish'):
-        del(vaultSessions[authtok])
-        SessionSourceAddressMismatchError
+    if sess['remote_addr'] != request.get('REMOTE_ADDR', 'gibberish'):
+        session_store.delete(authtok)
+        raise SessionSourceAddressMismatchError
         return None
 
-    return vaultSessions[authtok]
+    return sess
+
+def renew_session(authtok, sess, request):
+    """Push back the session's timeout, once half of it has passed, while
+    it is being used.  Only with `sflvault.vault.session_renew` on."""
+    settings = request.get('settings', {})
+    if settings.get('sflvault.vault.session_renew', 'false').lower() \
+       not in ['1', 'true', 't']:
+        return
+    timeout = timedelta(0, int(settings['sflvault.vault.session_timeout']))
+    now = datetime.now()
+    if sess['timeout'] - now < timeout / 2:
+        sess['timeout'] = now + timeout
+        set_session(authtok, sess)
+        metrics.incr('sessions.renewed')
 
 class SessionNotFoundError(Exception):
     pass